@@ -0,0 +1,37 @@
+import importlib
+
+# Submodules are imported on first use, so importing the package is cheap and
+# NumPy is only loaded with the modules that need it
+SUBMODULES = (
+    "batch_decoder", "benchmark", "cc11xx", "cli", "dedup", "doppler", "framing",
+    "fsk_demodulator", "health_metrics", "hex_decoder", "ingest_server", "instrumentation",
+    "iq_reader", "ntcle100_temp_sensor", "parallel_decoder", "recovery", "serializers",
+    "synthetic", "telemetry_store", "telemetry_unit_conversions", "vectorized_conversions",
+)
+# Names available from the package itself, and their submodules
+EXPORTS = {
+    "CspPacket": "hex_decoder",
+    "EpsStatisticsMessage": "hex_decoder",
+    "HWRadioPacket": "hex_decoder",
+    "UhfStatisticsMessage": "hex_decoder",
+    "decode_statistics_frame": "hex_decoder",
+    "eps_to_json": "hex_decoder",
+    "uhf_to_json": "hex_decoder",
+    "METRICS": "instrumentation",
+}
+
+__all__ = list(SUBMODULES) + sorted(EXPORTS)
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    if name in EXPORTS:
+        value = getattr(importlib.import_module("." + EXPORTS[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,229 @@
+from collections import OrderedDict
+from ctypes import sizeof
+import functools
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .cc11xx import check_crc_frames
+from .hex_decoder import message_layout, csp_address_mask, LENGTH_HEADER_SIZE, HEADER_SIZE, \
+    HEADER_PLUS_LENGTH_SIZE, CSP_HEADER_FIELDS, RADIO_FRAME_CSP_OFFSET, RadioPacketType, \
+    STATISTICS_DISPATCHER
+
+# Offset of the message struct inside a demodulated frame:
+# length byte, radio packet type, CSP header and CSP length
+RADIO_FRAME_PAYLOAD_OFFSET = LENGTH_HEADER_SIZE + 1 + HEADER_PLUS_LENGTH_SIZE
+
+
+def column_name(path):
+    return ".".join(str(key) for key in path)
+
+
+def _field_dtype(field):
+    # MessageData structures are little endian regardless of the host
+    dtype = np.dtype(field.ctype).newbyteorder("<")
+    if field.shape:
+        return np.dtype((dtype, field.shape))
+    return dtype
+
+
+@functools.lru_cache(maxsize=None)
+def message_dtype(message_class, offset=0, itemsize=None):
+    if itemsize is None:
+        itemsize = offset + sizeof(message_class)
+    if itemsize < offset + sizeof(message_class):
+        raise ValueError("Record of %d bytes can't hold %s at offset %d" %
+                         (itemsize, message_class.__name__, offset))
+    layout = message_layout(message_class)
+    # Bitfields and union members overlap their storage unit, which numpy
+    # allows for plain (non-object) fields
+    return np.dtype({"names": [column_name(field.path) for field in layout],
+                     "formats": [_field_dtype(field) for field in layout],
+                     "offsets": [offset + field.offset for field in layout],
+                     "itemsize": itemsize})
+
+
+def records_to_columns(message_class, records):
+    columns = OrderedDict()
+    for field in message_layout(message_class):
+        name = column_name(field.path)
+        column = records[name]
+        if field.bit_size is not None:
+            mask = (1 << field.bit_size) - 1
+            column = (column >> field.bit_offset) & mask
+        columns[name] = column
+    return columns
+
+
+def decode_records(message_class, frames, offset=0, frame_size=None):
+    if isinstance(frames, (bytes, bytearray, memoryview)):
+        buffer = frames
+    else:
+        frames = list(frames)
+        sizes = {len(frame) for frame in frames}
+        if len(sizes) > 1:
+            raise ValueError("All frames of a batch should have the same length")
+        if frame_size is None and sizes:
+            frame_size = sizes.pop()
+        buffer = b"".join(frames)
+    dtype = message_dtype(message_class, offset, frame_size)
+    if len(buffer) % dtype.itemsize:
+        raise ValueError("Buffer length %d is not a multiple of the %d byte frame size" %
+                         (len(buffer), dtype.itemsize))
+    return np.frombuffer(buffer, dtype=dtype)
+
+
+# Decodes N messages into one array per field. frames is either a single
+# buffer with the messages back to back or an iterable of equally sized
+# buffers; with offset and frame_size whole radio frames can be decoded
+# without slicing out the payloads first.
+def decode_columns(message_class, frames, offset=0, frame_size=None):
+    return records_to_columns(message_class,
+                              decode_records(message_class, frames, offset, frame_size))
+
+
+def frames_to_columns(message_class, frames):
+    return decode_columns(message_class, frames, offset=RADIO_FRAME_PAYLOAD_OFFSET)
+
+
+def pack_frames(frames):
+    # One buffer with the frames back to back, and the offset and length of
+    # each frame in it
+    frames = list(frames)
+    lengths = np.fromiter(map(len, frames), dtype=np.int64, count=len(frames))
+    offsets = np.zeros(len(frames), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=offsets[1:])
+    return b"".join(frames), offsets, lengths
+
+
+def fixed_size_frames(buffer, frame_size):
+    # Offsets and lengths of equally sized frames stored back to back
+    count = len(buffer) // frame_size
+    return np.arange(count, dtype=np.int64) * frame_size, np.full(count, frame_size, np.int64)
+
+
+def _frame_stride(offsets, valid):
+    # Distance between consecutive frames when they are evenly spaced and all
+    # long enough, so fields can be read through a strided view
+    if len(offsets) < 2 or not valid.all():
+        return None
+    stride = int(offsets[1] - offsets[0])
+    if stride <= 0 or not (np.diff(offsets) == stride).all():
+        return None
+    return stride
+
+
+def _load(buffer, data, positions, stride, dtype):
+    # The dtype value at each position, a zero copy strided view of evenly
+    # spaced positions and a gather of the others
+    dtype = np.dtype(dtype)
+    if stride is not None:
+        return np.ndarray((len(positions),), dtype, buffer, int(positions[0]), (stride,))
+    return sliding_window_view(data, dtype.itemsize)[positions].view(dtype)[:, 0]
+
+
+# Decodes the raw CSP header and length field of every frame in buffer
+# without a Python object per frame. valid is set for frames of
+# packet_type (any type when None) that hold the whole packet announced by
+# the length field; the header and length of the others are 0. With
+# check_crc the frames end with the CC11xx CRC and must also pass it.
+def decode_csp_headers(buffer, offsets, lengths, csp_offset=RADIO_FRAME_CSP_OFFSET,
+                       packet_type=RadioPacketType.CSP, check_crc=False):
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    valid = lengths >= csp_offset + HEADER_PLUS_LENGTH_SIZE
+    if check_crc:
+        valid &= check_crc_frames(buffer, offsets, lengths)
+    header = np.zeros(len(offsets), dtype=np.uint32)
+    length = np.zeros(len(offsets), dtype=np.uint16)
+    if valid.any():
+        stride = _frame_stride(offsets, valid)
+        # Frames too short for a header read the first bytes and are masked
+        positions = np.where(valid, offsets, 0)
+        if packet_type is not None:
+            valid &= _load(buffer, data, positions + LENGTH_HEADER_SIZE, stride,
+                           np.uint8) == packet_type
+        header[valid] = _load(buffer, data, positions + csp_offset, stride, ">u4")[valid]
+        length[valid] = _load(buffer, data, positions + csp_offset + HEADER_SIZE, stride,
+                              ">u2")[valid]
+        valid &= lengths >= csp_offset + HEADER_PLUS_LENGTH_SIZE + length
+        header[~valid] = 0
+        length[~valid] = 0
+    return OrderedDict([("header", header), ("length", length), ("valid", valid),
+                        ("offset", offsets + csp_offset)])
+
+
+def csp_header_field(headers, name):
+    shift, mask = CSP_HEADER_FIELDS[name]
+    return ((headers["header"] >> shift) & mask).astype(np.uint8)
+
+
+def csp_header_columns(headers):
+    return OrderedDict((name, csp_header_field(headers, name)) for name in CSP_HEADER_FIELDS)
+
+
+def select_csp(headers, predicate=None, **address):
+    # Boolean mask of the valid frames with the given header fields, e.g.
+    # dst_port=10 or hmac=True. A field can also be given a collection of
+    # accepted values. All exact fields are checked with a single mask and
+    # compare of the raw headers. predicate gets the header columns and
+    # returns a boolean array for anything else.
+    selection = headers["valid"].copy()
+    exact = {}
+    for name, value in address.items():
+        if isinstance(value, (int, np.integer)):
+            exact[name] = value
+        else:
+            # Checked here so that unknown fields fail the same way
+            csp_address_mask({name: 0})
+            selection &= np.isin(csp_header_field(headers, name),
+                                 np.fromiter(value, dtype=np.int64))
+    mask, value = csp_address_mask(exact)
+    if mask:
+        selection &= (headers["header"] & np.uint32(mask)) == np.uint32(value)
+    if predicate is not None:
+        selection &= predicate(csp_header_columns(headers))
+    return selection
+
+
+def gather_records(message_class, buffer, positions):
+    # Copies the message at each position into a record array, reading only
+    # those bytes
+    windows = sliding_window_view(np.frombuffer(buffer, dtype=np.uint8), sizeof(message_class))
+    rows = windows[np.asarray(positions, dtype=np.int64)]
+    return rows.view(message_dtype(message_class))[:, 0]
+
+
+# Groups the selected frames by message type and decodes only those. The
+# dispatcher is consulted once per distinct header and length, not per
+# frame. Returns an OrderedDict of message class to (frame indices,
+# columns); unregistered traffic is left out.
+def dispatch_columns(buffer, headers, selection=None, dispatcher=STATISTICS_DISPATCHER):
+    if selection is None:
+        selection = headers["valid"]
+    indices = np.flatnonzero(selection)
+    keys = (headers["header"][indices].astype(np.uint64) << np.uint64(16)) | \
+        headers["length"][indices]
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    groups = OrderedDict()
+    for key_index, key in enumerate(unique_keys.tolist()):
+        message_class = dispatcher.lookup(key >> 16, key & 0xffff)
+        if message_class is not None:
+            groups.setdefault(message_class, []).append(key_index)
+    results = OrderedDict()
+    for message_class, key_indices in groups.items():
+        message_indices = indices[np.isin(inverse, key_indices)]
+        records = gather_records(message_class, buffer,
+                                 headers["offset"][message_indices] + HEADER_PLUS_LENGTH_SIZE)
+        results[message_class] = (message_indices, records_to_columns(message_class, records))
+    return results
+
+
+def filter_frames(frames, predicate=None, **address):
+    # The frames with the given CSP header fields, the others never become
+    # Python objects
+    buffer, offsets, lengths = pack_frames(frames)
+    selection = select_csp(decode_csp_headers(buffer, offsets, lengths), predicate, **address)
+    return [buffer[start:start + length] for start, length in
+            zip(offsets[selection].tolist(), lengths[selection].tolist())]
@@ -0,0 +1,248 @@
+import argparse
+from collections import OrderedDict
+import copy
+import json
+import logging
+import os
+import platform
+import random
+import struct
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from .cc11xx import crc16, CRC16_SIZE
+from .hex_decoder import HWRadioPacket, CspPacket, EpsStatisticsMessage, ctypes_obj_to_dic, \
+    _ctypes_obj_to_dic, compile_message_view
+from .ntcle100_temp_sensor import resistance_to_celsius
+from .serializers import compile_ndjson_formatter
+
+# The EPS beacon of the README
+README_EPS_PACKET = bytes.fromhex(
+    '71 01 07 00 C3 00 00 62 81 F8 00 5C AC 60 03 00 77 7A 35 00 8F 00 00 00 5E 00 00 00 0A 00 02 '
+    '06 02 02 02 02 02 02 02 06 02 02 06 DE 72 01 00 C6 00 00 00 00 FE FF 03 00 77 00 BB 00 27 00 '
+    'E0 05 07 05 FF 07 A5 0D 2E 00 05 00 97 01 01 00 F6 00 00 00 7A 08 B3 0C 03 00 00 00 7E 0A 18 '
+    '0B B5 07 9D 08 C3 06 C3 06 00 04 00 3F 20 23 04 26 FD 7A AB FF B4 AC')
+# Offset of the message inside the frame and of its ADC channels
+MESSAGE_OFFSET = 8
+ADC_OFFSET = MESSAGE_OFFSET + 46
+ADC_CHANNELS = 20
+DEFAULT_FRAMES = 100000
+DEFAULT_SEED = 1
+REGRESSION_THRESHOLD = 0.10
+# Modules timed by the import benchmark, the package alone first
+IMPORT_MODULES = ("rhw_telemetry", "rhw_telemetry.hex_decoder", "rhw_telemetry.cli",
+                  "rhw_telemetry.ingest_server", "rhw_telemetry.vectorized_conversions",
+                  "rhw_telemetry.fsk_demodulator", "rhw_telemetry.parallel_decoder")
+_IMPORT_SOURCE = ("import sys, time\n"
+                  "start = time.perf_counter()\n"
+                  "import %s\n"
+                  "print(time.perf_counter() - start, 'numpy' in sys.modules)\n")
+
+
+def synthetic_corpus(count, seed=DEFAULT_SEED):
+    # Deterministic variations of the README beacon: increasing timestamp
+    # and counters, random 12 bit ADC readings and a valid CRC
+    rng = random.Random(seed)
+    frame = bytearray(README_EPS_PACKET)
+    corpus = []
+    for idx in range(count):
+        struct.pack_into("<III", frame, MESSAGE_OFFSET, 1543567489 + 30 * idx,
+                         221356 + 7 * idx, 3504759 + 11 * idx)
+        struct.pack_into("<%dH" % ADC_CHANNELS, frame, ADC_OFFSET,
+                         *[rng.randrange(1, 4095) for _ in range(ADC_CHANNELS)])
+        struct.pack_into(">H", frame, len(frame) - CRC16_SIZE,
+                         crc16(memoryview(frame)[:-CRC16_SIZE]))
+        corpus.append(frame.hex(" ").upper())
+    return corpus
+
+
+# (name, function, mutates input) in pipeline order, each stage is fed the
+# outputs of the previous one
+PIPELINE_STAGES = [
+    ("bytes.fromhex", bytes.fromhex, False),
+    ("HWRadioPacket.from_bytes", HWRadioPacket.from_bytes, False),
+    ("CspPacket.from_bytes", lambda packet: CspPacket.from_bytes(packet.payload_view), False),
+    ("from_buffer_copy", lambda csp: EpsStatisticsMessage.from_buffer_copy(csp.payload_view),
+     False),
+    ("ctypes_obj_to_dic", _ctypes_obj_to_dic, False),
+    ("unit_conversions_to_ground", EpsStatisticsMessage.unit_conversions_to_ground, True),
+    ("json.dumps", lambda dic: json.dumps(dic, indent=1, sort_keys=False), False),
+]
+
+
+def _time_stage(function, inputs, repeat, mutates=False):
+    best = None
+    outputs = None
+    for _ in range(repeat):
+        # In place stages get a fresh copy of their input every round
+        items = copy.deepcopy(inputs) if mutates else inputs
+        start = time.perf_counter()
+        outputs = [function(item) for item in items]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, outputs
+
+
+def _peak_memory(function, inputs, mutates=False):
+    items = copy.deepcopy(inputs) if mutates else inputs
+    tracemalloc.start()
+    outputs = [function(item) for item in items]
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del outputs
+    return peak
+
+
+def _result(seconds, items, peak):
+    return OrderedDict([("seconds", seconds), ("items", items),
+                        ("per_item_us", seconds / items * 1e6 if items else None),
+                        ("items_per_s", items / seconds if seconds else None),
+                        ("peak_bytes", peak)])
+
+
+def _benchmark(results, name, function, inputs, repeat, memory, mutates=False):
+    seconds, outputs = _time_stage(function, inputs, repeat, mutates)
+    peak = _peak_memory(function, inputs, mutates) if memory else None
+    results[name] = _result(seconds, len(inputs), peak)
+    return outputs
+
+
+def _view_fields(view):
+    return view.timestamp, view.adc_statistics.bat_v, view.eps_statistics.boot_count
+
+
+def run_benchmarks(frames=DEFAULT_FRAMES, repeat=3, seed=DEFAULT_SEED, memory=True):
+    results = OrderedDict()
+    outputs = OrderedDict()
+    inputs = synthetic_corpus(frames, seed)
+    for name, function, mutates in PIPELINE_STAGES:
+        inputs = outputs[name] = _benchmark(results, name, function, inputs, repeat, memory,
+                                            mutates)
+
+    resistances = [1000 + (idx * 7919) % 400000 for idx in range(frames)]
+    _benchmark(results, "resistance_to_celsius", resistance_to_celsius, resistances,
+               repeat, memory)
+
+    # The whole payload to dict path, reflective and compiled
+    payloads = [csp.payload for csp in outputs["CspPacket.from_bytes"]]
+    _benchmark(results, "from_buffer_copy+ctypes_obj_to_dic",
+               lambda payload: ctypes_obj_to_dic(EpsStatisticsMessage.from_buffer_copy(payload)),
+               payloads, repeat, memory)
+    _benchmark(results, "EpsStatisticsMessage.decode", EpsStatisticsMessage.decode,
+               payloads, repeat, memory)
+    _benchmark(results, "ndjson formatter", compile_ndjson_formatter(EpsStatisticsMessage),
+               payloads, repeat, memory)
+
+    # Selective access through a lazy view, a typical filter
+    view = compile_message_view(EpsStatisticsMessage)
+    _benchmark(results, "view timestamp+bat_v+boot_count",
+               lambda payload: _view_fields(view(payload)), payloads, repeat, memory)
+
+    radio_frames = outputs["bytes.fromhex"]
+    _benchmark(results, "crc16", crc16, radio_frames, repeat, memory)
+
+    # CRC checks and filtering by CSP address of whole frames in one
+    # vectorized pass
+    try:
+        batch_stages = _batch_stages()
+    except ImportError:
+        return results
+    for name, function in batch_stages:
+        seconds, _ = _time_stage(function, [radio_frames], repeat)
+        peak = _peak_memory(function, [radio_frames]) if memory else None
+        results[name] = _result(seconds, len(radio_frames), peak)
+    return results
+
+
+def _batch_stages():
+    # NumPy is only needed for the batch stages
+    # pylint: disable=import-outside-toplevel
+    from .batch_decoder import pack_frames, decode_csp_headers, select_csp
+    from .cc11xx import check_crc_frames
+
+    def check_crc(frames):
+        return check_crc_frames(*pack_frames(frames))
+
+    def filter_csp(frames):
+        headers = decode_csp_headers(*pack_frames(frames))
+        return select_csp(headers, dst_port=10, hmac=True)
+    return [("batch CRC check", check_crc), ("batch CSP header filter", filter_csp)]
+
+
+def import_times(modules=IMPORT_MODULES, repeat=5):
+    # Cold start cost: the best of repeat imports of each module, each in a
+    # fresh interpreter, and whether it loaded NumPy
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ, PYTHONPATH=root)
+    results = OrderedDict()
+    for module in modules:
+        samples = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, "-c", _IMPORT_SOURCE % module],
+                                    env=environment, check=True, stdout=subprocess.PIPE,
+                                    universal_newlines=True).stdout.split()
+            samples.append(float(output[0]))
+        results[module] = OrderedDict([("seconds", min(samples)),
+                                       ("numpy", output[1] == "True")])
+    return results
+
+
+def compare(baseline, current, threshold=REGRESSION_THRESHOLD):
+    # Stages whose time per item, and modules whose import time, grew more
+    # than threshold
+    regressions = OrderedDict()
+    for section, key in (("stages", "per_item_us"), ("imports", "seconds")):
+        for name, result in current.get(section, {}).items():
+            old = baseline.get(section, {}).get(name)
+            if not old or not old[key] or not result[key]:
+                continue
+            ratio = result[key] / old[key]
+            if ratio > 1 + threshold:
+                regressions[name] = ratio
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark every telemetry decode stage")
+    parser.add_argument("--frames", type=int, default=DEFAULT_FRAMES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc runs")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="baseline JSON results to flag regressions against")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--import-time", action="store_true",
+                        help="also time cold imports of the package and its modules")
+    args = parser.parse_args(argv)
+
+    # Keep the out of range temperature errors of random ADC values quiet
+    logging.disable(logging.ERROR)
+    report = OrderedDict([("python", platform.python_version()),
+                          ("machine", platform.machine()),
+                          ("frames", args.frames), ("seed", args.seed),
+                          ("stages", run_benchmarks(args.frames, args.repeat, args.seed,
+                                                    not args.no_memory))])
+    for name, result in report["stages"].items():
+        print("%-36s %10.3f us/item %12.0f items/s %12s bytes peak" % (
+            name, result["per_item_us"], result["items_per_s"], result["peak_bytes"]))
+    if args.import_time:
+        report["imports"] = import_times(repeat=max(args.repeat, 5))
+        for name, result in report["imports"].items():
+            print("import %-36s %8.1f ms%s" % (name, result["seconds"] * 1e3,
+                                               " (loads numpy)" if result["numpy"] else ""))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=1)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(json.load(baseline_file), report, args.threshold)
+        for name, ratio in regressions.items():
+            print("REGRESSION %s: %.2fx slower" % (name, ratio))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
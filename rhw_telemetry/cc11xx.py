@@ -0,0 +1,199 @@
+# CC11xx link layer, see the CC1101 datasheet sections "Data whitening" and
+# "CRC check": www.ti.com/lit/ds/symlink/cc1101.pdf
+
+import functools
+import struct
+
+PN9_SEED = 0x1FF
+# The PN9 byte sequence repeats after 511 bytes
+PN9_PERIOD_BYTES = 511
+
+
+def _pn9_sequence(length):
+    state = PN9_SEED
+    sequence = bytearray(length)
+    for idx in range(length):
+        sequence[idx] = state & 0xFF
+        for _ in range(8):
+            state = (state >> 1) | ((((state >> 5) ^ state) & 1) << 8)
+    return bytes(sequence)
+
+
+PN9_SEQUENCE = _pn9_sequence(PN9_PERIOD_BYTES)
+
+
+def dewhiten(data):
+    # Whitening is its own inverse, XOR the whole buffer with the PN9
+    # sequence at once
+    length = len(data)
+    if length > PN9_PERIOD_BYTES:
+        raise ValueError("Whitened data can't be longer than %d bytes" % PN9_PERIOD_BYTES)
+    return (int.from_bytes(data, "big") ^
+            int.from_bytes(PN9_SEQUENCE[:length], "big")).to_bytes(length, "big")
+
+
+whiten = dewhiten
+
+
+CRC16_POLYNOMIAL = 0x8005
+CRC16_INIT = 0xFFFF
+CRC16_SIZE = 2
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = (crc << 1) ^ CRC16_POLYNOMIAL if crc & 0x8000 else crc << 1
+        table.append(crc & 0xFFFF)
+    return tuple(table)
+
+
+CRC16_TABLE = _crc16_table()
+
+
+@functools.lru_cache(maxsize=None)
+def crc16_pair_table():
+    # CRC state after two bytes, indexed by the state XOR the two bytes
+    table = CRC16_TABLE
+    pairs = []
+    for state in range(1 << 16):
+        state = ((state << 8) & 0xFFFF) ^ table[state >> 8]
+        pairs.append(((state << 8) & 0xFFFF) ^ table[state >> 8])
+    return tuple(pairs)
+
+
+def crc16(data, crc=CRC16_INIT):
+    # CRC of the length byte and the data, sent big endian after them. The
+    # CRC of a whole frame, CRC included, is 0.
+    if len(data) % 2:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ data[0]]
+        data = memoryview(data)[1:]
+    table = crc16_pair_table()
+    for pair in struct.unpack(">%dH" % (len(data) // 2), data):
+        crc = table[crc ^ pair]
+    return crc
+
+
+def check_crc(frame):
+    # Whether a frame from the length byte to the CRC is intact
+    return len(frame) > CRC16_SIZE and crc16(frame) == 0
+
+
+@functools.lru_cache(maxsize=None)
+def _crc16_swapped_pair_array():
+    # crc16_pair_table with the state and the index byte swapped, for the
+    # two bytes read as a little endian word
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    table = np.array(crc16_pair_table(), dtype=np.uint16)
+    return table[np.arange(1 << 16, dtype=np.uint16).byteswap()].byteswap()
+
+
+def crc16_rows(rows, crc=CRC16_INIT):
+    # crc16 of every row of a 2-D uint8 NumPy array at once, one table
+    # lookup per two columns
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    crcs = np.full(len(rows), crc, dtype=np.uint16)
+    if rows.shape[1] % 2:
+        table = np.array(CRC16_TABLE, dtype=np.uint16)
+        crcs = (crcs << 8) ^ table[(crcs >> 8) ^ rows[:, 0]]
+        rows = rows[:, 1:]
+    if rows.strides[1] != 1:
+        rows = np.ascontiguousarray(rows)
+    pair_table = _crc16_swapped_pair_array()
+    crcs = crcs.byteswap()
+    index = np.empty_like(crcs)
+    # Columns of the pairs transposed to rows keep the lookups sequential
+    for pairs in np.ascontiguousarray(rows.view("<u2").T):
+        np.bitwise_xor(crcs, pairs, out=index)
+        np.take(pair_table, index, out=crcs)
+    return crcs.byteswap()
+
+
+def dewhiten_frames(buffer, offsets, lengths):
+    # dewhiten of every frame in buffer at once: the PN9 sequence restarting
+    # at each frame is laid out into a key as long as buffer, which is then
+    # XORed with it in one go. Bytes between frames are copied as they are.
+    # Whitening works the same way.
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    key = bytearray(len(buffer))
+    sequence = memoryview(PN9_SEQUENCE)
+    for offset, length in zip(np.asarray(offsets).tolist(), np.asarray(lengths).tolist()):
+        if length > PN9_PERIOD_BYTES:
+            raise ValueError("Whitened data can't be longer than %d bytes" % PN9_PERIOD_BYTES)
+        key[offset:offset + length] = sequence[:length]
+    return np.frombuffer(buffer, dtype=np.uint8) ^ np.frombuffer(key, dtype=np.uint8)
+
+
+def check_crc_frames(buffer, offsets, lengths):
+    # check_crc of every frame in buffer, a boolean NumPy array. Frames of
+    # the same length are checked together, and frames running past the end
+    # of buffer fail.
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    intact = np.zeros(len(offsets), dtype=bool)
+    checked = (lengths > CRC16_SIZE) & (offsets >= 0) & (offsets + lengths <= len(data))
+    for length in np.unique(lengths[checked]).tolist():
+        selected = np.flatnonzero(checked & (lengths == length))
+        rows = np.lib.stride_tricks.sliding_window_view(data, length)[offsets[selected]]
+        intact[selected] = crc16_rows(rows) == 0
+    return intact
+
+
+@functools.lru_cache(maxsize=None)
+def crc16_syndromes(length):
+    # How flipping each bit of a length byte frame changes crc16 of the whole
+    # frame, bit 8 * i + 7 being the lowest bit of byte i. The CRC is linear
+    # apart from its initial value, so the change doesn't depend on the
+    # data and the syndromes of several flips XOR together. The polynomial
+    # has a period of 32767 bits, so no two bits of a frame share one.
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    bits = np.arange(8 * length)
+    rows = np.zeros((len(bits), length), dtype=np.uint8)
+    rows[bits, bits // 8] = 0x80 >> (bits % 8)
+    syndromes = crc16_rows(rows, crc=0)
+    syndromes.flags.writeable = False
+    return syndromes
+
+
+def crc16_flip_candidates(rows, max_flips=2, first_bit=0):
+    # The bit flips that make the rows of a 2-D uint8 array of frames pass
+    # the CRC, at most max_flips (1 or 2) flips per frame and only at bits
+    # from first_bit on. Returns NumPy arrays of the row, the first flipped
+    # bit and the second one, -1 for single flips. A frame with one bit
+    # error has exactly one single flip candidate, but two bit errors share
+    # their syndrome with several other pairs. Each frame is compared
+    # against all syndromes at once, pairs through a sorted syndrome table.
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    syndromes = crc16_syndromes(rows.shape[1])
+    residues = crc16_rows(rows)
+    frame, first = np.nonzero(syndromes[first_bit:] == residues[:, None])
+    first += first_bit
+    second = np.full(len(frame), -1, dtype=np.int64)
+    if max_flips >= 2:
+        order = np.argsort(syndromes[first_bit:], kind="stable") + first_bit
+        ordered = syndromes[order]
+        # Each bit pairs with the bit whose syndrome XORs it to the residue
+        targets = syndromes[first_bit:] ^ residues[:, None]
+        positions = np.minimum(np.searchsorted(ordered, targets), len(ordered) - 1)
+        partners = order[positions]
+        bits = np.arange(first_bit, len(syndromes))
+        pair_frame, pair_first = np.nonzero((ordered[positions] == targets) & (partners > bits))
+        frame = np.concatenate((frame, pair_frame))
+        first = np.concatenate((first, pair_first + first_bit))
+        second = np.concatenate((second, partners[pair_frame, pair_first]))
+    return frame, first, second
+
+
+def flip_bits(rows, frame, first, second):
+    # Copies of the rows with the candidate flips of crc16_flip_candidates
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    candidates = rows[frame]
+    index = np.arange(len(frame))
+    candidates[index, first // 8] ^= (0x80 >> (first % 8)).astype(np.uint8)
+    pairs = second >= 0
+    candidates[index[pairs], second[pairs] // 8] ^= (0x80 >> (second[pairs] % 8)).astype(np.uint8)
+    return candidates
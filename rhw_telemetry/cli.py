@@ -0,0 +1,395 @@
+import argparse
+from collections import Counter
+import functools
+import logging
+import string
+import struct
+import sys
+import time
+
+from .cc11xx import crc16
+from .framing import RadioPacketFramer, CC11XX_CRC_SIZE
+from .hex_decoder import RadioPacketType, STATISTICS_DISPATCHER, \
+    RADIO_FRAME_CSP_OFFSET, HEADER_PLUS_LENGTH_SIZE, LENGTH_HEADER_SIZE
+from .instrumentation import METRICS
+from .serializers import compile_ndjson_formatter
+from .telemetry_unit_conversions import active_calibration, load_calibration_profile, \
+    use_calibration
+
+LOG_FORMAT = "%(asctime)s.%(msecs)03dZ - %(levelname)s: %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+BATCH_SIZE = 2000
+READ_SIZE = 1 << 16
+FAILURE_STAGES = ("hex", "crc", "radio", "csp", "decode")
+MESSAGE_OFFSET = RADIO_FRAME_CSP_OFFSET + HEADER_PLUS_LENGTH_SIZE
+# recovery.MAX_FLIPS, not imported so that parsing the arguments doesn't
+# load numpy
+MAX_FLIPS = 2
+_HEX_CHARACTERS = frozenset((string.hexdigits + string.whitespace).encode())
+
+
+def configure_logging(level=logging.INFO):
+    # Only the command line entry points configure logging, importing the
+    # package leaves it to the application
+    logging.basicConfig(level=level, format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
+
+
+@functools.lru_cache(maxsize=None)
+def _ndjson_formatter(message_class):
+    # The message type goes first on every line so that mixed output can be
+    # told apart
+    return '{"message":"%s",' % message_class.__name__, compile_ndjson_formatter(message_class)
+
+
+def parse_hex(line):
+    return bytes.fromhex(line)
+
+
+def format_ndjson_line(message_class, frame):
+    prefix, format_ndjson = _ndjson_formatter(message_class)
+    return prefix + format_ndjson(frame, MESSAGE_OFFSET)[1:]
+
+
+def decode_frame(frame, dispatcher=STATISTICS_DISPATCHER):
+    # Returns (failed stage, None), ("skipped", None) for unregistered
+    # traffic or (None, NDJSON line)
+    if isinstance(frame, str):
+        try:
+            frame = parse_hex(frame)
+        except ValueError:
+            return "hex", None
+    if len(frame) < 2 or frame[1] not in RadioPacketType.TYPES:
+        return "radio", None
+    # The message type comes from the CSP header and length field alone
+    try:
+        message_class = dispatcher.dispatch_frame(frame)
+    except ValueError:
+        return "csp", None
+    if message_class is None:
+        return "skipped", None
+    try:
+        return None, format_ndjson_line(message_class, frame)
+    except (ValueError, struct.error):
+        return "decode", None
+
+
+def tag_bit_flips(line, bit_flips):
+    # Adds the number of bits flipped to recover a frame after the message
+    # type of its NDJSON line
+    split = line.index(",") + 1
+    return '%s"bit_flips":%d,%s' % (line[:split], bit_flips, line[split:])
+
+
+def _has_crc(frame):
+    return len(frame) == LENGTH_HEADER_SIZE + frame[0] + CC11XX_CRC_SIZE
+
+
+def reject_bad_crc(frames, bit_flips, failures, max_flips=0):
+    # Frames that end with the CC11xx CRC are checked all at once, and those
+    # failing it are dropped before any parsing unless they can be recovered
+    # from at most max_flips bit errors. bit_flips goes along with frames
+    # and gets the count of the recovered ones. Binary frames arrive without
+    # the CRC, the framer has checked them. Recovered frames are counted in
+    # failures as ("recovered", flips).
+    checked = [idx for idx, frame in enumerate(frames) if frame and _has_crc(frame)]
+    if not checked:
+        return frames, bit_flips
+    # pylint: disable=import-outside-toplevel
+    from .batch_decoder import pack_frames
+    from .cc11xx import check_crc_frames
+    intact = check_crc_frames(*pack_frames(frames[idx] for idx in checked))
+    if intact.all():
+        return frames, bit_flips
+    failed = [checked[idx] for idx in (~intact).nonzero()[0].tolist()]
+    if max_flips:
+        from .recovery import recover_frames
+        frames = list(frames)
+        bit_flips = list(bit_flips)
+        recovered = recover_frames([frames[idx] for idx in failed], max_flips)
+        for idx, (frame, flips) in zip(failed, recovered):
+            if flips:
+                frames[idx] = frame
+                bit_flips[idx] = flips
+                failures["recovered", flips] += 1
+        failed = [idx for idx in failed if not bit_flips[idx]]
+    rejected = set(failed)
+    failures["crc"] += len(rejected)
+    return ([frame for idx, frame in enumerate(frames) if idx not in rejected],
+            [flips for idx, flips in enumerate(bit_flips) if idx not in rejected])
+
+
+def decode_batch(frames, collect_metrics=False, check_crc=True, max_flips=0):
+    # Workers send their metrics along with each batch. Frames recovered by
+    # the framer arrive as (frame, bit flips).
+    lines = []
+    failures = Counter()
+    parsed = []
+    bit_flips = []
+    for frame in frames:
+        flips = 0
+        if isinstance(frame, tuple):
+            frame, flips = frame
+        if isinstance(frame, str):
+            try:
+                frame = parse_hex(frame)
+            except ValueError:
+                failures["hex"] += 1
+                continue
+        parsed.append(frame)
+        bit_flips.append(flips)
+    if check_crc:
+        parsed, bit_flips = reject_bad_crc(parsed, bit_flips, failures, max_flips)
+    for frame, flips in zip(parsed, bit_flips):
+        stage, line = decode_frame(frame)
+        if stage is None:
+            lines.append(tag_bit_flips(line, flips) if flips else line)
+        else:
+            failures[stage] += 1
+    metrics = None
+    if collect_metrics and METRICS.enabled:
+        metrics = METRICS.snapshot()
+        METRICS.reset()
+    return lines, failures, metrics
+
+
+def _init_worker(metrics, calibration):
+    if metrics:
+        METRICS.reset()
+        METRICS.enable()
+    use_calibration(calibration)
+
+
+def _looks_like_hex(head):
+    return all(byte in _HEX_CHARACTERS for byte in head)
+
+
+def read_frames(stream, input_format, trailer_size, statistics, check_crc=True, max_flips=0):
+    # Yields hex strings or binary frames from a binary stream. Binary frames
+    # failing the CRC are skipped by the framer and counted in statistics,
+    # those it recovers come as (frame, bit flips).
+    head = stream.read(READ_SIZE)
+    if input_format == "auto":
+        input_format = "hex" if _looks_like_hex(head) else "binary"
+    if input_format == "hex":
+        remainder = b""
+        chunk = head
+        while chunk:
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if line:
+                    statistics["bytes_in"] += len(line)
+                    yield line.decode("ascii", "replace")
+            chunk = stream.read(READ_SIZE)
+        if remainder.strip():
+            statistics["bytes_in"] += len(remainder.strip())
+            yield remainder.strip().decode("ascii", "replace")
+    else:
+        framer = RadioPacketFramer(trailer_size=trailer_size,
+                                   check_crc=check_crc and trailer_size == CC11XX_CRC_SIZE,
+                                   max_flips=max_flips)
+        chunk = head
+        while chunk:
+            for packet in framer.feed(chunk):
+                frame = bytes(packet.get_bytes())
+                yield (frame, framer.bit_flips) if framer.bit_flips else frame
+            chunk = stream.read(READ_SIZE)
+        statistics["bytes_in"] += framer.bytes_in
+        statistics["bytes_skipped"] += framer.bytes_skipped + framer.pending()
+        statistics["crc_errors"] += framer.crc_errors
+        for flips, count in framer.recovered.items():
+            statistics["recovered", flips] += count
+
+
+def _batches(frames, size):
+    batch = []
+    for frame in frames:
+        batch.append(frame)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _inputs(paths):
+    if not paths:
+        paths = ["-"]
+    for path in paths:
+        if path == "-":
+            yield path, sys.stdin.buffer
+        else:
+            with open(path, "rb") as stream:
+                yield path, stream
+
+
+def _checked_frame(frame, statistics, max_flips=0):
+    # frame if it has no CC11xx CRC or passes it, (frame, bit flips) when
+    # recovered and None when it fails
+    if not frame or not _has_crc(frame) or crc16(frame) == 0:
+        return frame
+    if max_flips:
+        # pylint: disable=import-outside-toplevel
+        from .recovery import recover_frame
+        recovered, flips = recover_frame(frame, max_flips)
+        if flips:
+            statistics["recovered", flips] += 1
+            return recovered, flips
+    statistics["crc_errors"] += 1
+    return None
+
+
+def _unique_frames(frames, dedup, station, statistics, check_crc=True, max_flips=0):
+    # Hex is parsed here so duplicates never reach the workers, lines that
+    # are not hex are left for them to count. The key leaves the CRC out,
+    # so hex frames are checked first, a corrupted copy arriving before the
+    # good one must not suppress it.
+    for frame in frames:
+        if isinstance(frame, str):
+            try:
+                frame = bytes.fromhex(frame)
+            except ValueError:
+                yield frame
+                continue
+            if check_crc:
+                frame = _checked_frame(frame, statistics, max_flips)
+                if frame is None:
+                    continue
+        if dedup.check(frame[0] if isinstance(frame, tuple) else frame, station):
+            yield frame
+        else:
+            statistics["duplicates"] += 1
+
+
+# pylint: disable=too-many-arguments
+def run(paths, output, input_format="auto", workers=None, trailer_size=CC11XX_CRC_SIZE,
+        batch_size=BATCH_SIZE, dedup=None, check_crc=True, max_flips=0):
+    # With a dedup.DuplicateCache every input is a station and beacons are
+    # decoded once however many of them received it. With check_crc frames
+    # with a CC11xx CRC are only decoded when it matches, or when max_flips
+    # bit flips recover them.
+    statistics = Counter()
+    failures = Counter()
+    start = time.perf_counter()
+
+    def frames():
+        for path, stream in _inputs(paths):
+            station_frames = read_frames(stream, input_format, trailer_size, statistics,
+                                         check_crc, max_flips)
+            if dedup is not None:
+                station_frames = _unique_frames(station_frames, dedup, path, statistics,
+                                                check_crc, max_flips)
+            yield from station_frames
+
+    batches = _batches(frames(), batch_size)
+    pool = None
+    if workers is None or workers > 1:
+        # Imported here, hooks that decode in process don't pay for it
+        import multiprocessing  # pylint: disable=import-outside-toplevel
+        pool = multiprocessing.Pool(workers, _init_worker,
+                                    (METRICS.enabled, active_calibration().profile))
+        results = pool.imap(functools.partial(decode_batch, collect_metrics=True,
+                                              check_crc=check_crc, max_flips=max_flips), batches)
+    else:
+        results = map(functools.partial(decode_batch, check_crc=check_crc, max_flips=max_flips),
+                      batches)
+    try:
+        for lines, batch_failures, metrics in results:
+            text = "".join(lines)
+            output.write(text)
+            if METRICS.enabled:
+                output_stage = METRICS.stage("output")
+                output_stage.calls += len(lines)
+                output_stage.bytes_out += len(text)
+            statistics["packets"] += len(lines)
+            failures.update(batch_failures)
+            if metrics:
+                METRICS.merge(metrics)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    output.flush()
+    failures["crc"] += statistics.pop("crc_errors", 0)
+    for key in [key for key in statistics if isinstance(key, tuple)]:
+        failures[key] += statistics.pop(key)
+    statistics["seconds"] = time.perf_counter() - start
+    return statistics, failures
+
+
+def format_summary(statistics, failures):
+    seconds = statistics["seconds"]
+    rate = statistics["packets"] / seconds if seconds else 0
+    summary = ("decoded %d packets in %.2f s (%.0f packets/s), skipped %d unregistered "
+               "and %d duplicates\n"
+               "failures: %s\n"
+               "bytes read: %d, skipped: %d\n" % (
+                   statistics["packets"], seconds, rate, failures["skipped"],
+                   statistics["duplicates"],
+                   " ".join("%s %d" % (stage, failures[stage]) for stage in FAILURE_STAGES),
+                   statistics["bytes_in"], statistics["bytes_skipped"]))
+    recovered = sorted((key[1], count) for key, count in failures.items()
+                       if isinstance(key, tuple) and key[0] == "recovered")
+    if recovered:
+        summary += "recovered: %s\n" % " ".join("%d with %d bit flips" % (count, flips)
+                                                for flips, count in recovered)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m rhw_telemetry",
+        description="Decode Reaktor Hello World EPS and UHF statistics beacons to NDJSON")
+    parser.add_argument("inputs", nargs="*",
+                        help="files with one hex frame per line or binary demodulator "
+                             "output, - or nothing for stdin")
+    parser.add_argument("--format", choices=("auto", "hex", "binary"), default="auto")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="decoding processes, default one per CPU")
+    parser.add_argument("--trailer-size", type=int, default=CC11XX_CRC_SIZE,
+                        help="bytes after each binary frame, the CC11xx CRC by default")
+    parser.add_argument("--no-crc-check", dest="check_crc", action="store_false",
+                        help="decode frames whatever their CC11xx CRC")
+    parser.add_argument("--recover-flips", dest="max_flips", type=int, default=0,
+                        choices=range(MAX_FLIPS + 1), metavar="FLIPS",
+                        help="recover beacons failing the CRC from up to FLIPS (at most %d) "
+                             "bit errors, tagged with bit_flips" % MAX_FLIPS)
+    parser.add_argument("--dedup", action="store_true",
+                        help="treat every input as a station and decode each beacon once")
+    parser.add_argument("--calibration", metavar="FILE",
+                        help="JSON calibration profile for the ground unit conversions")
+    parser.add_argument("--output", "-o", help="NDJSON output file instead of stdout")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write per stage metrics in Prometheus text format to FILE")
+    parser.add_argument("--quiet", "-q", action="store_true", help="no summary on stderr")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    if args.calibration:
+        use_calibration(load_calibration_profile(args.calibration))
+    if args.metrics:
+        METRICS.enable()
+    dedup = None
+    if args.dedup:
+        from .dedup import DuplicateCache  # pylint: disable=import-outside-toplevel
+        dedup = DuplicateCache()
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        statistics, failures = run(args.inputs, output, args.format, args.workers,
+                                   args.trailer_size, dedup=dedup, check_crc=args.check_crc,
+                                   max_flips=args.max_flips)
+    finally:
+        if args.output:
+            output.close()
+    if not args.quiet:
+        sys.stderr.write(format_summary(statistics, failures))
+    if args.metrics:
+        with open(args.metrics, "w") as metrics_file:
+            metrics_file.write(METRICS.prometheus_text())
+    return 0
+
+
+METRICS.instrument(sys.modules[__name__], "parse_hex", "hex", bytes_in=lambda args: len(args[0]),
+                   bytes_out=len)
+METRICS.instrument(sys.modules[__name__], "format_ndjson_line", "format", bytes_out=len)
@@ -0,0 +1,132 @@
+from collections import Counter, OrderedDict
+import functools
+import hashlib
+import struct
+import time
+
+from .hex_decoder import STATISTICS_DISPATCHER, CSP_HEADER_STRUCT, RADIO_FRAME_CSP_OFFSET, \
+    HEADER_PLUS_LENGTH_SIZE, message_layout
+
+MAX_ENTRIES = 1 << 16
+# Receptions of one beacon by different stations arrive within seconds, a
+# beacon seen again after this long is counted as new
+TTL_S = 15 * 60
+DIGEST_SIZE = 16
+MAX_ALSO_SEEN = 64
+TIMESTAMP_STRUCT = struct.Struct("<I")
+
+
+class BeaconSighting:
+    # Who received a beacon first and who else received it
+    __slots__ = ("first_station", "first_seen", "last_seen", "also_seen", "receptions")
+
+    def __init__(self, station, now):
+        self.first_station = station
+        self.first_seen = now
+        self.last_seen = now
+        self.also_seen = []
+        self.receptions = 1
+
+
+def payload_key(frame, offset=RADIO_FRAME_CSP_OFFSET):
+    # Hash of the CSP packet (header, length and payload) at offset, the same
+    # for every station that received it whatever came around it
+    length = struct.unpack_from(">H", frame, offset + HEADER_PLUS_LENGTH_SIZE - 2)[0]
+    with memoryview(frame) as view:
+        return hashlib.blake2b(view[offset:offset + HEADER_PLUS_LENGTH_SIZE + length],
+                               digest_size=DIGEST_SIZE).digest()
+
+
+@functools.lru_cache(maxsize=None)
+def _timestamp_offset(message_class):
+    for field in message_layout(message_class):
+        if field.path == ("timestamp",):
+            return field.offset
+    return None
+
+
+def timestamp_key(frame, offset=RADIO_FRAME_CSP_OFFSET, dispatcher=STATISTICS_DISPATCHER):
+    # The raw CSP header, length and beacon timestamp of messages that have
+    # one, the payload hash of others
+    header, length = CSP_HEADER_STRUCT.unpack_from(frame, offset)
+    message_class = dispatcher.lookup(header, length)
+    timestamp_offset = None if message_class is None else _timestamp_offset(message_class)
+    if timestamp_offset is None:
+        return payload_key(frame, offset)
+    timestamp = TIMESTAMP_STRUCT.unpack_from(
+        frame, offset + HEADER_PLUS_LENGTH_SIZE + timestamp_offset)[0]
+    return header, length, timestamp
+
+
+class DuplicateCache:
+    # Bounded cache of the beacons seen recently. Entries are kept in least
+    # recently seen order, so both the LRU bound and the TTL evict from the
+    # front. A frame is checked from its raw bytes, so duplicates are dropped
+    # before any decoding.
+    def __init__(self, max_entries=MAX_ENTRIES, ttl_s=TTL_S, key=payload_key, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.key = key
+        self.clock = clock
+        self._entries = OrderedDict()
+        self.unique = 0
+        self.duplicates = 0
+        self.evicted = 0
+        # Per station count of beacons it received first and of the ones
+        # another station had already received
+        self.first_seen = Counter()
+        self.also_seen = Counter()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self, now):
+        entries = self._entries
+        oldest = now - self.ttl_s
+        while entries:
+            sighting = next(iter(entries.values()))
+            if sighting.last_seen > oldest and len(entries) <= self.max_entries:
+                break
+            entries.popitem(last=False)
+            self.evicted += 1
+
+    def check(self, frame, station=None, now=None):
+        # True the first time a beacon is seen, False for duplicates. Frames
+        # that are too short for a key are passed on for the decoder to
+        # reject.
+        if now is None:
+            now = self.clock()
+        try:
+            key = self.key(frame)
+        except (ValueError, struct.error):
+            return True
+        entries = self._entries
+        sighting = entries.get(key)
+        if sighting is not None and now - sighting.last_seen <= self.ttl_s:
+            sighting.last_seen = now
+            sighting.receptions += 1
+            if len(sighting.also_seen) < MAX_ALSO_SEEN:
+                sighting.also_seen.append((station, now))
+            entries.move_to_end(key)
+            self.duplicates += 1
+            self.also_seen[station] += 1
+            return False
+        entries[key] = BeaconSighting(station, now)
+        entries.move_to_end(key)
+        self.unique += 1
+        self.first_seen[station] += 1
+        self._expire(now)
+        return True
+
+    def filter(self, frames, station=None, now=None):
+        check = self.check
+        return [frame for frame in frames if check(frame, station, now)]
+
+    def sighting(self, frame):
+        return self._entries.get(self.key(frame))
+
+    def snapshot(self):
+        return OrderedDict([("entries", len(self._entries)), ("unique", self.unique),
+                            ("duplicates", self.duplicates), ("evicted", self.evicted),
+                            ("first_seen", dict(self.first_seen)),
+                            ("also_seen", dict(self.also_seen))])
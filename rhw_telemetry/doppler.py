@@ -0,0 +1,409 @@
+import argparse
+from collections import namedtuple
+import datetime
+import math
+import sys
+
+import numpy as np
+
+from .fsk_demodulator import FskDemodulator, SAMPLE_RATE
+from .iq_reader import IqRecording, PolyphaseDecimator, parse_iq_format, decimation_factor, \
+    DEFAULT_FORMAT, SAMPLE_FORMATS, FSK_BANDWIDTH_HZ
+
+# WGS84 and EGM-96 constants of the TLE theory, km and seconds
+EARTH_RADIUS_KM = 6378.137
+EARTH_FLATTENING = 1 / 298.257223563
+EARTH_MU = 398600.4418
+EARTH_J2 = 1.08262668e-3
+EARTH_ROTATION_RAD_S = 7.292115e-5
+SPEED_OF_LIGHT_KM_S = 299792.458
+SECONDS_PER_DAY = 86400
+CURVE_STEP_S = 1.0
+KEPLER_ITERATIONS = 8
+# TLE errors and the oscillators of the station and the satellite leave a
+# small residual offset, tracked only within this window around the curve
+RESIDUAL_WINDOW_HZ = 1500
+RESIDUAL_SMOOTHING = 0.5
+# Spacing of the residuals tried until the first frame, about the offset the
+# demodulator still decodes through at low SNR
+RESIDUAL_SEARCH_STEP_HZ = 750
+
+# Mean elements of a two line element set, angles in radians, mean motion
+# in radians per second and its first derivative / 2 in radians per second
+# squared, epoch in Unix seconds
+TleElements = namedtuple("TleElements", ["name", "epoch", "inclination", "raan", "eccentricity",
+                                         "arg_perigee", "mean_anomaly", "mean_motion",
+                                         "mean_motion_dot"])
+# Geodetic station coordinates, degrees and meters above the ellipsoid
+Station = namedtuple("Station", ["latitude", "longitude", "altitude"])
+# Predicted offset every step_s seconds from start (Unix seconds), and the
+# elevation of the satellite in degrees
+DopplerCurve = namedtuple("DopplerCurve", ["start", "step_s", "offsets_hz", "elevations"])
+
+
+def _tle_checksum(line):
+    return sum(int(char) if char.isdigit() else char == "-" for char in line[:68]) % 10
+
+
+def _tle_epoch(field):
+    # Two digit year, 57-99 is 1900s, and the fractional day of the year
+    year = int(field[:2])
+    year += 1900 if year >= 57 else 2000
+    start = datetime.datetime(year, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+    return start + (float(field[2:]) - 1) * SECONDS_PER_DAY
+
+
+def parse_tle(line1, line2, name=None):
+    line1 = line1.rstrip()
+    line2 = line2.rstrip()
+    if not (line1.startswith("1 ") and line2.startswith("2 ")) or \
+            len(line1) < 69 or len(line2) < 69:
+        raise ValueError("Not a two line element set")
+    for line in (line1, line2):
+        if int(line[68]) != _tle_checksum(line):
+            raise ValueError("TLE checksum mismatch: %s" % line)
+    revolution_s = 2 * math.pi / SECONDS_PER_DAY
+    return TleElements(
+        name=name,
+        epoch=_tle_epoch(line1[18:32]),
+        inclination=math.radians(float(line2[8:16])),
+        raan=math.radians(float(line2[17:25])),
+        eccentricity=float("0." + line2[26:33].strip()),
+        arg_perigee=math.radians(float(line2[34:42])),
+        mean_anomaly=math.radians(float(line2[43:51])),
+        mean_motion=float(line2[52:63]) * revolution_s,
+        mean_motion_dot=float(line1[33:43]) * revolution_s / SECONDS_PER_DAY)
+
+
+def load_tle(path, name=None):
+    # The element set of name from a file of two or three line sets, the
+    # first one when name is None
+    with open(path) as tle_file:
+        lines = [line.rstrip() for line in tle_file if line.strip()]
+    for idx, line in enumerate(lines[:-1]):
+        if line.startswith("1 ") and lines[idx + 1].startswith("2 "):
+            title = lines[idx - 1].strip() if idx and not lines[idx - 1][:2] in ("1 ", "2 ") \
+                else None
+            if title and title.startswith("0 "):
+                title = title[2:]
+            if name is None or title == name or line[2:7].strip() == str(name):
+                return parse_tle(line, lines[idx + 1], title)
+    raise ValueError("No element set for %s in %s" % (name or "any satellite", path))
+
+
+class KeplerOrbit:
+    # Two body propagation of TLE mean elements with the secular J2 drift of
+    # the node, perigee and mean anomaly and the TLE mean motion derivative
+    # for drag. Simpler than SGP4, its error of some kilometres after a few
+    # days is what the residual tracking around the Doppler curve absorbs.
+    def __init__(self, elements):
+        self.elements = elements
+        cos_i = math.cos(elements.inclination)
+        ecc = elements.eccentricity
+        beta = math.sqrt(1 - ecc ** 2)
+        # TLE mean motion to the Brouwer mean motion and semi-major axis
+        a_1 = (EARTH_MU / elements.mean_motion ** 2) ** (1 / 3)
+        delta = 1.5 * EARTH_J2 * (EARTH_RADIUS_KM / a_1) ** 2 * (3 * cos_i ** 2 - 1) / beta ** 3
+        a_0 = a_1 * (1 - delta / 3 - delta ** 2 - 134 / 81 * delta ** 3)
+        delta *= (a_1 / a_0) ** 2
+        self.mean_motion = elements.mean_motion / (1 + delta)
+        self.semi_major_axis = a_0 / (1 - delta)
+        j2_term = EARTH_J2 * (EARTH_RADIUS_KM / (self.semi_major_axis * beta ** 2)) ** 2
+        self.raan_rate = -1.5 * self.mean_motion * j2_term * cos_i
+        self.perigee_rate = 0.75 * self.mean_motion * j2_term * (5 * cos_i ** 2 - 1)
+        self.anomaly_rate = self.mean_motion * (1 + 0.75 * j2_term * beta * (3 * cos_i ** 2 - 1))
+
+    def teme(self, times):
+        # Position (km) and velocity (km/s) in the TEME frame at Unix times,
+        # arrays of shape (len(times), 3)
+        elements = self.elements
+        ecc = elements.eccentricity
+        elapsed = np.asarray(times, dtype=np.float64) - elements.epoch
+        mean_anomaly = (elements.mean_anomaly + self.anomaly_rate * elapsed +
+                        elements.mean_motion_dot * elapsed ** 2)
+        raan = elements.raan + self.raan_rate * elapsed
+        perigee = elements.arg_perigee + self.perigee_rate * elapsed
+        eccentric = mean_anomaly.copy()
+        for _ in range(KEPLER_ITERATIONS):
+            eccentric -= ((eccentric - ecc * np.sin(eccentric) - mean_anomaly) /
+                          (1 - ecc * np.cos(eccentric)))
+        # The semi-major axis shrinks with the mean motion derivative
+        motion = self.mean_motion + 2 * elements.mean_motion_dot * elapsed
+        semi_major = self.semi_major_axis * (self.mean_motion / motion) ** (2 / 3)
+        anomaly_rate = motion * self.anomaly_rate / self.mean_motion
+        beta = math.sqrt(1 - ecc ** 2)
+        cos_e = np.cos(eccentric)
+        sin_e = np.sin(eccentric)
+        # Perifocal coordinates
+        p_x = semi_major * (cos_e - ecc)
+        p_y = semi_major * beta * sin_e
+        v_x = -semi_major * anomaly_rate * sin_e / (1 - ecc * cos_e)
+        v_y = semi_major * anomaly_rate * beta * cos_e / (1 - ecc * cos_e)
+        cos_o, sin_o = np.cos(raan), np.sin(raan)
+        cos_w, sin_w = np.cos(perigee), np.sin(perigee)
+        cos_i, sin_i = math.cos(elements.inclination), math.sin(elements.inclination)
+        # Columns of the perifocal to TEME rotation
+        p_axis = np.stack((cos_o * cos_w - sin_o * sin_w * cos_i,
+                           sin_o * cos_w + cos_o * sin_w * cos_i, sin_w * sin_i), axis=-1)
+        q_axis = np.stack((-cos_o * sin_w - sin_o * cos_w * cos_i,
+                           -sin_o * sin_w + cos_o * cos_w * cos_i, cos_w * sin_i), axis=-1)
+        position = p_x[:, None] * p_axis + p_y[:, None] * q_axis
+        velocity = v_x[:, None] * p_axis + v_y[:, None] * q_axis
+        # Perigee turning in the orbit plane and the plane turning around z
+        normal = np.stack((sin_o * sin_i, -cos_o * sin_i, np.full_like(raan, cos_i)), axis=-1)
+        velocity += self.perigee_rate * np.cross(normal, position)
+        velocity += self.raan_rate * np.cross((0.0, 0.0, 1.0), position)
+        return position, velocity
+
+
+def gmst(times):
+    # Greenwich mean sidereal angle (IAU 1982) at Unix times, UT1 taken as UTC
+    centuries = ((np.asarray(times, dtype=np.float64) / SECONDS_PER_DAY + 2440587.5 - 2451545.0)
+                 / 36525)
+    seconds = (67310.54841 + (876600 * 3600 + 8640184.812866) * centuries +
+               0.093104 * centuries ** 2 - 6.2e-6 * centuries ** 3)
+    return np.radians((seconds % SECONDS_PER_DAY) / 240)
+
+
+def teme_to_ecef(times, position, velocity):
+    # Earth fixed position and velocity, polar motion ignored
+    angle = gmst(times)
+    cos_a, sin_a = np.cos(angle), np.sin(angle)
+    x_ecef = cos_a * position[:, 0] + sin_a * position[:, 1]
+    y_ecef = -sin_a * position[:, 0] + cos_a * position[:, 1]
+    ecef = np.stack((x_ecef, y_ecef, position[:, 2]), axis=-1)
+    v_ecef = np.stack((cos_a * velocity[:, 0] + sin_a * velocity[:, 1] +
+                       EARTH_ROTATION_RAD_S * y_ecef,
+                       -sin_a * velocity[:, 0] + cos_a * velocity[:, 1] -
+                       EARTH_ROTATION_RAD_S * x_ecef,
+                       velocity[:, 2]), axis=-1)
+    return ecef, v_ecef
+
+
+def station_ecef(station):
+    # Position (km) and the local up unit vector of a station
+    lat = math.radians(station.latitude)
+    lon = math.radians(station.longitude)
+    ecc2 = EARTH_FLATTENING * (2 - EARTH_FLATTENING)
+    normal = EARTH_RADIUS_KM / math.sqrt(1 - ecc2 * math.sin(lat) ** 2)
+    height = station.altitude / 1000
+    position = np.array([(normal + height) * math.cos(lat) * math.cos(lon),
+                         (normal + height) * math.cos(lat) * math.sin(lon),
+                         (normal * (1 - ecc2) + height) * math.sin(lat)])
+    up = np.array([math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat)])
+    return position, up
+
+
+def doppler_curve(elements, station, start, duration_s, carrier_hz, step_s=CURVE_STEP_S):
+    # Predicted offset of a carrier_hz downlink received at station, from
+    # start (Unix seconds) for duration_s, one point every step_s
+    times = start + np.arange(int(math.ceil(duration_s / step_s)) + 2) * step_s
+    position, velocity = teme_to_ecef(times, *KeplerOrbit(elements).teme(times))
+    site, up = station_ecef(station)
+    line_of_sight = position - site
+    distance = np.linalg.norm(line_of_sight, axis=1)
+    range_rate = np.einsum("ij,ij->i", line_of_sight, velocity) / distance
+    elevations = np.degrees(np.arcsin(line_of_sight @ up / distance))
+    return DopplerCurve(float(start), float(step_s), -carrier_hz * range_rate / SPEED_OF_LIGHT_KM_S,
+                        elevations)
+
+
+def curve_phase(curve, sample_index, sample_rate=SAMPLE_RATE):
+    # Phase of an NCO following the curve at absolute sample indices, the
+    # exact integral of the offset interpolated linearly between points, so
+    # chunks can be derotated independently and still join up
+    offsets = curve.offsets_hz
+    slopes = np.diff(offsets) / curve.step_s
+    cycles = np.concatenate(([0.0], np.cumsum((offsets[:-1] + offsets[1:]) / 2 * curve.step_s)))
+    elapsed = np.asarray(sample_index, dtype=np.float64) / sample_rate
+    point = np.clip((elapsed // curve.step_s).astype(np.int64), 0, len(slopes) - 1)
+    since = elapsed - point * curve.step_s
+    cycles_now = cycles[point] + offsets[point] * since + slopes[point] * since ** 2 / 2
+    return 2 * np.pi * (cycles_now % 1)
+
+
+class DopplerCorrector:
+    # Continuous phase NCO removing the predicted Doppler curve from a
+    # recording that starts at the curve start, fed in chunks of any size
+    # with process(). What is left, the residual, is measured by the
+    # demodulator on the sync word of every frame and fed back with track(),
+    # limited to residual_window_hz around the curve so a false measurement
+    # cannot pull the correction away. first_sample lets a worker start in
+    # the middle of the recording.
+    def __init__(self, curve, sample_rate=SAMPLE_RATE, first_sample=0,
+                 residual_window_hz=RESIDUAL_WINDOW_HZ):
+        self.curve = curve
+        self.sample_rate = sample_rate
+        self.sample_index = first_sample
+        self.residual_window_hz = residual_window_hz
+        self.residual_hz = 0.0
+        self._residual_phase = 0.0
+
+    def offset_hz(self, sample_index=None):
+        # Total correction at a sample, the curve and the residual
+        index = self.sample_index if sample_index is None else sample_index
+        elapsed = index / self.sample_rate
+        return float(np.interp(elapsed, np.arange(len(self.curve.offsets_hz)) * self.curve.step_s,
+                               self.curve.offsets_hz)) + self.residual_hz
+
+    def lock(self, residual_hz):
+        # Continues with the residual of an NCO started at sample 0, as used
+        # by the acquisition search
+        self.residual_hz = residual_hz
+        self._residual_phase = float(2 * np.pi * residual_hz * self.sample_index /
+                                     self.sample_rate % (2 * np.pi))
+
+    def track(self, measured_hz):
+        # measured_hz is the offset still left in the corrected samples
+        residual = self.residual_hz + RESIDUAL_SMOOTHING * measured_hz
+        self.residual_hz = min(max(residual, -self.residual_window_hz), self.residual_window_hz)
+
+    def process(self, samples):
+        samples = np.asarray(samples, dtype=np.complex64)
+        indices = self.sample_index + np.arange(len(samples))
+        self.sample_index += len(samples)
+        if not len(samples):
+            return samples
+        corrected = samples * np.exp(-1j * curve_phase(self.curve, indices,
+                                                       self.sample_rate)).astype(np.complex64)
+        if self.residual_hz:
+            step = 2 * np.pi * self.residual_hz / self.sample_rate
+            phase = self._residual_phase + step * np.arange(len(samples))
+            self._residual_phase = float((phase[-1] + step) % (2 * np.pi))
+            corrected *= np.exp(-1j * phase).astype(np.complex64)
+        return corrected
+
+
+def residual_candidates(window_hz, step_hz=RESIDUAL_SEARCH_STEP_HZ):
+    # Zero first, then outwards to the edges of the window
+    count = int(window_hz // step_hz) if window_hz else 0
+    return [0.0] + [sign * idx * step_hz for idx in range(1, count + 1) for sign in (1, -1)]
+
+
+class PassDemodulator:
+    # FskDemodulator for a pass, derotating every chunk with corrector first.
+    # Until the first frame each candidate residual in the window gets a
+    # demodulator of its own; the first one to find a frame carries on
+    # alone, and the offset measured on its frames is fed back to the
+    # corrector once per chunk.
+    def __init__(self, corrector, **kwargs):
+        self.corrector = corrector
+        self._candidates = residual_candidates(corrector.residual_window_hz)
+        self._demodulators = [FskDemodulator(sample_rate=corrector.sample_rate, **kwargs)
+                              for _ in self._candidates]
+        self._dropped_crc_errors = 0
+
+    @property
+    def crc_errors(self):
+        return self._dropped_crc_errors + sum(demodulator.crc_errors
+                                              for demodulator in self._demodulators)
+
+    def process(self, samples):
+        corrector = self.corrector
+        corrected = corrector.process(samples)
+        if len(self._demodulators) == 1:
+            frames = self._demodulators[0].process(corrected)
+        else:
+            frames = []
+            indices = corrector.sample_index - len(corrected) + np.arange(len(corrected))
+            for candidate, demodulator in zip(self._candidates, self._demodulators):
+                nco = np.exp(-2j * np.pi * candidate / corrector.sample_rate * indices)
+                frames = demodulator.process(corrected * nco.astype(np.complex64))
+                if frames:
+                    corrector.lock(candidate)
+                    self._dropped_crc_errors = self.crc_errors - demodulator.crc_errors
+                    self._demodulators = [demodulator]
+                    break
+        if corrector.residual_window_hz and frames:
+            # The frames of a chunk were all measured against the same
+            # correction, their mean is fed back once
+            corrector.track(float(np.mean([frame.frequency_offset_hz for frame in frames])))
+        return frames
+
+
+def parse_time(text):
+    # Unix seconds or ISO 8601, UTC unless a zone is given
+    try:
+        return float(text)
+    except ValueError:
+        moment = datetime.datetime.fromisoformat(text.replace("Z", "+00:00"))
+        if moment.tzinfo is None:
+            moment = moment.replace(tzinfo=datetime.timezone.utc)
+        return moment.timestamp()
+
+
+def parse_station(text):
+    values = [float(value) for value in text.split(",")]
+    if len(values) not in (2, 3):
+        raise ValueError("Station is LATITUDE,LONGITUDE[,ALTITUDE_M]")
+    return Station(values[0], values[1], values[2] if len(values) == 3 else 0.0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Predict the Doppler curve of a pass from a local TLE and remove it from "
+                    "a raw IQ recording")
+    parser.add_argument("--tle", required=True, help="file with two or three line elements")
+    parser.add_argument("--satellite", help="name or catalog number in the TLE file")
+    parser.add_argument("--station", required=True, type=parse_station,
+                        metavar="LAT,LON[,ALT_M]")
+    parser.add_argument("--start", required=True, type=parse_time,
+                        help="time of the first sample, Unix seconds or ISO 8601 UTC")
+    parser.add_argument("--frequency", required=True, type=float,
+                        help="downlink frequency the recording was tuned to, Hz")
+    parser.add_argument("--duration", type=float, default=900,
+                        help="seconds of curve to print without a recording")
+    parser.add_argument("--format", type=parse_iq_format, default=DEFAULT_FORMAT,
+                        metavar="FORMAT[:RATE]",
+                        help="sample format (%s) and rate of the recording, default cf32:%d" %
+                        (", ".join(SAMPLE_FORMATS), SAMPLE_RATE))
+    parser.add_argument("--decimation", default="auto",
+                        help="decimation factor before the correction, or auto for the largest "
+                             "that keeps the signal and the Doppler shift")
+    parser.add_argument("--residual-window", type=float, default=RESIDUAL_WINDOW_HZ,
+                        help="Hz of residual offset tracked around the curve, 0 for none")
+    parser.add_argument("--recording", help="recording to correct")
+    parser.add_argument("--output", "-o",
+                        help="corrected complex64 recording, stdout by default")
+    parser.add_argument("--decode", action="store_true",
+                        help="demodulate the corrected recording, one hex frame per line")
+    args = parser.parse_args(argv)
+
+    elements = load_tle(args.tle, args.satellite)
+    if not args.recording:
+        curve = doppler_curve(elements, args.station, args.start, args.duration, args.frequency)
+        sys.stdout.write("time_s,elevation_deg,offset_hz\n")
+        for idx, (elevation, offset) in enumerate(zip(curve.elevations, curve.offsets_hz)):
+            sys.stdout.write("%.1f,%.2f,%.1f\n" % (idx * curve.step_s, elevation, offset))
+        return 0
+    recording = IqRecording(args.recording, args.format)
+    curve = doppler_curve(elements, args.station, args.start, recording.duration_s,
+                          args.frequency)
+    if args.decimation == "auto":
+        shift = float(np.max(np.abs(curve.offsets_hz))) + args.residual_window
+        decimation = decimation_factor(recording.sample_rate, FSK_BANDWIDTH_HZ + shift)
+    else:
+        decimation = int(args.decimation)
+    decimator = PolyphaseDecimator(decimation) if decimation > 1 else None
+    chunks = (decimator.process(chunk) if decimator else chunk for chunk in recording.chunks())
+    corrector = DopplerCorrector(curve, recording.sample_rate / decimation,
+                                 residual_window_hz=args.residual_window)
+    if args.decode:
+        demodulator = PassDemodulator(corrector)
+        for chunk in chunks:
+            for frame in demodulator.process(chunk):
+                sys.stdout.write(frame.data.hex() + "\n")
+        return 0
+    # Without demodulation there is nothing to measure the residual on
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in chunks:
+            output.write(corrector.process(chunk).tobytes())
+    finally:
+        if args.output:
+            output.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
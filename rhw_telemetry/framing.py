@@ -0,0 +1,148 @@
+from collections import Counter
+import logging
+import struct
+
+from .cc11xx import crc16, CRC16_SIZE
+from .hex_decoder import HWRadioPacket, CspPacket, RadioPacketType, LENGTH_HEADER_SIZE, \
+    HEADER_PLUS_LENGTH_SIZE
+from .instrumentation import METRICS
+
+CC11XX_CRC_SIZE = CRC16_SIZE
+CSP_MAX_PAYLOAD_SIZE = 256
+
+# Framed bytes and frames, malformed frames as errors and skipped bytes
+_FRAMING = METRICS.stage("framing")
+
+
+class StreamFramer:
+    # Incremental framer for byte streams that arrive in arbitrary chunks.
+    # Subclasses define the header size, the frame size implied by a header
+    # (None when the header is implausible) and how a frame is parsed. On
+    # garbage the framer moves one byte forward and tries again, counting the
+    # skipped bytes. At most one incomplete frame is kept between chunks.
+    header_size = 1
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._start = 0
+        self.bytes_in = 0
+        self.bytes_skipped = 0
+        self.frames = 0
+        self.malformed = 0
+        # Malformed frames that failed a link layer CRC
+        self.crc_errors = 0
+
+    def _frame_size(self, view, idx):
+        raise NotImplementedError()
+
+    def _parse(self, frame):
+        raise NotImplementedError()
+
+    # Buffers chunk and returns an iterator over the packets completed by it,
+    # which should be consumed before the next chunk is fed
+    def feed(self, chunk):
+        if self._start:
+            del self._buffer[:self._start]
+            self._start = 0
+        self._buffer += chunk
+        self.bytes_in += len(chunk)
+        if METRICS.enabled:
+            _FRAMING.bytes_in += len(chunk)
+        return iter(self._next_packet, None)
+
+    def pending(self):
+        return len(self._buffer) - self._start
+
+    def _next_packet(self):
+        with memoryview(self._buffer) as view:
+            idx = self._start
+            end = len(view)
+            while end - idx >= self.header_size:
+                frame_size = self._frame_size(view, idx)
+                if frame_size is not None:
+                    if end - idx < frame_size:
+                        break
+                    try:
+                        packet = self._parse(bytes(view[idx:idx + frame_size]))
+                    except ValueError:
+                        logging.debug("Skipping malformed frame at stream offset %d",
+                                      self.bytes_in - end + idx)
+                        self.malformed += 1
+                        if METRICS.enabled:
+                            _FRAMING.errors += 1
+                    else:
+                        self.frames += 1
+                        self._start = idx + frame_size
+                        if METRICS.enabled:
+                            _FRAMING.calls += 1
+                            _FRAMING.bytes_out += frame_size
+                        return packet
+                self.bytes_skipped += 1
+                if METRICS.enabled:
+                    _FRAMING.skipped += 1
+                idx += 1
+            self._start = idx
+        return None
+
+
+class RadioPacketFramer(StreamFramer):
+    # Frames HWRadioPacket from demodulator output: a length byte, the packet
+    # type and the payload, optionally followed by trailer_size bytes such as
+    # the CC11xx CRC which are kept out of the packet. With check_crc the
+    # trailer is the CRC and frames failing it are skipped as malformed, so
+    # a corrupted frame never reaches the packet parser. With max_flips they
+    # are first recovered from up to that many bit errors when possible;
+    # bit_flips is the count of the last packet returned.
+    header_size = LENGTH_HEADER_SIZE + 1
+
+    def __init__(self, with_signature=False, trailer_size=0, check_crc=False, max_flips=0):
+        super().__init__()
+        if check_crc and trailer_size != CC11XX_CRC_SIZE:
+            raise ValueError("Checking the CRC needs a %d byte trailer" % CC11XX_CRC_SIZE)
+        self.with_signature = with_signature
+        self.trailer_size = trailer_size
+        self.check_crc = check_crc
+        self.max_flips = max_flips if check_crc else 0
+        self.bit_flips = 0
+        # Recovered frames by the number of flips
+        self.recovered = Counter()
+
+    def _frame_size(self, view, idx):
+        packet_len = view[idx]
+        if packet_len < 1 or view[idx + 1] not in RadioPacketType.TYPES:
+            return None
+        return LENGTH_HEADER_SIZE + packet_len + self.trailer_size
+
+    def _parse(self, frame):
+        self.bit_flips = 0
+        if self.check_crc and crc16(frame) != 0:
+            if self.max_flips:
+                # pylint: disable=import-outside-toplevel
+                from .recovery import recover_frame
+                frame, self.bit_flips = recover_frame(frame, self.max_flips)
+            if not self.bit_flips:
+                self.crc_errors += 1
+                raise ValueError("CRC mismatch")
+            self.recovered[self.bit_flips] += 1
+        if self.trailer_size:
+            frame = frame[:-self.trailer_size]
+        return HWRadioPacket.from_bytes(frame, self.with_signature)
+
+
+class CspPacketFramer(StreamFramer):
+    # Frames CspPacket with the 16 bit length field. CSP headers carry no
+    # sync pattern, so a length above max_payload_size is what marks garbage.
+    header_size = HEADER_PLUS_LENGTH_SIZE
+
+    def __init__(self, max_payload_size=CSP_MAX_PAYLOAD_SIZE):
+        super().__init__()
+        self.max_payload_size = max_payload_size
+
+    def _frame_size(self, view, idx):
+        length = struct.unpack_from(">H", view, idx + HEADER_PLUS_LENGTH_SIZE - 2)[0]
+        if length > self.max_payload_size:
+            return None
+        return HEADER_PLUS_LENGTH_SIZE + length
+
+    def _parse(self, frame):
+        return CspPacket.from_bytes(frame)
@@ -0,0 +1,265 @@
+from collections import Counter, namedtuple
+
+import numpy as np
+
+from .cc11xx import dewhiten, crc16
+
+# Parameters of gfsk-cc11xx-receiver-test.grc
+SAMPLE_RATE = 96000
+SYMBOL_RATE = 9600
+DEVIATION_HZ = 6000
+CHANNEL_CUTOFF_HZ = 7000
+CHANNEL_FILTER_TAPS = 63
+# CC11xx 32 bit sync word, sync1 and sync2 sent twice
+SYNC_WORD = 0x352E352E
+SYNC_WORD_BITS = 32
+SYNC_THRESHOLD = 0.8
+MIN_SYNC_VARIANCE = 1e-3
+# Clock recovery may not move the symbol rate further than this
+OMEGA_RELATIVE_LIMIT = 0.014
+# Length byte, type byte and the trailing CRC16
+MIN_FRAME_SIZE = 4
+CRC_SIZE = 2
+
+# data starts with the length byte and ends with the CRC, the same bytes the
+# gr-cc11xx deframer prints. sample_index is the input sample of the first
+# sync word bit.
+# bit_flips is the number of bits recovery flipped to pass the CRC and
+# frequency_offset_hz the carrier offset measured on the frame's sync word
+DemodulatedFrame = namedtuple("DemodulatedFrame", ["sample_index", "data", "bit_flips",
+                                                   "frequency_offset_hz"],
+                              defaults=(0, None))
+
+
+def low_pass_taps(sample_rate, cutoff_hz, num_taps):
+    time = np.arange(num_taps) - (num_taps - 1) / 2
+    taps = np.sinc(2 * cutoff_hz / sample_rate * time) * np.hamming(num_taps)
+    return (taps / taps.sum()).astype(np.float32)
+
+
+def _next_pow2(value):
+    return 1 << max(0, int(value - 1).bit_length())
+
+
+def fft_correlate(signal, template, template_spectra=None):
+    # Valid part of the cross correlation of signal with template
+    nfft = _next_pow2(len(signal) + len(template) - 1)
+    if template_spectra is not None:
+        spectrum = template_spectra.get(nfft)
+        if spectrum is None:
+            spectrum = template_spectra[nfft] = np.fft.rfft(template[::-1], nfft)
+    else:
+        spectrum = np.fft.rfft(template[::-1], nfft)
+    result = np.fft.irfft(np.fft.rfft(signal, nfft) * spectrum, nfft)
+    return result[len(template) - 1:len(signal)]
+
+
+class _Incomplete(Exception):
+    pass
+
+
+class FskDemodulator:
+    # Streaming 2-FSK demodulator for the CC11xx framed beacons. Feed complex
+    # baseband chunks of any size to process(), which returns the frames that
+    # became complete. Only the samples of a possibly unfinished frame are
+    # kept between calls. Frames failing the CRC check are dropped like the
+    # CC11xx does, unless check_crc is off or recovery from up to max_flips
+    # bit errors finds the beacon that was sent.
+    # pylint: disable=too-many-instance-attributes
+    # pylint: disable=too-many-arguments
+    def __init__(self, sample_rate=SAMPLE_RATE, symbol_rate=SYMBOL_RATE,
+                 sync_word=SYNC_WORD, sync_word_bits=SYNC_WORD_BITS,
+                 threshold=SYNC_THRESHOLD, channel_cutoff_hz=CHANNEL_CUTOFF_HZ, check_crc=True,
+                 max_flips=0):
+        self.sample_rate = sample_rate
+        self.samples_per_symbol = sample_rate / symbol_rate
+        self.threshold = threshold
+        self.check_crc = check_crc
+        self.max_flips = max_flips if check_crc else 0
+
+        self._taps = None
+        if channel_cutoff_hz:
+            self._taps = low_pass_taps(sample_rate, channel_cutoff_hz, CHANNEL_FILTER_TAPS)
+            self._filter_state = np.zeros(len(self._taps) - 1, dtype=np.complex64)
+        self._last_sample = np.complex64(0)
+        self._matched_taps = np.full(int(round(self.samples_per_symbol)),
+                                     1 / round(self.samples_per_symbol), dtype=np.float32)
+        self._matched_state = np.zeros(len(self._matched_taps) - 1, dtype=np.float32)
+
+        sync_bits = np.array([(sync_word >> (sync_word_bits - 1 - bit)) & 1
+                              for bit in range(sync_word_bits)])
+        self._sync_bits = sync_word_bits
+        self._sync_offsets = np.round(np.arange(sync_word_bits) *
+                                      self.samples_per_symbol).astype(np.int64)
+        template_len = self._sync_offsets[-1] + 1
+        self._sync_template = np.zeros(template_len)
+        self._sync_template[self._sync_offsets] = 2.0 * sync_bits - 1
+        self._sync_mask = np.zeros(template_len)
+        self._sync_mask[self._sync_offsets] = 1.0
+        self._spectra = ({}, {})
+
+        # Matched filter output and the absolute sample index of its start
+        self._history = np.zeros(0, dtype=np.float32)
+        self._history_start = 0
+        self._search_from = 0
+        self.samples_in = 0
+        self.sync_detections = 0
+        self.crc_errors = 0
+        # Recovered frames by the number of flips
+        self.recovered = Counter()
+        # Carrier offset measured on the sync word of the last frame, Hz
+        self.frequency_offset_hz = None
+
+    @property
+    def group_delay(self):
+        # Samples the channel and matched filters and the discriminator,
+        # which compares each sample to the one before it, delay the
+        # frame positions by
+        channel = (len(self._taps) - 1) / 2 if self._taps is not None else 0
+        return channel + 0.5 + (len(self._matched_taps) - 1) / 2
+
+    def _discriminate(self, samples):
+        if self._taps is not None:
+            padded = np.concatenate((self._filter_state, samples))
+            self._filter_state = padded[len(padded) - len(self._filter_state):]
+            samples = np.convolve(padded, self._taps, "valid")
+        previous = np.concatenate(([self._last_sample], samples[:-1]))
+        self._last_sample = samples[-1]
+        frequency = np.angle(samples * np.conj(previous)).astype(np.float32)
+        padded = np.concatenate((self._matched_state, frequency))
+        self._matched_state = padded[len(padded) - len(self._matched_state):]
+        return np.convolve(padded, self._matched_taps, "valid")
+
+    def _sync_correlation(self, soft):
+        # Normalized correlation against the +-1 sync pattern. The sync word
+        # has as many ones as zeros, so a frequency offset only shows up in
+        # the variance term.
+        numerator = fft_correlate(soft, self._sync_template, self._spectra[0])
+        total = fft_correlate(soft, self._sync_mask, self._spectra[1])
+        squares = fft_correlate(soft.astype(np.float64) ** 2, self._sync_mask, self._spectra[1])
+        # The floor keeps FFT rounding noise over silence from correlating
+        variance = np.maximum(squares - total ** 2 / self._sync_bits, MIN_SYNC_VARIANCE)
+        return numerator / np.sqrt(self._sync_bits * variance)
+
+    def _recover_clock(self, soft, start, level, num_symbols):
+        # Least squares fit of the zero crossings to symbol boundaries gives
+        # the symbol timing and rate over the whole frame
+        sps = self.samples_per_symbol
+        first = max(int(start - sps), 0)
+        last = min(int(start + num_symbols * sps), len(soft))
+        centered = soft[first:last] - level
+        idx = np.nonzero(np.signbit(centered[:-1]) != np.signbit(centered[1:]))[0]
+        if len(idx) < 2:
+            return float(start), sps
+        fraction = centered[idx] / (centered[idx] - centered[idx + 1])
+        crossings = first + idx + fraction
+        boundaries = np.round((crossings - start) / sps + 0.5)
+        if np.ptp(boundaries) == 0:
+            return float(start), sps
+        rate, intercept = np.polyfit(boundaries, crossings, 1)
+        rate = np.clip(rate, sps * (1 - OMEGA_RELATIVE_LIMIT), sps * (1 + OMEGA_RELATIVE_LIMIT))
+        offset = np.mean(crossings - boundaries * rate)
+        return offset + rate / 2, rate
+
+    def _slice_bytes(self, soft, first_center, rate, level, first_bit, num_bytes):
+        positions = first_center + (first_bit + np.arange(8 * num_bytes)) * rate
+        if positions[-1] >= len(soft) - 1:
+            raise _Incomplete()
+        bits = np.interp(positions, np.arange(len(soft)), soft) > level
+        return np.packbits(bits).tobytes()
+
+    def _decode_at(self, soft, start):
+        sps = self.samples_per_symbol
+        sync_positions = start + self._sync_offsets
+        level = float(np.mean(soft[sync_positions]))
+        center, rate = self._recover_clock(soft, start, level, self._sync_bits)
+        length = dewhiten(self._slice_bytes(soft, center, rate, level, self._sync_bits, 1))[0]
+        frame_size = 1 + length + CRC_SIZE
+        if frame_size < MIN_FRAME_SIZE:
+            return None, int(self._sync_bits * sps), 0
+        num_symbols = self._sync_bits + 8 * frame_size
+        if start + num_symbols * sps * (1 + OMEGA_RELATIVE_LIMIT) + sps >= len(soft):
+            raise _Incomplete()
+        center, rate = self._recover_clock(soft, start, level, num_symbols)
+        whitened = self._slice_bytes(soft, center, rate, level, self._sync_bits, frame_size)
+        data = dewhiten(whitened)
+        bit_flips = 0
+        if self.check_crc and crc16(data) != 0:
+            if self.max_flips:
+                # pylint: disable=import-outside-toplevel
+                from .recovery import recover_frame
+                data, bit_flips = recover_frame(data, self.max_flips)
+            if not bit_flips:
+                # Likely a false sync, look for another one inside it
+                self.crc_errors += 1
+                return None, int(self._sync_bits * sps), 0
+            self.recovered[bit_flips] += 1
+        # The balanced sync word averages to the carrier offset in radians
+        # per sample
+        self.frequency_offset_hz = level * self.sample_rate / (2 * np.pi)
+        return data, int(num_symbols * rate), bit_flips
+
+    @staticmethod
+    def _peaks(correlation, threshold):
+        above = correlation > threshold
+        if not above.any():
+            return []
+        edges = np.diff(above.astype(np.int8), prepend=0, append=0)
+        starts = np.nonzero(edges == 1)[0]
+        ends = np.nonzero(edges == -1)[0]
+        return [(run_start + int(np.argmax(correlation[run_start:run_end])), run_end)
+                for run_start, run_end in zip(starts, ends)]
+
+    def process(self, samples):
+        samples = np.asarray(samples, dtype=np.complex64)
+        if len(samples) == 0:
+            return []
+        self.samples_in += len(samples)
+        self._history = np.concatenate((self._history, self._discriminate(samples)))
+        return self._scan()
+
+    def _scan(self):
+        soft = self._history
+        base = self._history_start
+        template_len = len(self._sync_template)
+        lo = self._search_from - base
+        hi = len(soft) - template_len + 1
+        frames = []
+        if hi > lo:
+            correlation = self._sync_correlation(soft[lo:hi + template_len - 1])
+            next_search = hi
+            skip_until = lo
+            for peak, run_end in self._peaks(correlation, self.threshold):
+                start = lo + peak
+                if start < skip_until:
+                    continue
+                if lo + run_end >= hi:
+                    # The correlation may still grow in the next chunk
+                    next_search = start
+                    break
+                self.sync_detections += 1
+                try:
+                    data, num_samples, bit_flips = self._decode_at(soft, start)
+                except _Incomplete:
+                    next_search = start
+                    break
+                if data is not None:
+                    frames.append(DemodulatedFrame(base + start, data, bit_flips,
+                                                   self.frequency_offset_hz))
+                skip_until = start + num_samples
+            self._search_from = base + max(next_search, skip_until)
+        keep_from = self._search_from - base
+        if keep_from > 0:
+            self._history = soft[keep_from:]
+            self._history_start = self._search_from
+        return frames
+
+
+def demodulate_file(path, chunk_samples=1 << 16, **kwargs):
+    demodulator = FskDemodulator(**kwargs)
+    with open(path, "rb") as recording:
+        while True:
+            samples = np.fromfile(recording, dtype=np.complex64, count=chunk_samples)
+            if len(samples) == 0:
+                break
+            yield from demodulator.process(samples)
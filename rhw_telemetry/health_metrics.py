@@ -0,0 +1,159 @@
+from collections import deque, namedtuple, OrderedDict
+
+from .telemetry_unit_conversions import TEMP_OUT_OF_RANGE, TEMP_INVALID
+
+WINDOW_S = 3600
+EWMA_ALPHA = 0.1
+
+# Fields of the decoded EpsStatisticsMessage tracked by default
+EPS_HEALTH_FIELDS = [
+    ('adc_statistics', 'bat_v'),
+    ('adc_statistics', 'bat_curr'),
+    ('adc_statistics', 'temp_sns1'),
+    ('adc_statistics', 'temp_sns2'),
+    ('eps_statistics', 'internal_temp'),
+]
+
+# Converted temperatures of unusable readings, one of them would dominate
+# every statistic of the window
+UNUSABLE_VALUES = (TEMP_OUT_OF_RANGE, TEMP_INVALID)
+
+HealthEvent = namedtuple("HealthEvent", ["timestamp", "kind", "detail"])
+
+
+class RollingStatistics:
+    # Mean, min and max over the last window_s seconds and an EWMA. Min and
+    # max are kept in monotonic deques, so an update is amortized O(1) and
+    # memory is bounded by the samples inside the window.
+    def __init__(self, window_s=WINDOW_S, alpha=EWMA_ALPHA):
+        if window_s <= 0:
+            raise ValueError("Statistics window should be positive, not %r s" % window_s)
+        self.window_s = window_s
+        self.alpha = alpha
+        self._samples = deque()
+        self._min = deque()
+        self._max = deque()
+        self._sum = 0
+        self.ewma = None
+        self.last = None
+
+    def update(self, timestamp, value):
+        self.last = value
+        self.ewma = value if self.ewma is None else \
+            self.ewma + self.alpha * (value - self.ewma)
+        self._samples.append((timestamp, value))
+        self._sum += value
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((timestamp, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((timestamp, value))
+        oldest = timestamp - self.window_s
+        while self._samples[0][0] <= oldest:
+            self._sum -= self._samples.popleft()[1]
+        while self._min[0][0] <= oldest:
+            self._min.popleft()
+        while self._max[0][0] <= oldest:
+            self._max.popleft()
+
+    @property
+    def count(self):
+        return len(self._samples)
+
+    @property
+    def mean(self):
+        return self._sum / len(self._samples) if self._samples else None
+
+    @property
+    def min(self):
+        return self._min[0][1] if self._min else None
+
+    @property
+    def max(self):
+        return self._max[0][1] if self._max else None
+
+    def snapshot(self):
+        return OrderedDict([("last", self.last), ("mean", self.mean), ("min", self.min),
+                            ("max", self.max), ("ewma", self.ewma), ("count", self.count)])
+
+
+def solar_power_milli_watt(adc):
+    return ((adc['spxp_curr'] + adc['spxn_curr']) * adc['sp_x_v'] +
+            (adc['spyp_curr'] + adc['spyn_curr']) * adc['sp_y_v']) / 1000
+
+
+def battery_power_milli_watt(adc):
+    return adc['bat_curr'] * adc['bat_v'] / 1000
+
+
+class EpsHealthMonitor:
+    # Incremental health metrics of a stream of decoded (ground unit)
+    # EpsStatisticsMessage dicts. update() does a constant amount of work per
+    # beacon and returns the events it detected.
+    def __init__(self, fields=EPS_HEALTH_FIELDS, window_s=WINDOW_S, alpha=EWMA_ALPHA):
+        self.statistics = OrderedDict()
+        self._tracked = []
+        for path in fields:
+            field_statistics = RollingStatistics(window_s, alpha)
+            self.statistics[".".join(path)] = field_statistics
+            self._tracked.append((tuple(path), field_statistics))
+        for name in ("solar_power_mw", "battery_power_mw", "can_error_rate"):
+            self.statistics[name] = RollingStatistics(window_s, alpha)
+        self.packets = 0
+        self.reboots = 0
+        self._previous = None
+
+    def _check_reboot(self, timestamp, eps, previous):
+        events = []
+        if eps['uptime_s'] < previous['uptime_s']:
+            events.append(HealthEvent(timestamp, "uptime_reset",
+                                      (previous['uptime_s'], eps['uptime_s'])))
+        if eps['boot_count'] != previous['boot_count']:
+            events.append(HealthEvent(timestamp, "boot_count_changed",
+                                      (previous['boot_count'], eps['boot_count'])))
+        if eps['last_boot_reason'] != previous['last_boot_reason']:
+            events.append(HealthEvent(timestamp, "boot_reason_changed",
+                                      (previous['last_boot_reason'], eps['last_boot_reason'])))
+        if events:
+            self.reboots += 1
+        return events
+
+    def _can_error_rate(self, can, previous_can):
+        # Errors per transferred frame since the previous beacon; counters
+        # that went backwards were reset by a reboot
+        errors = can['error_count'] - previous_can['error_count']
+        frames = (can['rx_frame_count'] - previous_can['rx_frame_count'] +
+                  can['tx_frame_count'] - previous_can['tx_frame_count'])
+        if errors < 0 or frames <= 0:
+            return None
+        return errors / frames
+
+    def update(self, message):
+        timestamp = message['timestamp']
+        adc = message['adc_statistics']
+        statistics = self.statistics
+        for path, field_statistics in self._tracked:
+            value = message
+            for key in path:
+                value = value[key]
+            if value not in UNUSABLE_VALUES:
+                field_statistics.update(timestamp, value)
+        statistics["solar_power_mw"].update(timestamp, solar_power_milli_watt(adc))
+        statistics["battery_power_mw"].update(timestamp, battery_power_milli_watt(adc))
+
+        events = []
+        previous = self._previous
+        if previous is not None:
+            events = self._check_reboot(timestamp, message['eps_statistics'],
+                                        previous['eps_statistics'])
+            rate = self._can_error_rate(message['can_statistics'], previous['can_statistics'])
+            if rate is not None:
+                statistics["can_error_rate"].update(timestamp, rate)
+        self._previous = message
+        self.packets += 1
+        return events
+
+    def snapshot(self):
+        return OrderedDict((name, statistics.snapshot())
+                           for name, statistics in self.statistics.items())
@@ -1,23 +1,12 @@
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 from ctypes import LittleEndianStructure, Structure, Union, c_uint8, c_uint16, c_uint32,\
     string_at, byref, sizeof, c_bool, c_int16, Array, c_char
-import json
+import functools
 import logging
 import struct
 
-from telemetry_unit_conversions import \
-    temp_sensor_adc_val_to_celsius, adc_to_bat_current_milli_amper, \
-    adc_to_solar_panel_current_milli_amper, adc_to_gps_current_milli_amper,\
-    adc_to_adcs_current_milli_amper, adc_to_obc_current_milli_amper,\
-    adc_to_payload_current_milli_amper, adc_to_solar_panel_voltage_milli_volt, \
-    adc_to_bat_voltage, adc_3v3_bus_voltage_milli_volt, adc_5v_bus_voltage_milli_volt,\
-    adc_12v_bus_voltage_milli_volt, adc_to_com_3v3_current_milli_amper,\
-    adc_to_com_5v_current_milli_amper
-
-
-logging.basicConfig(level=logging.INFO,
-                    format="%(asctime)s.%(msecs)03dZ - %(levelname)s: %(message)s",
-                    datefmt="%Y-%m-%dT%H:%M:%S")
+from .instrumentation import METRICS
+from .telemetry_unit_conversions import ADC_GROUND_CONVERSIONS
 
 
 def format_all_fields(self):
@@ -63,14 +52,316 @@ def ctypes_obj_to_dic(obj):
     return obj.unit_conversions_to_ground(_ctypes_obj_to_dic(obj))
 
 
+# One leaf of a flattened ctypes structure. path is the tuple of keys (and
+# list indices) leading to the value in the ctypes_obj_to_dic output, offset
+# is the byte offset of the value (or of the bitfield storage unit) and shape
+# is non-empty for arrays of plain values.
+FieldLayout = namedtuple("FieldLayout", ["path", "offset", "ctype", "shape",
+                                         "bit_offset", "bit_size"])
+
+
+def _walk_ctypes_type(field_type, path, offset):
+    # pylint: disable=protected-access
+    if issubclass(field_type, Array):
+        element_type = field_type._type_
+        if issubclass(element_type, (Array, Structure, Union)):
+            for index in range(field_type._length_):
+                yield from _walk_ctypes_type(element_type, path + (index,),
+                                             offset + index * sizeof(element_type))
+        else:
+            yield FieldLayout(path, offset, element_type, (field_type._length_,), None, None)
+    elif issubclass(field_type, (Structure, Union)):
+        yield from _walk_ctypes_fields(field_type, path, offset)
+    else:
+        yield FieldLayout(path, offset, field_type, (), None, None)
+
+
+def _walk_ctypes_fields(ctype, path, base_offset):
+    # pylint: disable=protected-access
+    for field in ctype._fields_:
+        field_name = field[0]
+        descriptor = getattr(ctype, field_name)
+        offset = base_offset + descriptor.offset
+        if len(field) > 2:
+            # Python < 3.14 packs the bit offset into the low word of size
+            bit_offset = getattr(descriptor, "bit_offset", descriptor.size & 0xffff)
+            yield FieldLayout(path + (field_name,), offset, field[1], (), bit_offset, field[2])
+        else:
+            yield from _walk_ctypes_type(field[1], path + (field_name,), offset)
+
+
+@functools.lru_cache(maxsize=None)
+def message_layout(message_class):
+    return tuple(_walk_ctypes_fields(message_class, (), 0))
+
+
+_STRUCT_INT_CODES = {1: "b", 2: "h", 4: "i", 8: "q"}
+
+
+def _struct_code(ctype):
+    # pylint: disable=protected-access
+    type_code = getattr(ctype, "_type_", None)
+    if type_code in ("?", "f", "d"):
+        return type_code
+    if type_code in ("b", "h", "i", "l", "q"):
+        return _STRUCT_INT_CODES[sizeof(ctype)]
+    if type_code in ("B", "H", "I", "L", "Q"):
+        return _STRUCT_INT_CODES[sizeof(ctype)].upper()
+    raise TypeError("No struct format for %s" % ctype.__name__)
+
+
+def _struct_format(layout):
+    # Union members and bitfields share storage, unpack each unit only once
+    units = OrderedDict()
+    for field in sorted(layout, key=lambda f: f.offset):
+        key = (field.offset, sizeof(field.ctype), field.shape)
+        units.setdefault(key, _struct_code(field.ctype))
+    fmt = "<"
+    position = 0
+    value_index = 0
+    value_indices = {}
+    for (offset, size, shape), code in units.items():
+        if offset < position:
+            raise TypeError("Overlapping fields of different size at offset %d" % offset)
+        if offset > position:
+            fmt += "%dx" % (offset - position)
+        count = shape[0] if shape else 1
+        fmt += ("%d%s" % (count, code)) if shape else code
+        value_indices[(offset, size, shape)] = value_index
+        value_index += count
+        position = offset + size * count
+    return fmt, value_indices
+
+
+def _value_expressions(field, index, conversion_name):
+    # One expression per value, arrays of plain values have one per element
+    count = field.shape[0] if field.shape else 1
+    expressions = []
+    for value_index in range(index, index + count):
+        expression = "v[%d]" % value_index
+        if field.bit_size is not None:
+            if field.bit_offset:
+                expression = "%s >> %d" % (expression, field.bit_offset)
+            expression = "%s & %d" % (expression, (1 << field.bit_size) - 1)
+        if conversion_name is not None:
+            expression = "int(%s(%s))" % (conversion_name, expression)
+        expressions.append(expression)
+    return expressions
+
+
+# Struct format, the namespace for generated code and, for every field of
+# message_layout, the expressions computing its ground unit values from the
+# tuple v unpacked with that format
+@functools.lru_cache(maxsize=None)
+def message_value_expressions(message_class):
+    layout = message_layout(message_class)
+    fmt, value_indices = _struct_format(layout)
+    namespace = {"unpack_from": struct.Struct(fmt).unpack_from}
+    # pylint: disable=protected-access
+    conversions = dict(message_class._ground_conversions_)
+    values = []
+    for field in layout:
+        conversion_name = None
+        if field.path in conversions:
+            conversion_name = "conversion_%d" % len(namespace)
+            namespace[conversion_name] = conversions[field.path]
+        index = value_indices[(field.offset, sizeof(field.ctype), field.shape)]
+        values.append((field, _value_expressions(field, index, conversion_name)))
+    return fmt, namespace, values
+
+
+def message_tree(message_class, leaf):
+    # The nested dict shape of ctypes_obj_to_dic with leaf(field, expressions)
+    # at the leaves, list indices are int keys
+    tree = OrderedDict()
+    for field, expressions in message_value_expressions(message_class)[2]:
+        node = tree
+        for key in field.path[:-1]:
+            node = node.setdefault(key, OrderedDict())
+        node[field.path[-1]] = leaf(field, expressions)
+    return tree
+
+
+def compile_message_function(message_class, name, expression, extra_namespace=None):
+    # Generated function(buffer, offset=0) returning expression over the
+    # unpacked values of one message
+    fmt, namespace, _ = message_value_expressions(message_class)
+    namespace = dict(namespace)
+    namespace.update(extra_namespace or {})
+    source = ("def %s(buffer, offset=0):\n"
+              "    v = unpack_from(buffer, offset)\n"
+              "    return %s\n" % (name, expression))
+    exec(compile(source, "<%s %s>" % (message_class.__name__, name), "exec"), namespace)  # pylint: disable=exec-used
+    function = namespace[name]
+    function.size = struct.calcsize(fmt)
+    return function
+
+
+def _tree_source(tree):
+    if all(isinstance(key, int) for key in tree):
+        return "[%s]" % ", ".join(_tree_source(tree[key]) if isinstance(tree[key], dict)
+                                  else tree[key] for key in sorted(tree))
+    return "{%s}" % ", ".join("%r: %s" % (key, _tree_source(value) if isinstance(value, dict)
+                                          else value) for key, value in tree.items())
+
+
+# Compiles a decoder that turns the bytes of one message directly into the
+# ctypes_obj_to_dic output of message_class: a single struct unpack followed
+# by a generated dict literal with the bitfield extraction and the ground unit
+# conversions inlined.
+@functools.lru_cache(maxsize=None)
+def compile_message_decoder(message_class):
+    tree = message_tree(message_class, lambda field, expressions:
+                        "[%s]" % ", ".join(expressions) if field.shape else expressions[0])
+    return compile_message_function(message_class, "decode", _tree_source(tree))
+
+
+def _view_tree(message_class):
+    tree = OrderedDict()
+    for field in message_layout(message_class):
+        node = tree
+        for key in field.path[:-1]:
+            node = node.setdefault(key, OrderedDict())
+        node[field.path[-1]] = field
+    return tree
+
+
+def _view_value_source(field, namespace, conversion):
+    count = field.shape[0] if field.shape else 1
+    unpack_name = "unpack_%d" % len(namespace)
+    namespace[unpack_name] = struct.Struct("<%d%s" % (count, _struct_code(field.ctype))).unpack_from
+    expression = "%s(self._buffer, self._offset + %d)" % (unpack_name, field.offset)
+    if not field.shape:
+        expression += "[0]"
+        if field.bit_size is not None:
+            if field.bit_offset:
+                expression = "(%s >> %d)" % (expression, field.bit_offset)
+            expression = "%s & %d" % (expression, (1 << field.bit_size) - 1)
+    if conversion is not None:
+        conversion_name = "conversion_%d" % len(namespace)
+        namespace[conversion_name] = conversion
+        if field.shape:
+            return "tuple([int(%s(x)) for x in %s])" % (conversion_name, expression)
+        return "int(%s(%s))" % (conversion_name, expression)
+    return expression
+
+
+def _view_class_source(name, tree, path, namespace, conversions, sources):
+    # Appends the source of the view class of tree and of its children to
+    # sources, children first. The cache slots start as None, which no field
+    # decodes to.
+    properties = []
+    for key, child in tree.items():
+        child_path = path + (key,)
+        if isinstance(child, FieldLayout):
+            expression = _view_value_source(child, namespace, conversions.get(child_path))
+        elif all(isinstance(idx, int) for idx in child):
+            elements = []
+            for idx in sorted(child):
+                element_name = "%s_%s_%d" % (name, key, idx)
+                _view_class_source(element_name, child[idx], child_path + (idx,), namespace,
+                                   conversions, sources)
+                elements.append("%s(self._buffer, self._offset)" % element_name)
+            expression = "(%s,)" % ", ".join(elements)
+        else:
+            child_name = "%s_%s" % (name, key)
+            _view_class_source(child_name, child, child_path, namespace, conversions, sources)
+            expression = "%s(self._buffer, self._offset)" % child_name
+        properties.append(
+            "    @property\n"
+            "    def {key}(self):\n"
+            "        value = self._c_{key}\n"
+            "        if value is None:\n"
+            "            value = self._c_{key} = {expression}\n"
+            "        return value\n".format(key=key, expression=expression))
+    check = ""
+    if not path:
+        check = ("        buffer = memoryview(buffer)\n"
+                 "        if len(buffer) < offset + size:\n"
+                 "            raise ValueError('%s needs %%d bytes at offset %%d, buffer has %%d'"
+                 " %% (size, offset, len(buffer)))\n" % namespace["message_class"].__name__)
+    sources.append(
+        "class {name}(MessageView):\n"
+        "    __slots__ = ({slots})\n"
+        "    _field_names_ = {keys!r}\n"
+        "    def __init__(self, buffer, offset{default}):\n"
+        "{check}"
+        "        self._buffer = buffer\n"
+        "        self._offset = offset\n"
+        "        {slots_none} = None\n"
+        "{properties}".format(
+            name=name, slots="".join("'_c_%s', " % key for key in tree), keys=tuple(tree),
+            default="=0" if not path else "", check=check,
+            slots_none=" = ".join("self._c_%s" % key for key in tree),
+            properties="".join(properties)))
+
+
+class MessageView:
+    # Base of the generated read-only views: the buffer holding a message and
+    # the message's offset in it. Views keep a memoryview of the buffer, a
+    # bytearray can't be resized while one is alive.
+    __slots__ = ("_buffer", "_offset")
+    _field_names_ = ()
+
+    def to_dict(self):
+        dic = OrderedDict()
+        for key in self._field_names_:
+            value = getattr(self, key)
+            if isinstance(value, MessageView):
+                value = value.to_dict()
+            elif isinstance(value, tuple):
+                value = [item.to_dict() if isinstance(item, MessageView) else item
+                         for item in value]
+            dic[key] = value
+        return dic
+
+
+# Compiles a view class of message_class over a buffer, without copying it.
+# Every field is a property that unpacks (and converts to ground units) just
+# that field on first access and caches it in a slot, nested structures are
+# views over the same buffer.
+@functools.lru_cache(maxsize=None)
+def compile_message_view(message_class):
+    name = "%sView" % message_class.__name__
+    namespace = {"MessageView": MessageView, "message_class": message_class,
+                 "size": sizeof(message_class), "decode": compile_message_decoder(message_class)}
+    # pylint: disable=protected-access
+    conversions = dict(message_class._ground_conversions_)
+    sources = []
+    _view_class_source(name, _view_tree(message_class), (), namespace, conversions, sources)
+    sources.append("%s.to_dict = lambda self: decode(self._buffer, self._offset)\n"
+                   "%s.message_class = message_class\n"
+                   "%s.size = size\n" % (name, name, name))
+    exec(compile("\n\n".join(sources), "<%s>" % name, "exec"), namespace)  # pylint: disable=exec-used
+    return namespace[name]
+
+
 class MessageData(LittleEndianStructure):
     _pack_ = 1
+    # (path, conversion) pairs of the fields converted to ground units
+    _ground_conversions_ = ()
+    # (CspIdBits field, value) pairs the message is sent with, empty for any
+    # address
+    _csp_address_ = ()
 
     def __str__(self):
         return format_all_fields(self)
 
+    @classmethod
+    def decode(cls, buffer, offset=0):
+        return compile_message_decoder(cls)(buffer, offset)
+
+    @classmethod
+    def view(cls, buffer, offset=0):
+        return compile_message_view(cls)(buffer, offset)
+
     @classmethod
     def unit_conversions_to_ground(cls, dic):
+        for path, conversion in cls._ground_conversions_:
+            parent = dic
+            for key in path[:-1]:
+                parent = parent[key]
+            parent[path[-1]] = int(conversion(parent[path[-1]]))
         return dic
 
 
@@ -191,62 +482,8 @@ class EpsStatisticsMessage(MessageData):
                 ('subsystem_hearbeat_statistics', SubsystemHeartbeatStatistics),
                 ('antenna_statistics', AntennaStatistics),
                ]
-
-    @classmethod
-    def _update_solar_panel_current_adc_to_milli_amper(cls, dic, field):
-        dic['adc_statistics'][field] = int(adc_to_solar_panel_current_milli_amper(
-            dic['adc_statistics'][field]))
-
-    @classmethod
-    def unit_conversions_to_ground(cls, dic):
-        cls._update_solar_panel_current_adc_to_milli_amper(dic, 'spxp_curr')
-        cls._update_solar_panel_current_adc_to_milli_amper(dic, 'spxn_curr')
-        cls._update_solar_panel_current_adc_to_milli_amper(dic, 'spyp_curr')
-        cls._update_solar_panel_current_adc_to_milli_amper(dic, 'spyn_curr')
-
-        dic['adc_statistics']['sp_x_v'] = int(adc_to_solar_panel_voltage_milli_volt(
-            dic['adc_statistics']['sp_x_v']))
-        dic['adc_statistics']['sp_y_v'] = int(adc_to_solar_panel_voltage_milli_volt(
-            dic['adc_statistics']['sp_y_v']))
-
-        dic['adc_statistics']['bat_curr'] = int(adc_to_bat_current_milli_amper(
-            dic['adc_statistics']['bat_curr']))
-
-        dic['adc_statistics']['bat_v'] = int(adc_to_bat_voltage(
-            dic['adc_statistics']['bat_v']))
-
-        dic['adc_statistics']['uhf_curr_3v3'] = int(adc_to_com_3v3_current_milli_amper(
-            dic['adc_statistics']['uhf_curr_3v3']))
-
-        dic['adc_statistics']['uhf_curr_5v'] = int(adc_to_com_5v_current_milli_amper(
-            dic['adc_statistics']['uhf_curr_5v']))
-
-        dic['adc_statistics']['payload_curr'] = int(adc_to_payload_current_milli_amper(
-            dic['adc_statistics']['payload_curr']))
-        dic['adc_statistics']['adcs_curr'] = int(adc_to_adcs_current_milli_amper(
-            dic['adc_statistics']['adcs_curr']))
-        dic['adc_statistics']['gps_curr'] = int(adc_to_gps_current_milli_amper(
-            dic['adc_statistics']['gps_curr']))
-        dic['adc_statistics']['obc_curr'] = int(adc_to_obc_current_milli_amper(
-            dic['adc_statistics']['obc_curr']))
-
-        dic['adc_statistics']['sns_3v3'] = int(adc_3v3_bus_voltage_milli_volt(
-            dic['adc_statistics']['sns_3v3']))
-
-        dic['adc_statistics']['sns_5v'] = int(adc_5v_bus_voltage_milli_volt(
-            dic['adc_statistics']['sns_5v']))
-
-        dic['adc_statistics']['sns_12v_1'] = int(adc_12v_bus_voltage_milli_volt(
-            dic['adc_statistics']['sns_12v_1']))
-        dic['adc_statistics']['sns_12v_2'] = int(adc_12v_bus_voltage_milli_volt(
-            dic['adc_statistics']['sns_12v_2']))
-
-        dic['adc_statistics']['temp_sns1'] = int(temp_sensor_adc_val_to_celsius(
-            dic['adc_statistics']['temp_sns1']))
-
-        dic['adc_statistics']['temp_sns2'] = int(temp_sensor_adc_val_to_celsius(
-            dic['adc_statistics']['temp_sns2']))
-        return dic
+    _ground_conversions_ = tuple((('adc_statistics', field), conversion)
+                                 for field, conversion in ADC_GROUND_CONVERSIONS.items())
 
 
 class UhfStatistics(MessageData):
@@ -277,47 +514,96 @@ class RadioPacketType:
 
 LENGTH_TYPE = ">B"
 LENGTH_HEADER_SIZE = 1
+COUNTER_SIZE_BYTES = 4
+CMAC_SIZE_BYTES = 4
+
+
+def _shared_buffer(data):
+    # Packets reference the buffer they are parsed from instead of copying
+    # it. Only read-only buffers can be shared safely, writable ones such as
+    # a bytearray the caller reuses are copied once.
+    if isinstance(data, bytes):
+        return data
+    view = data if isinstance(data, memoryview) else memoryview(data)
+    if not view.readonly:
+        return view.tobytes()
+    return view if view.format == "B" and view.ndim == 1 else view.cast("B")
 
 
 class HWRadioPacket:
+    # The payload, and with a signature the serial and CMAC at its end, are
+    # offsets into the frame the packet was parsed from. payload_view is a
+    # view of it without a copy, payload and get_bytes() build bytes when
+    # asked for, and when the frame's length byte matches the payload
+    # get_bytes() returns the frame itself.
+    __slots__ = ("packet_type", "serial", "cmac", "_data", "_start", "_end", "_signed")
+
     def __init__(self, packet_type, payload, with_signature=False,
                  target_id=None, serial=None, cmac=None):
         if packet_type not in RadioPacketType.TYPES:
             raise ValueError("Packet type must be valid")
-        self.payload = payload
         self.packet_type = packet_type
-
-        if with_signature and packet_type == RadioPacketType.CSP:
+        self._signed = with_signature and packet_type == RadioPacketType.CSP
+        if self._signed:
             if not serial and not cmac:
-                self.serial = bytearray(struct.pack("<I", 0)) # Here we would in reality get the next available packet number
-                self.payload += self.serial
-
-                # Calculate after serial added
-                self.cmac = bytearray([ 0x0, 0x0, 0x0, 0x0 ]) # Here we would in reality sign for real
-                self.payload += self.cmac
-            elif cmac and serial:
-                self.serial = serial
-                self.cmac = cmac
-                self.payload += serial + cmac
-            else:
+                # Here we would in reality get the next available packet
+                # number and sign for real
+                serial = struct.pack("<I", 0)
+                cmac = bytes(CMAC_SIZE_BYTES)
+            elif not (cmac and serial):
                 raise AssertionError("Either give both CMAC and serial or "
                                      "neither")
-
-        self.sat_packet = bytearray([packet_type]) + self.payload
-        self.length_header = bytearray(struct.pack(LENGTH_TYPE, len(self.sat_packet)))
-        self.bytes = self.length_header + self.sat_packet
+            self.serial = serial
+            self.cmac = cmac
+            payload = b"".join((payload, serial, cmac))
+        self.payload = payload
 
     def __str__(self):
-        return " ".join(map(lambda b: "%02X" % b, self.bytes))
+        return " ".join(map(lambda b: "%02X" % b, self.get_bytes()))
+
+    def __reduce__(self):
+        return HWRadioPacket.from_bytes, (self.get_bytes(), self._signed)
+
+    @property
+    def payload_view(self):
+        return memoryview(self._data)[self._start:self._end]
+
+    @property
+    def payload(self):
+        if self._start == 0 and self._end == len(self._data) and isinstance(self._data, bytes):
+            return self._data
+        return bytes(self._data[self._start:self._end])
+
+    @payload.setter
+    def payload(self, payload):
+        self._data = _shared_buffer(payload)
+        self._start = 0
+        self._end = len(self._data)
+
+    @property
+    def length_header(self):
+        return struct.pack(LENGTH_TYPE, self.len_without_len_field())
+
+    @property
+    def sat_packet(self):
+        return self.get_bytes_without_len()
+
+    @property
+    def bytes(self):
+        return self.get_bytes()
 
     def get_bytes(self):
-        return self.bytes
+        if (self._start == LENGTH_HEADER_SIZE + 1 and
+                self._data[0] == self.len_without_len_field()):
+            # Parsed from a frame of exactly this packet
+            return bytes(self._data[:self._end])
+        return b"".join((self.length_header, bytes((self.packet_type,)), self.payload_view))
 
     def get_bytes_without_len(self):
-        return self.sat_packet
+        return self.get_bytes()[LENGTH_HEADER_SIZE:]
 
     def len_without_len_field(self):
-        return len(self.bytes) - len(self.length_header)
+        return 1 + self._end - self._start
 
     @classmethod
     def from_bytes(cls, data, with_signature=False):
@@ -325,40 +611,37 @@ class HWRadioPacket:
             raise ValueError("Packet can't be empty")
         if len(data) < 2:
             raise ValueError("Packet should contain atleast length and type")
+        data = _shared_buffer(data)
         if data[1] not in RadioPacketType.TYPES:
             raise ValueError("Second byte should define the packet type")
-        packet_len = struct.unpack(LENGTH_TYPE, data[0:LENGTH_HEADER_SIZE])[0]
+        packet_len = data[0]
         if packet_len != (len(data) - LENGTH_HEADER_SIZE):
             logging.debug("Too many bytes for HW_RADIO_PACKET ignoring leftovers")
             logging.debug(data)
 
-        cmac = None
-        serial = None
+        packet = cls.__new__(cls)
+        packet.packet_type = data[1]
+        packet._data = data
+        packet._start = LENGTH_HEADER_SIZE + 1
+        # The signature is the end of data, whatever the length byte says. A
+        # length byte of 0 leaves an empty payload.
+        packet._end = len(data) if with_signature else \
+            max(packet._start, min(len(data), LENGTH_HEADER_SIZE + packet_len))
+        packet._signed = with_signature
         if with_signature:
-            cmac = data[-COUNTER_SIZE_BYTES:]
-            serial = data[-CMAC_SIZE_BYTES-COUNTER_SIZE_BYTES:-CMAC_SIZE_BYTES]
-            # Skip trailing cmac and counter so we can compare recalculated
-            # value
-            payload = data[LENGTH_HEADER_SIZE + 1:-CMAC_SIZE_BYTES-COUNTER_SIZE_BYTES]
-        else:
-            payload = data[LENGTH_HEADER_SIZE + 1:LENGTH_HEADER_SIZE + packet_len]
-        packet = HWRadioPacket(data[LENGTH_HEADER_SIZE], payload,
-                               with_signature, serial=serial, cmac=cmac)
-
-        if with_signature:
-            packet.cmac = cmac
-            packet.serial = serial
-
+            packet.cmac = bytes(data[-CMAC_SIZE_BYTES:])
+            packet.serial = bytes(data[-CMAC_SIZE_BYTES - COUNTER_SIZE_BYTES:-CMAC_SIZE_BYTES])
         return packet
 
     @classmethod
     def packets_from_bytes(cls, data, with_signature=False):
         packets = []
         idx = 0
-        while idx < len(data):
-            packet = HWRadioPacket.from_bytes(data[idx:], with_signature)
+        view = memoryview(_shared_buffer(data))
+        while idx < len(view):
+            packet = HWRadioPacket.from_bytes(view[idx:], with_signature)
             packets.append(packet)
-            idx += len(packet.get_bytes())
+            idx += LENGTH_HEADER_SIZE + packet.len_without_len_field()
         return packets
 
 
@@ -387,31 +670,104 @@ class CspHeader(Union):
         return struct.pack(">I", self.raw)
 
 
+def _print_bool(value):
+    return "yes" if value else "no"
+
+
+class Rdp:
+    # The RDP header libcsp appends to the data of reliable connections:
+    # flags and the big endian sequence and acknowledgement numbers
+    __slots__ = ("flags", "seq_nr", "ack_nr")
+    HEADER = struct.Struct(">BHH")
+    FLAGS = (("syn", 0x08), ("ack", 0x04), ("eak", 0x02), ("rst", 0x01))
+
+    def __init__(self, flags, seq_nr, ack_nr):
+        self.flags = flags
+        self.seq_nr = seq_nr
+        self.ack_nr = ack_nr
+
+    def __str__(self):
+        return "%s seq %d ack %d" % (
+            " ".join("%s %s" % (name, _print_bool(self.flags & bit)) for name, bit in self.FLAGS),
+            self.seq_nr, self.ack_nr)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if len(data) < cls.HEADER.size:
+            raise ValueError("RDP header is %d bytes" % cls.HEADER.size)
+        return cls(*cls.HEADER.unpack_from(data, len(data) - cls.HEADER.size))
+
+
+def _csp_header_field(name):
+    def field(self):
+        shift, mask = CSP_HEADER_FIELDS[name]
+        return self._header >> shift & mask
+
+    def set_field(self, value):
+        shift, mask = CSP_HEADER_FIELDS[name]
+        # The buffer no longer holds this packet's header
+        self.payload = self.payload_view
+        self._header = self._header & ~(mask << shift) | (int(value) & mask) << shift
+    return property(field, set_field)
+
+
 class CspPacket:
-    # pylint: disable=too-many-instance-attributes
+    # The header is kept raw and its fields are read from it when asked for.
+    # payload_view is a view of the buffer the packet was parsed from, and
+    # get_bytes() returns that buffer when it holds exactly this packet.
+    __slots__ = ("_header", "_data", "_start", "_end")
+
     # pylint: disable=too-many-arguments
     def __init__(self, src, dst, dst_port, src_port, payload,
                  priority=0, hmac=False, xtea=False, rdp=False,
                  crc=False):
-
-        self.len = struct.pack(">H", len(payload))
-        header_bits = CspIdBits(src=src, dst=dst, dst_port=dst_port, src_port=src_port,
-                                priority=priority, hmac=hmac, xtea=xtea, rdp=rdp, crc=crc)
-        self.header = CspHeader(structured=header_bits)
-        self.src = src
-        self.dst = dst
-        self.dst_port = dst_port
-        self.src_port = src_port
+        header = 0
+        for name, value in (("src", src), ("dst", dst), ("dst_port", dst_port),
+                            ("src_port", src_port), ("priority", priority), ("hmac", hmac),
+                            ("xtea", xtea), ("rdp", rdp), ("crc", crc)):
+            shift, mask = CSP_HEADER_FIELDS[name]
+            header |= (int(value) & mask) << shift
+        self._header = header
         self.payload = payload
-        self.priority = priority
-        self.hmac = hmac
-        self.xtea = xtea
-        self.rdp = rdp
-        self.crc = crc
+
+    src = _csp_header_field("src")
+    dst = _csp_header_field("dst")
+    dst_port = _csp_header_field("dst_port")
+    src_port = _csp_header_field("src_port")
+    priority = _csp_header_field("priority")
+    hmac = _csp_header_field("hmac")
+    xtea = _csp_header_field("xtea")
+    rdp = _csp_header_field("rdp")
+    crc = _csp_header_field("crc")
+
+    @property
+    def header(self):
+        return CspHeader(raw=self._header)
+
+    @property
+    def len(self):
+        return struct.pack(">H", self._end - self._start)
+
+    @property
+    def payload_view(self):
+        return memoryview(self._data)[self._start:self._end]
+
+    @property
+    def payload(self):
+        if self._start == 0 and self._end == len(self._data) and isinstance(self._data, bytes):
+            return self._data
+        return bytes(self._data[self._start:self._end])
+
+    @payload.setter
+    def payload(self, payload):
+        self._data = _shared_buffer(payload)
+        self._start = 0
+        self._end = len(self._data)
 
     def __str__(self):
-        payload_str = " ".join(map(lambda b: "%02X" %b, self.payload)) if len(self.payload) < 10 else ""
-        rdp_str = " RDP(" + str(Rdp.from_bytes(self.payload)) + ")" \
+        payload = self.payload_view
+        payload_str = " ".join(map(lambda b: "%02X" %b, payload)) if len(payload) < 10 else ""
+        rdp_str = " RDP(" + str(Rdp.from_bytes(payload)) + ")" \
             if self.rdp else ""
         return "CSP(src %d:%d dst %d:%d prio %s hmac %s xtea %s rdp %s " \
                "crc %s data[%d] [%s]%s)" % (
@@ -420,15 +776,24 @@ class CspPacket:
                    _print_bool(self.xtea),
                    _print_bool(self.rdp),
                    _print_bool(self.crc),
-                   len(self.payload), payload_str, rdp_str)
+                   len(payload), payload_str, rdp_str)
+
+    def __reduce__(self):
+        return CspPacket.from_bytes, (self.get_bytes(),)
+
+    @classmethod
+    def _wrap(cls, header, data, start, end):
+        packet = cls.__new__(cls)
+        packet._header = header
+        packet._data = data
+        packet._start = start
+        packet._end = end
+        return packet
 
     @classmethod
     def from_header(cls, header, payload):
-        return CspPacket(header.structured.src, header.structured.dst, header.structured.dst_port,
-                         header.structured.src_port, payload, priority=header.structured.priority,
-                         hmac=header.structured.hmac, xtea=header.structured.xtea,
-                         rdp=header.structured.rdp, crc=header.structured.crc
-                         )
+        payload = _shared_buffer(payload)
+        return cls._wrap(header.raw, payload, 0, len(payload))
 
     @classmethod
     def from_bytes(cls, data, with_length=True):
@@ -436,26 +801,27 @@ class CspPacket:
             raise ValueError("argument should be iterable")
         if len(data) < HEADER_PLUS_LENGTH_SIZE:
             raise ValueError("Csp packet has to have at least 32bit header and 16bit length field")
-        header = CspHeader(raw=struct.unpack(">I", data[0:4])[0])
+        data = _shared_buffer(data)
+        header, length = CSP_HEADER_STRUCT.unpack_from(data)
         if with_length:
-            length = struct.unpack(">H", data[4:HEADER_PLUS_LENGTH_SIZE])[0]
             if len(data) < length + HEADER_PLUS_LENGTH_SIZE:
                 raise ValueError("No support for buffering,"
                                  " argument should enough bytes to satifsfy length field length")
-            return cls.from_header(header,
-                                   data[HEADER_PLUS_LENGTH_SIZE:HEADER_PLUS_LENGTH_SIZE+length])
+            return cls._wrap(header, data, HEADER_PLUS_LENGTH_SIZE,
+                             HEADER_PLUS_LENGTH_SIZE + length)
         else:
-            return cls.from_header(header, data[HEADER_SIZE:])
+            return cls._wrap(header, data, HEADER_SIZE, len(data))
 
     @classmethod
     def packets_from_bytes(cls, data):
         packets = []
         idx = 0
-        while idx < len(data):
+        view = memoryview(_shared_buffer(data))
+        while idx < len(view):
             try:
-                packet = cls.from_bytes(data[idx:])
+                packet = cls.from_bytes(view[idx:])
                 packets.append(packet)
-                idx += len(packet.get_bytes())
+                idx += HEADER_PLUS_LENGTH_SIZE + packet._end - packet._start
             except ValueError:
                 logging.debug("Tried to parse malformed or"
                               " incomplete csp packet from bytes: %s", data[idx:])
@@ -463,22 +829,156 @@ class CspPacket:
         return packets
 
     def get_bytes(self, with_length=True):
+        if with_length and self._start == HEADER_PLUS_LENGTH_SIZE:
+            # Parsed with the length field, the buffer starts with the packet
+            return bytes(self._data[:self._end])
+        header = struct.pack(">I", self._header)
         if with_length:
-            return self.header.get_bytes() + self.len + self.payload
+            return b"".join((header, self.len, self.payload_view))
         else:
-            return self.header.get_bytes() + self.payload
+            return b"".join((header, self.payload_view))
+
+
+CSP_HEADER_STRUCT = struct.Struct(">IH")
+RADIO_FRAME_CSP_OFFSET = LENGTH_HEADER_SIZE + 1
+# (shift, mask) of every CspIdBits field in the raw header
+CSP_HEADER_FIELDS = {field.path[0]: (field.bit_offset, (1 << field.bit_size) - 1)
+                     for field in message_layout(CspIdBits)}
+MAX_RESOLVED_HEADERS = 1 << 16
+
+
+def csp_address_mask(address):
+    # (mask, value) such that header & mask == value for the headers with
+    # the given field values, e.g. {"dst_port": 10, "hmac": 1}
+    mask = 0
+    value = 0
+    for name, field_value in address.items():
+        if name not in CSP_HEADER_FIELDS:
+            raise ValueError("%s is not a CSP header field" % name)
+        shift, field_mask = CSP_HEADER_FIELDS[name]
+        field_value = int(field_value)
+        if field_value & ~field_mask:
+            raise ValueError("%s %d does not fit in the CSP header" % (name, field_value))
+        mask |= field_mask << shift
+        value |= field_value << shift
+    return mask, value
+
+
+class CspDispatcher:
+    # Maps the raw CSP header and length field to the message class sent
+    # with them. Each registration is a (masked header, payload size) key in
+    # the table of its header mask, and every header seen is memoized, so
+    # unregistered traffic is dropped after one dict lookup without touching
+    # the payload.
+    def __init__(self, message_classes=()):
+        self._tables = {}
+        self._masks = []
+        self._resolved = {}
+        for message_class in message_classes:
+            self.register(message_class)
+
+    def register(self, message_class, **address):
+        # address overrides the class' _csp_address_, e.g. dst_port=10
+        mask, value = csp_address_mask(dict(getattr(message_class, "_csp_address_", ()),
+                                            **address))
+        table = self._tables.setdefault(mask, {})
+        key = (value, sizeof(message_class))
+        if table.get(key, message_class) is not message_class:
+            raise ValueError("%s is already registered for the same header and size as %s" % (
+                table[key].__name__, message_class.__name__))
+        table[key] = message_class
+        # The most specific registration wins
+        self._masks = sorted(self._tables, key=lambda mask: bin(mask).count("1"), reverse=True)
+        self._resolved.clear()
+        return message_class
+
+    def payload_sizes(self):
+        return {size for table in self._tables.values() for _, size in table}
+
+    def lookup(self, header, length):
+        key = (header, length)
+        try:
+            return self._resolved[key]
+        except KeyError:
+            pass
+        message_class = None
+        for mask in self._masks:
+            message_class = self._tables[mask].get((header & mask, length))
+            if message_class is not None:
+                break
+        if len(self._resolved) >= MAX_RESOLVED_HEADERS:
+            self._resolved.clear()
+        self._resolved[key] = message_class
+        return message_class
+
+    def dispatch(self, data, offset=0):
+        # Message class of the CSP packet (with length field) at offset, None
+        # for unregistered traffic
+        if len(data) < offset + HEADER_PLUS_LENGTH_SIZE:
+            raise ValueError("Csp packet has to have at least 32bit header and 16bit length field")
+        header, length = CSP_HEADER_STRUCT.unpack_from(data, offset)
+        if len(data) < offset + HEADER_PLUS_LENGTH_SIZE + length:
+            raise ValueError("Csp packet is shorter than its length field")
+        return self.lookup(header, length)
+
+    def dispatch_frame(self, frame):
+        # Same for a length prefixed radio frame, relay packets are never
+        # dispatched
+        if len(frame) < 2 or frame[1] not in RadioPacketType.TYPES:
+            raise ValueError("Second byte should define the packet type")
+        if frame[1] != RadioPacketType.CSP:
+            return None
+        return self.dispatch(frame, RADIO_FRAME_CSP_OFFSET)
+
+
+# Statistics beacons are told apart by the size of their CSP payload
+STATISTICS_MESSAGES = {sizeof(message_class): message_class
+                       for message_class in (EpsStatisticsMessage, UhfStatisticsMessage)}
+STATISTICS_DISPATCHER = CspDispatcher(STATISTICS_MESSAGES.values())
+
+
+def decode_statistics_frame(data, dispatcher=STATISTICS_DISPATCHER):
+    message_class = dispatcher.dispatch_frame(data)
+    if message_class is None:
+        raise ValueError("Frame is not a registered statistics message")
+    return message_class, message_class.decode(
+        data, RADIO_FRAME_CSP_OFFSET + HEADER_PLUS_LENGTH_SIZE)
 
 
 def uhf_to_json(str):
+    import json  # pylint: disable=import-outside-toplevel
     data = bytes.fromhex(str)
     packet = HWRadioPacket.from_bytes(data, with_signature=False)
-    csp_packet = CspPacket.from_bytes(packet.payload)
-    msg = UhfStatisticsMessage.from_buffer_copy(csp_packet.payload)
-    print(json.dumps(ctypes_obj_to_dic(msg), indent=1, sort_keys=False))
+    csp_packet = CspPacket.from_bytes(packet.payload_view)
+    print(json.dumps(UhfStatisticsMessage.decode(csp_packet.payload_view), indent=1, sort_keys=False))
 
 def eps_to_json(str):
+    import json  # pylint: disable=import-outside-toplevel
     data = bytes.fromhex(str)
     packet = HWRadioPacket.from_bytes(data, with_signature=False)
-    csp_packet = CspPacket.from_bytes(packet.payload)
-    msg = EpsStatisticsMessage.from_buffer_copy(csp_packet.payload)
-    print(json.dumps(ctypes_obj_to_dic(msg), indent=1, sort_keys=False))
+    csp_packet = CspPacket.from_bytes(packet.payload_view)
+    print(json.dumps(EpsStatisticsMessage.decode(csp_packet.payload_view), indent=1, sort_keys=False))
+
+
+def _is_none(result):
+    return result is None
+
+
+def _data_size(args):
+    return len(args[1])
+
+
+def _message_size(args):
+    return sizeof(args[0])
+
+
+# Pipeline stages timed while instrumentation.METRICS is enabled
+METRICS.instrument(HWRadioPacket, "from_bytes", "radio", bytes_in=_data_size)
+METRICS.instrument(CspPacket, "from_bytes", "csp", bytes_in=_data_size)
+METRICS.instrument(CspDispatcher, "dispatch_frame", "dispatch", bytes_in=_data_size,
+                   skipped=_is_none)
+METRICS.instrument(CspDispatcher, "dispatch", "csp_dispatch", bytes_in=_data_size,
+                   skipped=_is_none)
+METRICS.instrument(MessageData, "decode", "decode", bytes_in=_message_size)
+METRICS.instrument(MessageData, "view", "view", bytes_in=_message_size)
+METRICS.instrument(MessageData, "unit_conversions_to_ground", "unit_conversions")
@@ -0,0 +1,495 @@
+import argparse
+import asyncio
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import json
+import logging
+import os
+import struct
+import sys
+import time
+
+from .cli import configure_logging
+from .dedup import DuplicateCache, payload_key
+from .framing import RadioPacketFramer, CspPacketFramer, CC11XX_CRC_SIZE
+from .health_metrics import RollingStatistics
+from .hex_decoder import STATISTICS_DISPATCHER, RADIO_FRAME_CSP_OFFSET, HEADER_PLUS_LENGTH_SIZE
+from .instrumentation import METRICS
+from .telemetry_unit_conversions import active_calibration, load_calibration_profile, \
+    use_calibration
+
+READ_SIZE = 1 << 16
+# Decode batches in flight per connection before reading from it stops
+MAX_PENDING_BATCHES = 8
+# A datagram usually carries a single frame
+UDP_MAX_PENDING_BATCHES = 256
+SUBSCRIBER_QUEUE_SIZE = 4096
+LATENCY_WINDOW_S = 60
+# Statistics of this many closed connections are kept
+CLOSED_CONNECTIONS = 64
+# UDP has no close, a station silent this long is closed, and how often
+# that is checked
+UDP_IDLE_S = 300
+UDP_EXPIRY_INTERVAL_S = 30
+
+IngestedMessage = namedtuple("IngestedMessage", ["station", "received", "message_class",
+                                                 "message"])
+
+
+def decode_frames(frames, dispatcher=STATISTICS_DISPATCHER, csp=False, collect_metrics=False):
+    # Runs in the executor: (message class, dict) of every registered message
+    # in frames, the counts of failed and unregistered frames and, from
+    # worker processes, their metrics
+    dispatch = dispatcher.dispatch if csp else dispatcher.dispatch_frame
+    offset = HEADER_PLUS_LENGTH_SIZE if csp else RADIO_FRAME_CSP_OFFSET + HEADER_PLUS_LENGTH_SIZE
+    messages = []
+    failures = 0
+    skipped = 0
+    for frame in frames:
+        try:
+            message_class = dispatch(frame)
+            if message_class is None:
+                skipped += 1
+                continue
+            messages.append((message_class, message_class.decode(frame, offset)))
+        except (ValueError, struct.error):
+            failures += 1
+    metrics = None
+    if collect_metrics and METRICS.enabled:
+        metrics = METRICS.snapshot()
+        METRICS.reset()
+    return messages, failures, skipped, metrics
+
+
+def enable_worker_metrics():
+    METRICS.reset()
+    METRICS.enable()
+
+
+def init_worker(metrics, calibration):
+    # Decoding processes collect metrics when the server does and convert
+    # with its calibration profile
+    if metrics:
+        enable_worker_metrics()
+    use_calibration(calibration)
+
+
+class Connection:
+    # One station feed: its framer, the decode batches in flight in order and
+    # its counters
+    def __init__(self, station, framer, max_pending):
+        self.station = station
+        self.framer = framer
+        self.pending = asyncio.Queue(max_pending)
+        self.publisher = None
+        self.messages = 0
+        self.failures = 0
+        self.skipped = 0
+        self.dropped_batches = 0
+        self.duplicates = 0
+        # Seconds from receiving a chunk to publishing its messages
+        self.latency = RollingStatistics(LATENCY_WINDOW_S)
+        self.last_active = time.monotonic()
+
+    def snapshot(self):
+        return OrderedDict([("queue_depth", self.pending.qsize()),
+                            ("bytes_in", self.framer.bytes_in),
+                            ("bytes_skipped", self.framer.bytes_skipped),
+                            ("frames", self.framer.frames),
+                            ("messages", self.messages),
+                            ("failures", self.failures + self.framer.malformed),
+                            ("crc_errors", self.framer.crc_errors),
+                            ("skipped", self.skipped),
+                            ("duplicates", self.duplicates),
+                            ("dropped_batches", self.dropped_batches),
+                            ("latency_s", self.latency.snapshot())])
+
+
+class Subscription:
+    # Async iterator over the messages of every station. A full queue makes
+    # the publishers wait, which in turn stops reading from the sockets,
+    # unless drop_oldest is set for subscribers that only want recent data.
+    def __init__(self, server, maxsize, drop_oldest):
+        self._server = server
+        self.queue = asyncio.Queue(maxsize)
+        self.drop_oldest = drop_oldest
+        self.dropped = 0
+
+    async def put(self, message):
+        if self.drop_oldest and self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+            self.queue.put_nowait(message)
+        else:
+            await self.queue.put(message)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+    def close(self):
+        self._server.unsubscribe(self)
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, addr):
+        self.server.datagram_received(data, addr)
+
+
+class IngestServer:
+    # Accepts demodulator output on any number of TCP, UDP and Unix sockets,
+    # frames it on the event loop and decodes batches of frames in an
+    # executor (the default thread pool, or a ProcessPoolExecutor for many
+    # stations). Messages of one connection are published in order. With a
+    # dedup.DuplicateCache, beacons another station already delivered are
+    # dropped before they are decoded. Radio frames failing the CC11xx CRC
+    # are dropped by the framer when check_crc is set. UDP stations idle for
+    # udp_idle_s are closed.
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, dispatcher=STATISTICS_DISPATCHER, executor=None, csp=False,
+                 trailer_size=CC11XX_CRC_SIZE, max_pending=MAX_PENDING_BATCHES, dedup=None,
+                 check_crc=True, udp_idle_s=UDP_IDLE_S):
+        self.dispatcher = dispatcher
+        self.dedup = dedup
+        self.executor = executor
+        self.csp = csp
+        self.trailer_size = trailer_size
+        self.check_crc = check_crc and trailer_size == CC11XX_CRC_SIZE
+        self.max_pending = max_pending
+        self.udp_idle_s = udp_idle_s
+        self.connections = OrderedDict()
+        self.closed_connections = deque(maxlen=CLOSED_CONNECTIONS)
+        self._subscribers = []
+        self._servers = []
+        self._transports = []
+        self._unix_connections = 0
+        self._udp_connections = {}
+        self._expiry = None
+
+    def _framer(self):
+        if self.csp:
+            return CspPacketFramer()
+        return RadioPacketFramer(trailer_size=self.trailer_size, check_crc=self.check_crc)
+
+    def subscribe(self, maxsize=SUBSCRIBER_QUEUE_SIZE, drop_oldest=False):
+        subscription = Subscription(self, maxsize, drop_oldest)
+        self._subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self._subscribers:
+            self._subscribers.remove(subscription)
+
+    async def start_tcp(self, host, port):
+        server = await asyncio.start_server(self._handle_stream, host, port)
+        self._servers.append(server)
+        return server
+
+    async def start_unix(self, path):
+        server = await asyncio.start_unix_server(self._handle_stream, path)
+        self._servers.append(server)
+        return server
+
+    async def start_udp(self, host, port):
+        transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _DatagramProtocol(self), local_addr=(host, port))
+        self._transports.append(transport)
+        if self._expiry is None:
+            self._expiry = asyncio.ensure_future(self._expire_udp())
+        return transport
+
+    def expire_idle(self, now=None):
+        # Closes the UDP stations that sent nothing for udp_idle_s and have
+        # no batch waiting. Their publisher finishes the batch it is on.
+        if now is None:
+            now = time.monotonic()
+        expired = [connection for connection in self._udp_connections.values()
+                   if now - connection.last_active > self.udp_idle_s and
+                   connection.pending.empty()]
+        for connection in expired:
+            del self._udp_connections[connection.station]
+            connection.pending.put_nowait(None)
+            if self.connections.pop(connection.station, None) is not None:
+                self.closed_connections.append((connection.station, connection.snapshot()))
+        return len(expired)
+
+    async def _expire_udp(self):
+        while True:
+            await asyncio.sleep(min(UDP_EXPIRY_INTERVAL_S, self.udp_idle_s))
+            self.expire_idle()
+
+    def _open(self, station, max_pending=None):
+        connection = Connection(station, self._framer(), max_pending or self.max_pending)
+        connection.publisher = asyncio.ensure_future(self._publish(connection))
+        self.connections[station] = connection
+        return connection
+
+    def _close(self, connection):
+        connection.publisher.cancel()
+        if self.connections.pop(connection.station, None) is not None:
+            self.closed_connections.append((connection.station, connection.snapshot()))
+
+    def _station_name(self, writer):
+        peer = writer.get_extra_info("peername")
+        if isinstance(peer, tuple):
+            return "tcp:%s:%d" % peer[:2]
+        self._unix_connections += 1
+        return "unix:%s#%d" % (writer.get_extra_info("sockname"), self._unix_connections)
+
+    def _decode(self, connection, chunk):
+        # Frames chunk and submits its complete frames, None when there are
+        # none
+        frames = [bytes(packet.get_bytes()) for packet in connection.framer.feed(chunk)]
+        if self.dedup is not None and frames:
+            unique = self.dedup.filter(frames, connection.station)
+            connection.duplicates += len(frames) - len(unique)
+            frames = unique
+        if not frames:
+            return None
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, decode_frames, frames, self.dispatcher, self.csp,
+            isinstance(self.executor, ProcessPoolExecutor))
+        return time.monotonic(), future
+
+    async def _handle_stream(self, reader, writer):
+        connection = self._open(self._station_name(writer))
+        try:
+            while True:
+                chunk = await reader.read(READ_SIZE)
+                if not chunk:
+                    break
+                batch = self._decode(connection, chunk)
+                if batch is not None:
+                    # Waits while max_pending batches are in flight
+                    await connection.pending.put(batch)
+            await connection.pending.put(None)
+            await connection.publisher
+        finally:
+            self._close(connection)
+            writer.close()
+
+    def datagram_received(self, data, addr):
+        # UDP has no flow control, batches beyond max_pending are dropped
+        station = "udp:%s:%d" % addr[:2]
+        connection = self._udp_connections.get(station)
+        if connection is None:
+            connection = self._udp_connections[station] = \
+                self._open(station, UDP_MAX_PENDING_BATCHES)
+        connection.last_active = time.monotonic()
+        batch = self._decode(connection, data)
+        if batch is None:
+            return
+        try:
+            connection.pending.put_nowait(batch)
+        except asyncio.QueueFull:
+            batch[1].cancel()
+            connection.dropped_batches += 1
+
+    async def _publish(self, connection):
+        while True:
+            batch = await connection.pending.get()
+            if batch is None:
+                return
+            received, future = batch
+            try:
+                messages, failures, skipped, metrics = await future
+            except asyncio.CancelledError:
+                raise
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Decoding a batch from %s failed", connection.station)
+                continue
+            connection.failures += failures
+            connection.skipped += skipped
+            if metrics:
+                METRICS.merge(metrics)
+            for message_class, message in messages:
+                ingested = IngestedMessage(connection.station, received, message_class, message)
+                for subscriber in list(self._subscribers):
+                    await subscriber.put(ingested)
+            connection.messages += len(messages)
+            now = time.monotonic()
+            connection.latency.update(now, now - received)
+
+    def snapshot(self):
+        return OrderedDict([
+            ("connections", OrderedDict((station, connection.snapshot())
+                                        for station, connection in self.connections.items())),
+            ("closed_connections", OrderedDict(self.closed_connections)),
+            ("subscribers", [OrderedDict([("queue_depth", subscriber.queue.qsize()),
+                                          ("dropped", subscriber.dropped)])
+                             for subscriber in self._subscribers]),
+            ("dedup", self.dedup.snapshot() if self.dedup is not None else None),
+            ("metrics", METRICS.snapshot() if METRICS.enabled else None)])
+
+    async def close(self):
+        if self._expiry is not None:
+            self._expiry.cancel()
+        self._udp_connections.clear()
+        for server in self._servers:
+            server.close()
+        for transport in self._transports:
+            transport.close()
+        for connection in list(self.connections.values()):
+            self._close(connection)
+        for server in self._servers:
+            await server.wait_closed()
+
+
+async def feed_frames(frames, host=None, port=None, path=None, chunk_size=4096, delay_s=0):
+    # Loopback feeder: streams frames as one TCP or Unix socket stream cut
+    # into chunks of chunk_size, so frames are split at arbitrary points
+    if path is not None:
+        _, writer = await asyncio.open_unix_connection(path)
+    else:
+        _, writer = await asyncio.open_connection(host, port)
+    data = b"".join(bytes(frame) for frame in frames)
+    for idx in range(0, len(data), chunk_size):
+        writer.write(data[idx:idx + chunk_size])
+        await writer.drain()
+        if delay_s:
+            await asyncio.sleep(delay_s)
+    writer.close()
+    await writer.wait_closed()
+
+
+async def loopback_test(frames, stations=1, executor=None, dedup=None):
+    # Feeds frames from stations concurrent connections to a server on the
+    # loopback interface and waits for all their messages, only one copy of
+    # each with dedup
+    server = IngestServer(executor=executor, dedup=dedup)
+    listener = await server.start_tcp("127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    subscription = server.subscribe()
+    start = time.perf_counter()
+    feeders = [asyncio.ensure_future(feed_frames(frames, "127.0.0.1", port))
+               for _ in range(stations)]
+    received = 0
+    while received < len(frames) * (1 if dedup is not None else stations):
+        await subscription.__anext__()
+        received += 1
+    seconds = time.perf_counter() - start
+    await asyncio.gather(*feeders)
+    snapshot = server.snapshot()
+    await server.close()
+    return received, seconds, snapshot
+
+
+def _address(text):
+    host, _, port = text.rpartition(":")
+    return host or "0.0.0.0", int(port)
+
+
+def _dedup(args):
+    if not args.dedup:
+        return None
+    return DuplicateCache(key=functools.partial(payload_key, offset=0) if args.csp else payload_key)
+
+
+def write_prometheus_file(path):
+    # Atomically, for the node exporter textfile collector
+    with open(path + ".tmp", "w") as metrics_file:
+        metrics_file.write(METRICS.prometheus_text())
+    os.replace(path + ".tmp", path)
+
+
+async def serve(args):
+    if args.prometheus:
+        METRICS.enable()
+    executor = None
+    if args.workers:
+        executor = ProcessPoolExecutor(args.workers, initializer=init_worker,
+                                       initargs=(bool(args.prometheus),
+                                                 active_calibration().profile))
+    server = IngestServer(executor=executor, csp=args.csp, trailer_size=args.trailer_size,
+                          dedup=_dedup(args), check_crc=args.check_crc,
+                          udp_idle_s=args.udp_idle_timeout)
+    for address in args.tcp:
+        await server.start_tcp(*_address(address))
+    for address in args.udp:
+        await server.start_udp(*_address(address))
+    for path in args.unix:
+        await server.start_unix(path)
+
+    async def report():
+        while True:
+            await asyncio.sleep(args.stats_interval)
+            sys.stderr.write(json.dumps(server.snapshot()) + "\n")
+            if args.prometheus:
+                write_prometheus_file(args.prometheus)
+
+    reporter = asyncio.ensure_future(report()) if args.stats_interval else None
+    try:
+        async for ingested in server.subscribe():
+            line = OrderedDict([("station", ingested.station),
+                                ("message", ingested.message_class.__name__)])
+            line.update(ingested.message)
+            sys.stdout.write(json.dumps(line, separators=(",", ":")) + "\n")
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+        await server.close()
+        if executor is not None:
+            executor.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Decode live demodulator output of many ground stations to NDJSON")
+    parser.add_argument("--tcp", action="append", default=[], metavar="[HOST]:PORT")
+    parser.add_argument("--udp", action="append", default=[], metavar="[HOST]:PORT")
+    parser.add_argument("--unix", action="append", default=[], metavar="PATH")
+    parser.add_argument("--csp", action="store_true",
+                        help="the streams carry CSP packets instead of radio frames")
+    parser.add_argument("--trailer-size", type=int, default=CC11XX_CRC_SIZE)
+    parser.add_argument("--no-crc-check", dest="check_crc", action="store_false",
+                        help="decode radio frames whatever their CC11xx CRC")
+    parser.add_argument("--udp-idle-timeout", type=float, default=UDP_IDLE_S, metavar="SECONDS",
+                        help="close UDP stations silent this long")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="decoding processes, threads of the event loop when 0")
+    parser.add_argument("--dedup", action="store_true",
+                        help="decode each beacon once however many stations receive it")
+    parser.add_argument("--calibration", metavar="FILE",
+                        help="JSON calibration profile for the ground unit conversions")
+    parser.add_argument("--stats-interval", type=float, default=10,
+                        help="seconds between connection statistics on stderr, 0 for none")
+    parser.add_argument("--prometheus", metavar="FILE",
+                        help="collect per stage metrics and write them to FILE in Prometheus "
+                             "text format every stats interval")
+    parser.add_argument("--loopback", type=int, metavar="FRAMES",
+                        help="feed synthetic frames over the loopback interface and report")
+    parser.add_argument("--stations", type=int, default=4,
+                        help="concurrent loopback connections")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    if args.calibration:
+        use_calibration(load_calibration_profile(args.calibration))
+    if args.loopback:
+        from .benchmark import synthetic_corpus  # pylint: disable=import-outside-toplevel
+        logging.disable(logging.ERROR)
+        frames = [bytes.fromhex(frame) for frame in synthetic_corpus(args.loopback)]
+        received, seconds, snapshot = asyncio.run(loopback_test(frames, args.stations,
+                                                                 dedup=_dedup(args)))
+        print(json.dumps(snapshot, indent=1))
+        print("%d messages from %d stations in %.2f s (%.0f messages/s)" % (
+            received, args.stations, seconds, received / seconds))
+        return 0
+    if not (args.tcp or args.udp or args.unix):
+        parser.error("nothing to listen on, give --tcp, --udp or --unix")
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+import bisect
+from collections import OrderedDict
+import functools
+import time
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS_S = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3,
+                     1e-2, 1e-1, 1.0)
+PROMETHEUS_PREFIX = "rhw_telemetry"
+
+
+class Histogram:
+    def __init__(self, bounds=LATENCY_BUCKETS_S):
+        self.bounds = bounds
+        # The last bucket counts the values above every bound
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class StageMetrics:
+    # Counters of one pipeline stage. Updates from several threads can race
+    # and lose an increment now and then, which is fine for monitoring.
+    __slots__ = ("calls", "errors", "skipped", "bytes_in", "bytes_out", "latency")
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.calls = 0
+        self.errors = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = Histogram()
+
+    def observe(self, seconds, bytes_in=0, bytes_out=0):
+        self.calls += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.latency.observe(seconds)
+
+    def snapshot(self):
+        return OrderedDict([("calls", self.calls), ("errors", self.errors),
+                            ("skipped", self.skipped), ("bytes_in", self.bytes_in),
+                            ("bytes_out", self.bytes_out),
+                            ("latency_sum_s", self.latency.sum),
+                            ("latency_buckets", list(self.latency.counts))])
+
+    def merge(self, snapshot):
+        self.calls += snapshot["calls"]
+        self.errors += snapshot["errors"]
+        self.skipped += snapshot["skipped"]
+        self.bytes_in += snapshot["bytes_in"]
+        self.bytes_out += snapshot["bytes_out"]
+        self.latency.sum += snapshot["latency_sum_s"]
+        for idx, count in enumerate(snapshot["latency_buckets"]):
+            self.latency.counts[idx] += count
+
+
+def _timed(function, stage, bytes_in, bytes_out, skipped):
+    perf_counter = time.perf_counter
+
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        start = perf_counter()
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            stage.errors += 1
+            raise
+        stage.observe(perf_counter() - start, bytes_in(args) if bytes_in else 0,
+                      bytes_out(result) if bytes_out else 0)
+        if skipped is not None and skipped(result):
+            stage.skipped += 1
+        return result
+    return timed
+
+
+class Metrics:
+    # Per stage counters and latency histograms of the decode pipeline.
+    # Functions and methods are registered with instrument() and only
+    # replaced by timed wrappers while the metrics are enabled, so disabled
+    # instrumentation costs nothing. Call sites that update stages directly
+    # check enabled first.
+    def __init__(self):
+        self.enabled = False
+        self.stages = OrderedDict()
+        self._patches = []
+
+    def stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageMetrics()
+        return stage
+
+    def instrument(self, owner, attribute, stage_name, bytes_in=None, bytes_out=None,
+                   skipped=None):
+        # Times owner.attribute (a function, classmethod or staticmethod of a
+        # class or module) as stage_name. bytes_in gets the call arguments,
+        # bytes_out and skipped the result. Only calls through owner are
+        # seen, not references imported before enabling.
+        original = vars(owner)[attribute]
+        stage = self.stage(stage_name)
+        if isinstance(original, (classmethod, staticmethod)):
+            instrumented = type(original)(_timed(original.__func__, stage, bytes_in, bytes_out,
+                                                 skipped))
+        else:
+            instrumented = _timed(original, stage, bytes_in, bytes_out, skipped)
+        self._patches.append((owner, attribute, original, instrumented))
+        if self.enabled:
+            setattr(owner, attribute, instrumented)
+
+    def enable(self):
+        for owner, attribute, _, instrumented in self._patches:
+            setattr(owner, attribute, instrumented)
+        self.enabled = True
+
+    def disable(self):
+        for owner, attribute, original, _ in self._patches:
+            setattr(owner, attribute, original)
+        self.enabled = False
+
+    def reset(self):
+        for stage in self.stages.values():
+            stage.clear()
+
+    def snapshot(self):
+        return OrderedDict((name, stage.snapshot()) for name, stage in self.stages.items())
+
+    def merge(self, snapshot):
+        # Adds the snapshot of another process, e.g. a decoding worker
+        for name, stage_snapshot in snapshot.items():
+            self.stage(name).merge(stage_snapshot)
+
+    def prometheus_text(self, prefix=PROMETHEUS_PREFIX):
+        lines = []
+        counters = ("calls", "errors", "skipped", "bytes_in", "bytes_out")
+        for counter in counters:
+            name = "%s_stage_%s_total" % (prefix, counter)
+            lines.append("# TYPE %s counter" % name)
+            for stage_name, stage in self.stages.items():
+                lines.append('%s{stage="%s"} %d' % (name, stage_name, getattr(stage, counter)))
+        name = "%s_stage_latency_seconds" % prefix
+        lines.append("# TYPE %s histogram" % name)
+        for stage_name, stage in self.stages.items():
+            cumulative = 0
+            for bound, count in zip(stage.latency.bounds + (float("inf"),),
+                                    stage.latency.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('%s_bucket{stage="%s",le="%s"} %d' % (name, stage_name, le,
+                                                                   cumulative))
+            lines.append('%s_sum{stage="%s"} %r' % (name, stage_name, stage.latency.sum))
+            lines.append('%s_count{stage="%s"} %d' % (name, stage_name, cumulative))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
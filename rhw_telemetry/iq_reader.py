@@ -0,0 +1,226 @@
+import argparse
+from collections import namedtuple
+import mmap
+import os
+import sys
+import time
+
+import numpy as np
+
+from .fsk_demodulator import low_pass_taps, SAMPLE_RATE, SYMBOL_RATE, DEVIATION_HZ
+
+CHUNK_SAMPLES = 1 << 16
+# Headerless interleaved I/Q sample formats: the stored type and the offset
+# and scale taking a component to about -1..1. cf32 is what GNU Radio file
+# sinks and rhw_telemetry_samples hold, ci16 and ci8 come from most SDR
+# tools and cu8 from rtl_sdr.
+SampleFormat = namedtuple("SampleFormat", ["dtype", "offset", "scale"])
+SAMPLE_FORMATS = {
+    "cf32": SampleFormat(np.dtype(np.float32), 0.0, 1.0),
+    "ci16": SampleFormat(np.dtype(np.int16), 0.0, 1 / 32768),
+    "ci8": SampleFormat(np.dtype(np.int8), 0.0, 1 / 128),
+    "cu8": SampleFormat(np.dtype(np.uint8), -127.5, 1 / 127.5),
+}
+# Sample format name and sample rate of a recording, written cf32:96000
+IqFormat = namedtuple("IqFormat", ["sample_format", "sample_rate"])
+DEFAULT_FORMAT = IqFormat("cf32", SAMPLE_RATE)
+# One sided bandwidth of the FSK signal: the tones and the first sidebands
+FSK_BANDWIDTH_HZ = DEVIATION_HZ + SYMBOL_RATE
+# Filter taps per polyphase branch, and the part of the output band kept
+# flat. Above it the filter rolls off into the aliased band.
+DECIMATION_TAPS_PER_PHASE = 16
+DECIMATION_PASSBAND = 0.8
+# The discriminator and matched filter of the demodulator lose sensitivity
+# with fewer samples per symbol than at the 96 kHz it was tuned at
+MIN_SAMPLES_PER_SYMBOL = 10
+
+
+def parse_iq_format(text):
+    name, _, rate = text.partition(":")
+    if name not in SAMPLE_FORMATS:
+        raise ValueError("Unknown sample format %r, one of %s" % (name, ", ".join(SAMPLE_FORMATS)))
+    return IqFormat(name, float(rate) if rate else DEFAULT_FORMAT.sample_rate)
+
+
+def chunk_ranges(num_samples, chunk_samples=CHUNK_SAMPLES, overlap=0, start=0):
+    # Every chunk is read overlap samples past its end, so a frame whose
+    # sync word starts inside the chunk is always complete in it
+    for chunk_start in range(start, num_samples, chunk_samples):
+        yield chunk_start, min(chunk_start + chunk_samples + overlap, num_samples)
+
+
+class IqRecording:
+    # A raw IQ file mapped into memory. cf32 samples are handed out as views
+    # of the mapping without a copy, other formats are converted a chunk at
+    # a time. The pages of the file are read on first access, so only the
+    # chunks in use take memory.
+    def __init__(self, path, iq_format=DEFAULT_FORMAT):
+        self.path = path
+        self.iq_format = iq_format
+        self.sample_rate = iq_format.sample_rate
+        self._format = SAMPLE_FORMATS[iq_format.sample_format]
+        self._sample_size = 2 * self._format.dtype.itemsize
+        self._mapped = None
+        self._raw = np.zeros((0, 2), dtype=self._format.dtype)
+        if os.path.getsize(path) >= self._sample_size:
+            with open(path, "rb") as recording:
+                self._mapped = mmap.mmap(recording.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                self._mapped.madvise(mmap.MADV_SEQUENTIAL)
+            count = len(self._mapped) // self._sample_size
+            self._raw = np.frombuffer(self._mapped, dtype=self._format.dtype,
+                                      count=2 * count).reshape(count, 2)
+        self.num_samples = len(self._raw)
+        self._released = 0
+
+    @property
+    def duration_s(self):
+        return self.num_samples / self.sample_rate
+
+    def samples(self, start=0, stop=None):
+        raw = self._raw[start:stop]
+        if self.iq_format.sample_format == "cf32":
+            return raw.view(np.complex64)[:, 0]
+        samples = raw.astype(np.float32)
+        if self._format.offset:
+            samples += self._format.offset
+        samples *= self._format.scale
+        return samples.view(np.complex64)[:, 0]
+
+    def release(self, stop):
+        # Drops the pages before sample stop from memory. They are read from
+        # the file again if a view of them is still used.
+        end = stop * self._sample_size // mmap.PAGESIZE * mmap.PAGESIZE
+        if self._mapped is not None and end > self._released and hasattr(mmap, "MADV_DONTNEED"):
+            self._mapped.madvise(mmap.MADV_DONTNEED, self._released, end - self._released)
+            self._released = end
+
+    def chunks(self, chunk_samples=CHUNK_SAMPLES, overlap=0, start=0, release=True):
+        # Chunks of chunk_samples, each overlap samples longer so consecutive
+        # ones share that many samples. With release the samples behind a
+        # chunk are dropped from memory, keeping the memory use of a pass
+        # over a large file bounded.
+        for chunk_start, chunk_stop in chunk_ranges(self.num_samples, chunk_samples, overlap,
+                                                    start):
+            if release:
+                self.release(chunk_start)
+            yield self.samples(chunk_start, chunk_stop)
+
+
+def decimation_taps(factor, num_taps=None):
+    num_taps = num_taps or DECIMATION_TAPS_PER_PHASE * factor
+    return low_pass_taps(1.0, DECIMATION_PASSBAND / (2 * factor), num_taps)
+
+
+def decimation_factor(sample_rate, bandwidth_hz=FSK_BANDWIDTH_HZ, symbol_rate=SYMBOL_RATE):
+    # Largest factor whose output band still passes bandwidth_hz on both
+    # sides and leaves the demodulator MIN_SAMPLES_PER_SYMBOL. Factors
+    # leaving a whole number of samples per symbol are preferred, the
+    # matched filter works best with them.
+    samples_per_symbol = sample_rate / symbol_rate
+    largest = max(1, min(int(sample_rate * DECIMATION_PASSBAND / (2 * bandwidth_hz)),
+                         int(samples_per_symbol / MIN_SAMPLES_PER_SYMBOL)))
+    for factor in range(largest, 0, -1):
+        if (samples_per_symbol / factor).is_integer():
+            return factor
+    return largest
+
+
+class PolyphaseDecimator:
+    # Low pass filter and keep every factor-th sample. Each of the factor
+    # branches filters only the input samples it needs, so the work is one
+    # filter length per output sample. The last samples of a chunk stay in
+    # the filter, so chunks of any size give the same output as a single
+    # one, output n being input sample n * factor filtered.
+    def __init__(self, factor, taps=None):
+        self.factor = factor
+        taps = decimation_taps(factor) if taps is None else np.asarray(taps, dtype=np.float32)
+        # Zero padding to whole branches
+        self._num_taps = len(taps)
+        self._branch_taps = -(-len(taps) // factor)
+        padded = np.zeros(self._branch_taps * factor, dtype=np.float32)
+        padded[:len(taps)] = taps
+        self._branches = [padded[branch::factor] for branch in range(factor)]
+        self._history = np.zeros(len(padded) - 1, dtype=np.complex64)
+        # Input samples to skip before the next output
+        self._phase = 0
+
+    @property
+    def delay(self):
+        # Input samples to run through the filter before it is settled
+        return len(self._history) + 1
+
+    @property
+    def group_delay(self):
+        # Input samples the linear phase filter delays its output by
+        return (self._num_taps - 1) / 2
+
+    def process(self, samples):
+        samples = np.asarray(samples, dtype=np.complex64)
+        factor = self.factor
+        padded = np.concatenate((self._history, samples))
+        first = len(self._history) + self._phase
+        count = max(0, -(-(len(padded) - first) // factor))
+        out = np.zeros(count, dtype=np.complex64)
+        if count:
+            for branch, taps in enumerate(self._branches):
+                begin = factor - 1 - branch + self._phase
+                inputs = padded[begin::factor][:count + self._branch_taps - 1]
+                out += np.convolve(inputs, taps, "valid")
+        self._phase = first + count * factor - len(padded)
+        if len(self._history):
+            self._history = padded[len(padded) - len(self._history):]
+        return out
+
+
+def iq_stream(path, iq_format=DEFAULT_FORMAT, chunk_samples=CHUNK_SAMPLES, decimation=1):
+    # Complex64 chunks of a recording, decimated by decimation to the rate
+    # iq_format.sample_rate / decimation
+    recording = IqRecording(path, iq_format)
+    decimator = PolyphaseDecimator(decimation) if decimation > 1 else None
+    for chunk in recording.chunks(chunk_samples):
+        yield decimator.process(chunk) if decimator else chunk
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert a raw IQ recording to complex64 at a lower rate that keeps only "
+                    "the band of the FSK beacons")
+    parser.add_argument("recording")
+    parser.add_argument("--format", type=parse_iq_format, default=DEFAULT_FORMAT,
+                        metavar="FORMAT[:RATE]",
+                        help="sample format (%s) and rate, default cf32:%d" %
+                        (", ".join(SAMPLE_FORMATS), SAMPLE_RATE))
+    parser.add_argument("--decimation", default="auto",
+                        help="decimation factor, or auto for the largest that keeps the band")
+    parser.add_argument("--bandwidth", type=float, default=FSK_BANDWIDTH_HZ,
+                        help="one sided Hz kept by auto decimation, add the Doppler shift of "
+                             "an uncorrected pass")
+    parser.add_argument("--chunk-samples", type=int, default=CHUNK_SAMPLES)
+    parser.add_argument("--output", "-o", help="complex64 output file, stdout by default")
+    args = parser.parse_args(argv)
+
+    if args.decimation == "auto":
+        decimation = decimation_factor(args.format.sample_rate, args.bandwidth)
+    else:
+        decimation = int(args.decimation)
+    started = time.perf_counter()
+    samples_out = 0
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in iq_stream(args.recording, args.format, args.chunk_samples, decimation):
+            output.write(chunk.tobytes())
+            samples_out += len(chunk)
+    finally:
+        if args.output:
+            output.close()
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    size = os.path.getsize(args.recording)
+    sys.stderr.write("%d samples at %g Hz (decimation %d), read %.1f MB/s\n" %
+                     (samples_out, args.format.sample_rate / decimation, decimation,
+                      size / elapsed / 1e6))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
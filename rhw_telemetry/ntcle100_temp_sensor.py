@@ -17,9 +17,10 @@ R_REF = 100000
 
 
 def resistance_to_celsius(resistance):
-    temp = 1 / (A_1 + B_1 * math.log(resistance / R_REF) +
-                C_1 * math.pow(math.log(resistance / R_REF), 2) +
-                D_1 * math.pow(math.log(resistance / R_REF), 3))
+    log_ratio = math.log(resistance / R_REF)
+    temp = 1 / (A_1 + B_1 * log_ratio +
+                C_1 * math.pow(log_ratio, 2) +
+                D_1 * math.pow(log_ratio, 3))
     return temp - 273
 
 
@@ -0,0 +1,145 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import logging
+
+from .fsk_demodulator import FskDemodulator, SAMPLE_RATE, SYMBOL_RATE, SYNC_WORD_BITS, \
+    CRC_SIZE, CHANNEL_FILTER_TAPS
+from .hex_decoder import decode_statistics_frame
+from .iq_reader import IqRecording, IqFormat, PolyphaseDecimator, chunk_ranges
+
+CHUNK_SAMPLES = 1 << 22
+PROCESS_SAMPLES = 1 << 16
+# Longest frame: sync word, length byte, 255 byte packet and the CRC, plus
+# the filter delays
+MAX_FRAME_SYMBOLS = SYNC_WORD_BITS + 8 * (1 + 255 + CRC_SIZE) + 16
+MAX_FRAME_SAMPLES = int(MAX_FRAME_SYMBOLS * SAMPLE_RATE / SYMBOL_RATE) + CHANNEL_FILTER_TAPS
+# A frame found by two chunks starts at (nearly) the same sample
+DUPLICATE_TOLERANCE_SAMPLES = int(SAMPLE_RATE / SYMBOL_RATE)
+
+DecodedPacket = namedtuple("DecodedPacket", ["sample_index", "time_s", "message_class",
+                                             "message", "data", "bit_flips"], defaults=(0,))
+ChunkResult = namedtuple("ChunkResult", ["start", "stop", "packets", "frames", "failures",
+                                         "crc_errors"])
+
+_recording = None
+
+
+def max_frame_samples(sample_rate, decimation=1):
+    # MAX_FRAME_SAMPLES of a recording at sample_rate, the channel filter
+    # running after decimation and the decimation filter delaying too
+    delay = PolyphaseDecimator(decimation).delay if decimation > 1 else 0
+    return (int(MAX_FRAME_SYMBOLS * sample_rate / SYMBOL_RATE) +
+            CHANNEL_FILTER_TAPS * decimation + delay)
+
+
+def _open_recording(path, iq_format):
+    global _recording  # pylint: disable=global-statement
+    _recording = IqRecording(path, iq_format)
+
+
+def _prime(decimator, start):
+    # Runs the samples before start through the decimator, so its output
+    # from start on is settled and output n is sample start + n * factor
+    factor = decimator.factor
+    length = -(-decimator.delay // factor) * factor
+    if length > start:
+        length = start - start % factor
+    decimator.process(_recording.samples(start - length, start))
+
+
+def decimation_delay(sample_rate, decimation):
+    # Samples the decimation filter, and the demodulator filters running at
+    # the lower rate, delay the frame positions by beyond the delay of an
+    # undecimated decode, so that positions match whatever the decimation
+    if decimation == 1:
+        return 0
+    decimated = FskDemodulator(sample_rate=sample_rate / decimation).group_delay
+    delay = PolyphaseDecimator(decimation).group_delay + decimated * decimation - \
+        FskDemodulator(sample_rate=sample_rate).group_delay
+    return int(round(delay))
+
+
+# pylint: disable=too-many-arguments
+def decode_chunk(start, stop, sample_rate=SAMPLE_RATE, check_crc=True, doppler=None,
+                 decimation=1, max_flips=0):
+    # Frames failing the CRC check are dropped by the demodulator, before any
+    # CSP parsing, unless recovered from up to max_flips bit errors. With a
+    # DopplerCurve of the pass the chunk is derotated first, the curve being
+    # indexed from the chunk start. Decimation runs before both.
+    rate = sample_rate / decimation
+    delay = decimation_delay(sample_rate, decimation)
+    decimator = None
+    if decimation > 1:
+        decimator = PolyphaseDecimator(decimation)
+        _prime(decimator, start)
+    if doppler is None:
+        demodulator = FskDemodulator(sample_rate=rate, check_crc=check_crc,
+                                     max_flips=max_flips)
+    else:
+        # pylint: disable=import-outside-toplevel
+        from .doppler import DopplerCorrector, PassDemodulator
+        demodulator = PassDemodulator(DopplerCorrector(doppler, rate,
+                                                       first_sample=start / decimation),
+                                      check_crc=check_crc, max_flips=max_flips)
+    packets = []
+    frames = 0
+    failures = 0
+    for idx in range(start, stop, PROCESS_SAMPLES):
+        samples = _recording.samples(idx, min(idx + PROCESS_SAMPLES, stop))
+        if decimator is not None:
+            samples = decimator.process(samples)
+        for frame in demodulator.process(samples):
+            frames += 1
+            sample_index = start + frame.sample_index * decimation - delay
+            try:
+                message_class, message = decode_statistics_frame(frame.data)
+            except ValueError as error:
+                logging.debug("Undecodable frame at sample %d: %s", sample_index, error)
+                failures += 1
+                continue
+            packets.append(DecodedPacket(sample_index, sample_index / sample_rate,
+                                         message_class, message, frame.data,
+                                         frame.bit_flips))
+    return ChunkResult(start, stop, packets, frames, failures, demodulator.crc_errors)
+
+
+def _is_duplicate(packet, previous, tolerance):
+    return (packet.data == previous.data and
+            abs(packet.sample_index - previous.sample_index) <= tolerance)
+
+
+def merge_chunk_results(results, frame_samples=MAX_FRAME_SAMPLES,
+                        tolerance=DUPLICATE_TOLERANCE_SAMPLES):
+    # Chunks arrive in order, and only the packets in the overlap with the
+    # previous chunk can be duplicates
+    previous = []
+    for result in results:
+        for packet in result.packets:
+            if any(_is_duplicate(packet, seen, tolerance) for seen in previous):
+                continue
+            yield packet
+        previous = [packet for packet in result.packets
+                    if packet.sample_index >= result.stop - 2 * frame_samples]
+
+
+def decode_recording(path, workers=None, chunk_samples=CHUNK_SAMPLES, sample_rate=SAMPLE_RATE,
+                     check_crc=True, doppler=None, iq_format=None, decimation=1,
+                     max_flips=0):
+    # iq_format describes a recording other than complex64 at sample_rate,
+    # whose rate it then overrides
+    iq_format = iq_format or IqFormat("cf32", sample_rate)
+    sample_rate = iq_format.sample_rate
+    frame_samples = max_frame_samples(sample_rate, decimation)
+    num_samples = IqRecording(path, iq_format).num_samples
+    ranges = list(chunk_ranges(num_samples, chunk_samples, frame_samples))
+    if not ranges:
+        return
+    starts, stops = zip(*ranges)
+    count = len(ranges)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_open_recording,
+                             initargs=(path, iq_format)) as pool:
+        results = pool.map(decode_chunk, starts, stops, [sample_rate] * count,
+                           [check_crc] * count, [doppler] * count, [decimation] * count,
+                           [max_flips] * count)
+        yield from merge_chunk_results(results, frame_samples,
+                                       int(sample_rate / SYMBOL_RATE))
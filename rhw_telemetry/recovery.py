@@ -0,0 +1,133 @@
+from collections import OrderedDict
+
+import numpy as np
+
+from .batch_decoder import decode_csp_headers, dispatch_columns, fixed_size_frames, select_csp
+from .cc11xx import crc16_flip_candidates, flip_bits, CRC16_SIZE
+from .hex_decoder import ADCData, EpsStatisticsMessage, UhfStatisticsMessage, PowerLevelsBits, \
+    STATISTICS_DISPATCHER, LENGTH_HEADER_SIZE, RADIO_FRAME_CSP_OFFSET, HEADER_PLUS_LENGTH_SIZE, \
+    COUNTER_SIZE_BYTES, CMAC_SIZE_BYTES
+from .telemetry_unit_conversions import ADC_MAX_VALUE
+
+MAX_FLIPS = 2
+# A double flip shares its CRC syndrome with several other pairs, telling
+# the right one apart takes more checkable fields than UHF beacons have
+MESSAGE_MAX_FLIPS = {EpsStatisticsMessage: 2, UhfStatisticsMessage: 1}
+# Frames searched together, bounding the candidate arrays
+RECOVERY_BATCH = 1024
+# The length byte sizes the frame, with a flip there it would be the wrong
+# length whatever the CRC says
+FIRST_RECOVERABLE_BIT = 8 * LENGTH_HEADER_SIZE
+MESSAGE_OFFSET = RADIO_FRAME_CSP_OFFSET + HEADER_PLUS_LENGTH_SIZE
+SIGNATURE_SIZE = COUNTER_SIZE_BYTES + CMAC_SIZE_BYTES
+# Beacons go to the ground station node without CSP options
+BEACON_CSP_ADDRESS = {"dst": 16, "reserved": 0, "hmac": 0, "xtea": 0, "rdp": 0, "crc": 0}
+# Operating limits of the parts with margin, degrees C
+INTERNAL_TEMP_RANGE = (-60, 125)
+POWER_LEVELS_MAX = (1 << len(PowerLevelsBits._fields_)) - 1
+# Inclusive ranges of the raw field values that can be checked. The
+# timestamp can't, beacons sent before the clock is set carry any value.
+PLAUSIBLE_RANGES = {
+    EpsStatisticsMessage: OrderedDict(
+        [("adc_statistics." + name, (0, ADC_MAX_VALUE)) for name, _ in ADCData._fields_] +
+        [("eps_statistics.memory_violation_reset_has_occured", (0, 1)),
+         ("eps_statistics.internal_temp", INTERNAL_TEMP_RANGE),
+         ("power_statistics.target_power_levels.raw", (0, POWER_LEVELS_MAX)),
+         ("power_statistics.actual_power_levels.raw", (0, POWER_LEVELS_MAX))]),
+    UhfStatisticsMessage: OrderedDict([
+        # Boot reasons are a single byte on the EPS
+        ("uhf_statistics.last_boot_reason", (0, 0xFF)),
+        ("uhf_statistics.memory_violation_reset_has_occured", (0, 1)),
+        ("uhf_statistics.internal_temp", INTERNAL_TEMP_RANGE)]),
+}
+# Fields that can't exceed another one
+PLAUSIBLE_ORDER = {
+    EpsStatisticsMessage: [("eps_statistics.uptime_s", "eps_statistics.total_uptime_s"),
+                           ("eps_statistics.periodic_boot_count", "eps_statistics.boot_count")],
+}
+
+
+def plausible_columns(message_class, columns):
+    # Boolean array of the messages whose decoded columns are in range
+    plausible = np.ones(len(next(iter(columns.values()))), dtype=bool)
+    for name, (low, high) in PLAUSIBLE_RANGES.get(message_class, {}).items():
+        column = columns[name]
+        if column.dtype == bool:
+            # Any byte other than 0 and 1 reads as True
+            column = column.view(np.uint8)
+        plausible &= (column >= low) & (column <= high)
+    for lower, upper in PLAUSIBLE_ORDER.get(message_class, ()):
+        plausible &= columns[lower] <= columns[upper]
+    return plausible
+
+
+def plausible_frames(buffer, frame_size, dispatcher=STATISTICS_DISPATCHER):
+    # For the frames of frame_size bytes, CRC included, stored back to back
+    # in buffer, the most flips their message class may be recovered from,
+    # 0 for frames that are not beacons with plausible values. Those have a
+    # beacon CSP header, a length field that leaves room for nothing but the
+    # signature, a registered message and fields in range.
+    offsets, lengths = fixed_size_frames(buffer, frame_size)
+    headers = decode_csp_headers(buffer, offsets, lengths)
+    selection = select_csp(headers, **BEACON_CSP_ADDRESS)
+    trailer = frame_size - CRC16_SIZE - MESSAGE_OFFSET - headers["length"].astype(np.int64)
+    selection &= (trailer == 0) | (trailer == SIGNATURE_SIZE)
+    max_flips = np.zeros(len(offsets), dtype=np.int64)
+    for message_class, (indices, columns) in dispatch_columns(buffer, headers, selection,
+                                                              dispatcher).items():
+        max_flips[indices] = (plausible_columns(message_class, columns) *
+                              MESSAGE_MAX_FLIPS.get(message_class, 1))
+    return max_flips
+
+
+def recover_rows(rows, max_flips=MAX_FLIPS, dispatcher=STATISTICS_DISPATCHER):
+    # Recovers the frames in the rows of a 2-D uint8 array, all failing the
+    # CRC, by flipping at most max_flips bits. Returns the rows with the
+    # recovered frames corrected and the number of flips per row, 0 when no
+    # candidate or more than one passes the plausibility checks.
+    candidate_rows, first, second = crc16_flip_candidates(rows, max_flips,
+                                                          FIRST_RECOVERABLE_BIT)
+    candidates = flip_bits(rows, candidate_rows, first, second)
+    candidate_flips = 1 + (second >= 0)
+    plausible = candidate_flips <= plausible_frames(candidates.tobytes(), rows.shape[1],
+                                                    dispatcher)
+    unique = np.bincount(candidate_rows[plausible], minlength=len(rows)) == 1
+    chosen = np.flatnonzero(plausible & unique[candidate_rows])
+    recovered = rows.copy()
+    recovered[candidate_rows[chosen]] = candidates[chosen]
+    flips = np.zeros(len(rows), dtype=np.int64)
+    flips[candidate_rows[chosen]] = candidate_flips[chosen]
+    return recovered, flips
+
+
+def recoverable_lengths(dispatcher=STATISTICS_DISPATCHER):
+    # Sizes of the frames, CRC included, that can carry a registered message
+    return {MESSAGE_OFFSET + size + trailer + CRC16_SIZE
+            for size in dispatcher.payload_sizes() for trailer in (0, SIGNATURE_SIZE)}
+
+
+def recover_frames(frames, max_flips=MAX_FLIPS, dispatcher=STATISTICS_DISPATCHER):
+    # recover_rows for frames of any length, a list of (frame, flips) with
+    # frame None for those that can't be recovered. Frames of the same
+    # length are searched together, those of no message's length are left
+    # out without a search, as the framer hands over many when resyncing.
+    results = [(None, 0)] * len(frames)
+    by_length = OrderedDict()
+    lengths = recoverable_lengths(dispatcher)
+    for idx, frame in enumerate(frames):
+        if len(frame) in lengths:
+            by_length.setdefault(len(frame), []).append(idx)
+    for length, indices in by_length.items():
+        for start in range(0, len(indices), RECOVERY_BATCH):
+            batch = indices[start:start + RECOVERY_BATCH]
+            rows = np.frombuffer(b"".join(frames[idx] for idx in batch),
+                                 dtype=np.uint8).reshape(len(batch), length)
+            recovered, flips = recover_rows(rows, max_flips, dispatcher)
+            for idx, row, count in zip(batch, recovered, flips.tolist()):
+                if count:
+                    results[idx] = (row.tobytes(), count)
+    return results
+
+
+def recover_frame(frame, max_flips=MAX_FLIPS, dispatcher=STATISTICS_DISPATCHER):
+    return recover_frames([frame], max_flips, dispatcher)[0]
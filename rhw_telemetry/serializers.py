@@ -0,0 +1,148 @@
+from ctypes import c_bool, c_float, c_double
+import functools
+import json
+import time
+
+from .hex_decoder import compile_message_function, message_tree, message_value_expressions
+from .instrumentation import METRICS
+
+BATCH_SIZE = 1024
+JSON_BOOLS = {False: "false", True: "true"}
+# Lines and bytes written, the latency is that of each batched stream write
+_OUTPUT = METRICS.stage("output")
+
+
+def _placeholder(field):
+    if field.ctype is c_bool:
+        return "%s"
+    if field.ctype in (c_float, c_double):
+        return "%r"
+    return "%d"
+
+
+def _argument(field, expression):
+    if field.ctype is c_bool:
+        return "json_bools[%s]" % expression
+    return expression
+
+
+def _arguments(message_class):
+    return [_argument(field, expression)
+            for field, expressions in message_value_expressions(message_class)[2]
+            for expression in expressions]
+
+
+def _json_template(tree):
+    if all(isinstance(key, int) for key in tree):
+        return "[%s]" % ",".join(_json_template(tree[key]) if isinstance(tree[key], dict)
+                                 else tree[key] for key in sorted(tree))
+    return "{%s}" % ",".join("%s:%s" % (json.dumps(key).replace("%", "%%"),
+                                        _json_template(value) if isinstance(value, dict)
+                                        else value) for key, value in tree.items())
+
+
+def _compile_formatter(message_class, name, template):
+    expression = "%r %% (%s,)" % (template, ", ".join(_arguments(message_class)))
+    return compile_message_function(message_class, name, expression,
+                                    {"json_bools": JSON_BOOLS})
+
+
+# Generated function turning the bytes of one message into a compact JSON
+# line, the same text as json.dumps(message_class.decode(buffer),
+# separators=(",", ":")) but formatted straight from the unpacked values
+@functools.lru_cache(maxsize=None)
+def compile_ndjson_formatter(message_class):
+    tree = message_tree(message_class, lambda field, expressions: "[%s]" % ",".join(
+        [_placeholder(field)] * len(expressions)) if field.shape else _placeholder(field))
+    return _compile_formatter(message_class, "format_ndjson", _json_template(tree) + "\n")
+
+
+def csv_header(message_class):
+    names = []
+    for field, expressions in message_value_expressions(message_class)[2]:
+        name = ".".join(str(key) for key in field.path)
+        if field.shape:
+            names.extend("%s.%d" % (name, idx) for idx in range(len(expressions)))
+        else:
+            names.append(name)
+    return names
+
+
+@functools.lru_cache(maxsize=None)
+def compile_csv_formatter(message_class):
+    template = ",".join(_placeholder(field)
+                        for field, expressions in message_value_expressions(message_class)[2]
+                        for _ in expressions)
+    return _compile_formatter(message_class, "format_csv", template + "\n")
+
+
+class _StreamingWriter:
+    # Writes the lines of messages given as bytes-like objects (or the
+    # MessageData instances themselves) to a text stream in batches
+    def __init__(self, stream, message_class, batch_size=BATCH_SIZE):
+        self.stream = stream
+        self.message_class = message_class
+        self.batch_size = batch_size
+        self.messages = 0
+        self._format = self._formatter(message_class)
+        self._pending = []
+
+    def _formatter(self, message_class):
+        raise NotImplementedError()
+
+    def _write_pending(self):
+        if self._pending:
+            text = "".join(self._pending)
+            if METRICS.enabled:
+                start = time.perf_counter()
+                self.stream.write(text)
+                _OUTPUT.latency.observe(time.perf_counter() - start)
+                _OUTPUT.calls += len(self._pending)
+                _OUTPUT.bytes_out += len(text)
+            else:
+                self.stream.write(text)
+            self._pending.clear()
+
+    def write(self, message):
+        self._pending.append(self._format(message))
+        self.messages += 1
+        if len(self._pending) >= self.batch_size:
+            self._write_pending()
+
+    def write_all(self, messages):
+        pending = self._pending
+        format_message = self._format
+        batch_size = self.batch_size
+        count = 0
+        for message in messages:
+            pending.append(format_message(message))
+            count += 1
+            if len(pending) >= batch_size:
+                self._write_pending()
+        self.messages += count
+        self.flush()
+
+    def flush(self):
+        self._write_pending()
+        self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+
+class NdjsonWriter(_StreamingWriter):
+    def _formatter(self, message_class):
+        return compile_ndjson_formatter(message_class)
+
+
+class CsvWriter(_StreamingWriter):
+    def __init__(self, stream, message_class, batch_size=BATCH_SIZE, header=True):
+        super().__init__(stream, message_class, batch_size)
+        if header:
+            self._pending.append(",".join(csv_header(message_class)) + "\n")
+
+    def _formatter(self, message_class):
+        return compile_csv_formatter(message_class)
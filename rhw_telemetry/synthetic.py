@@ -0,0 +1,439 @@
+import argparse
+from ctypes import sizeof
+import struct
+import sys
+import time
+
+import numpy as np
+
+from .batch_decoder import message_dtype
+from .cc11xx import crc16_rows, whiten
+from .fsk_demodulator import SAMPLE_RATE, SYMBOL_RATE, DEVIATION_HZ, SYNC_WORD, \
+    SYNC_WORD_BITS, CRC_SIZE
+from .hex_decoder import EpsStatisticsMessage, UhfStatisticsMessage, RadioPacketType, \
+    LENGTH_HEADER_SIZE, HEADER_PLUS_LENGTH_SIZE, COUNTER_SIZE_BYTES, CMAC_SIZE_BYTES
+from .telemetry_unit_conversions import BUILTIN_PROFILE, ADC_MAX_VALUE, compile_calibration, \
+    ADC_CHANNEL_CONVERSIONS, temp_sensor_adc_val_to_celsius
+
+# CSP headers of the beacons in rhw_telemetry_samples: EPS from node 3 port
+# 3 and UHF from node 2 port 2 to port 11, both to the ground at node 16
+BEACON_HEADERS = {EpsStatisticsMessage: 0x0700C300, UhfStatisticsMessage: 0x0502C200}
+RADIO_HEADER_STRUCT = struct.Struct(">BBIH")
+MESSAGE_OFFSET = LENGTH_HEADER_SIZE + 1 + HEADER_PLUS_LENGTH_SIZE
+SIGNATURE_SIZE = COUNTER_SIZE_BYTES + CMAC_SIZE_BYTES
+SIGNATURE_DTYPE = np.dtype([("serial", "<u4"), ("cmac", "<u4")])
+CHUNK_FRAMES = 1 << 16
+START_TIMESTAMP = 1543567489
+BEACON_INTERVAL_S = 15
+ORBIT_PERIOD_S = 5676
+SUNLIT_FRACTION = 0.64
+TUMBLE_PERIOD_S = 610
+MEAN_TIME_BETWEEN_REBOOTS_S = 3 * 24 * 3600
+# Reboot reasons seen in the sample beacons, 6 is counted as periodic
+REBOOT_REASONS = (2, 6)
+REBOOT_REASON_WEIGHTS = (0.8, 0.2)
+PERIODIC_BOOT_REASON = 6
+BOOT_REASON_HISTORY = 12
+# payload, charging, uhf_a and toggle_5v on, as in the sample beacons
+POWER_LEVELS = 0x4C1
+CHARGING_BIT = 1 << 6
+ANTENNAS_DEPLOYED = 15 | 3 << 4
+CAN_RX_PER_S = 61
+CAN_TX_PER_S = 55
+MAX_GARBAGE_BYTES = 64
+# CC11xx preamble
+PREAMBLE = b"\xaa" * 4
+GAUSSIAN_BT = 0.5
+GAP_SYMBOLS = 200
+
+
+def frame_size(message_class):
+    # Length byte, radio packet type, CSP header and length, the message,
+    # the counter and CMAC of a signed packet and the CC11xx CRC
+    return MESSAGE_OFFSET + sizeof(message_class) + SIGNATURE_SIZE + CRC_SIZE
+
+
+def _ranges(starts, lengths):
+    # Indices of the concatenated ranges starts[i]...starts[i] + lengths[i]
+    total = int(lengths.sum())
+    ends = np.cumsum(lengths)
+    return np.arange(total) + np.repeat(starts - (ends - lengths), lengths)
+
+
+class BootModel:
+    # Reboots of one subsystem as a Poisson process, the uptime, boot count
+    # and boot reasons that follow from them
+    def __init__(self, rng, now, boot_count=50, uptime_s=3600,
+                 mean_time_between_reboots_s=MEAN_TIME_BETWEEN_REBOOTS_S):
+        self.rng = rng
+        self.mean_time_between_reboots_s = mean_time_between_reboots_s
+        self.boot_count = boot_count
+        self.periodic_boot_count = boot_count // 5
+        self.boot_time = now - uptime_s
+        self.reasons = [REBOOT_REASONS[0]] * BOOT_REASON_HISTORY
+
+    def advance(self, times, interval_s):
+        # Per beacon at times: (boot count, periodic boot count, uptime,
+        # last boot reasons with the latest first)
+        rng = self.rng
+        reboots = np.flatnonzero(rng.random(len(times)) <
+                                 interval_s / self.mean_time_between_reboots_s)
+        reboot_times = times[reboots] - rng.integers(0, interval_s, len(reboots))
+        reasons = rng.choice(REBOOT_REASONS, len(reboots), p=REBOOT_REASON_WEIGHTS)
+        events = np.zeros(len(times), dtype=np.int64)
+        events[reboots] = np.arange(1, len(reboots) + 1)
+        last = np.maximum.accumulate(events)
+        histories = [self.reasons]
+        for reason in reasons.tolist():
+            histories.append([reason] + histories[-1][:-1])
+        periodic = np.concatenate(([0], np.cumsum(reasons == PERIODIC_BOOT_REASON)))
+        boot_times = np.concatenate(([self.boot_time], reboot_times))
+
+        boot_count = self.boot_count + last
+        periodic_boot_count = self.periodic_boot_count + periodic[last]
+        uptime = times - boot_times[last]
+        history = np.array(histories, dtype=np.uint8)[last]
+        self.boot_count += len(reboots)
+        self.periodic_boot_count += int(periodic[-1])
+        self.boot_time = int(boot_times[-1])
+        self.reasons = histories[-1]
+        return boot_count, periodic_boot_count, uptime, history
+
+
+class BeaconGenerator:
+    # Realistic EPS and UHF statistics beacons of one satellite, as complete
+    # radio frames with a valid CRC. Frames are written into a preallocated
+    # buffer: the constant bytes once with struct.pack_into, then every chunk
+    # only the modelled fields, each as one strided NumPy assignment per
+    # message type. The satellite sends the messages in turn, one every
+    # interval_s, over an orbit of sunlight and eclipse that cycles the
+    # battery, with a tumbling attitude and random reboots.
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, messages=(EpsStatisticsMessage, UhfStatisticsMessage),
+                 chunk_frames=CHUNK_FRAMES, seed=1, start=START_TIMESTAMP,
+                 interval_s=BEACON_INTERVAL_S,
+                 mean_time_between_reboots_s=MEAN_TIME_BETWEEN_REBOOTS_S,
+                 calibration=BUILTIN_PROFILE):
+        self.rng = np.random.default_rng(seed)
+        self.messages = tuple(messages)
+        self.interval_s = interval_s
+        self.tables = compile_calibration(calibration)
+        self._inverses = {}
+        self.start = start
+        self.frames = 0
+        self.serial = 0
+        self._eps_boots = BootModel(self.rng, start, 55, 3332, mean_time_between_reboots_s)
+        self._uhf_boots = BootModel(self.rng, start, 477, 86400, mean_time_between_reboots_s)
+        self._total_uptime_s = 1938906
+        self._csp_packet_number = 446896
+        self._uhf_failures = 4
+
+        sizes = [frame_size(message_class) for message_class in self.messages]
+        self.cycle_size = sum(sizes)
+        self.cycles = -(-chunk_frames // len(self.messages))
+        self.buffer = bytearray(self.cycles * self.cycle_size)
+        self._slots = []
+        position = 0
+        for message_class, size in zip(self.messages, sizes):
+            RADIO_HEADER_STRUCT.pack_into(self.buffer, position, size - 1 - CRC_SIZE,
+                                          RadioPacketType.CSP, BEACON_HEADERS[message_class],
+                                          sizeof(message_class))
+            self._slots.append((message_class, position, size))
+            position += size
+        data = np.frombuffer(self.buffer, dtype=np.uint8).reshape(self.cycles, self.cycle_size)
+        data[1:] = data[0]
+        self.offsets = (np.arange(self.cycles)[:, None] * self.cycle_size +
+                        np.cumsum([0] + sizes[:-1])).ravel()
+        self.lengths = np.tile(sizes, self.cycles)
+
+    def _strided(self, position, dtype, count):
+        return np.ndarray((count,), dtype, self.buffer, position, (self.cycle_size,))
+
+    def generate(self, count=None):
+        # The next count frames, at most chunk_frames, as (buffer, offsets,
+        # lengths). The buffer is overwritten by the next call.
+        capacity = len(self.offsets)
+        count = capacity if count is None else count
+        if not 0 < count <= capacity:
+            raise ValueError("Can generate 1 to %d frames at a time" % capacity)
+        for slot, (message_class, position, size) in enumerate(self._slots):
+            frames = len(range(slot, count, len(self.messages)))
+            if not frames:
+                continue
+            indices = self.frames + slot + np.arange(frames) * len(self.messages)
+            times = self.start + indices * self.interval_s
+            records = self._strided(position + MESSAGE_OFFSET, message_dtype(message_class),
+                                    frames)
+            MODELS[message_class](self, records, times)
+            trailer = position + MESSAGE_OFFSET + sizeof(message_class)
+            signatures = self._strided(trailer, SIGNATURE_DTYPE, frames)
+            signatures["serial"] = self.serial + indices
+            signatures["cmac"] = self.rng.integers(0, 1 << 32, frames, dtype=np.uint32)
+            rows = np.ndarray((frames, size - CRC_SIZE), np.uint8, self.buffer, position,
+                              (self.cycle_size, 1))
+            self._strided(position + size - CRC_SIZE, ">u2", frames)[:] = crc16_rows(rows)
+        self.frames += count
+        self.serial += count
+        end = int(self.offsets[count - 1] + self.lengths[count - 1])
+        return memoryview(self.buffer)[:end], self.offsets[:count], self.lengths[:count]
+
+    def _inverse(self, conversion):
+        # Reading for every whole converted value, the lowest one that
+        # converts to at least the value
+        if conversion not in self._inverses:
+            table = self.tables.array(conversion)
+            if conversion is temp_sensor_adc_val_to_celsius:
+                # Falling with the reading, 0 and ADC_MAX_VALUE are invalid
+                valid = table[ADC_MAX_VALUE - 1:0:-1]
+                readings = np.arange(ADC_MAX_VALUE - 1, 0, -1)
+            else:
+                valid = table[:ADC_MAX_VALUE]
+                readings = np.arange(ADC_MAX_VALUE)
+            values = np.arange(valid[0], valid[-1] + 1)
+            self._inverses[conversion] = (valid[0], readings[np.searchsorted(valid, values)])
+        return self._inverses[conversion]
+
+    def _to_adc(self, conversion, values):
+        lowest, readings = self._inverse(conversion)
+        return readings[np.clip(np.ceil(values) - lowest, 0, len(readings) - 1).astype(np.intp)]
+
+    def _adc(self, records, channel, values):
+        records["adc_statistics." + channel] = self._to_adc(ADC_CHANNEL_CONVERSIONS[channel],
+                                                            values)
+
+    def _orbit(self, times):
+        # Orbit phase from the start of sunlight, sunlight and the battery
+        # charge level between 0.3 and 1
+        phase = (times % ORBIT_PERIOD_S) / ORBIT_PERIOD_S
+        sunlit = phase < SUNLIT_FRACTION
+        charge = np.where(sunlit, 0.3 + 0.7 * np.minimum(phase / (0.6 * SUNLIT_FRACTION), 1),
+                          1 - 0.7 * (phase - SUNLIT_FRACTION) / (1 - SUNLIT_FRACTION))
+        temperature = 10 + 20 * np.sin(2 * np.pi * (phase - 0.1))
+        return sunlit, charge, temperature
+
+    def _eps(self, records, times):
+        rng = self.rng
+        count = len(times)
+        sunlit, charge, temperature = self._orbit(times)
+        boot_count, periodic_boot_count, uptime, history = self._eps_boots.advance(
+            times, self.interval_s * len(self.messages))
+        records["timestamp"] = times
+        records["can_statistics.rx_frame_count"] = uptime * CAN_RX_PER_S
+        records["can_statistics.tx_frame_count"] = uptime * CAN_TX_PER_S
+        records["can_statistics.error_count"] = uptime // 3600
+        records["eps_statistics.boot_count"] = boot_count
+        records["eps_statistics.periodic_boot_count"] = periodic_boot_count
+        records["eps_statistics.boot_reasons"] = history
+        records["eps_statistics.last_boot_reason"] = history[:, 0]
+        total_uptime = self._total_uptime_s + (times - self.start)
+        records["eps_statistics.total_uptime_s"] = total_uptime
+        records["eps_statistics.uptime_s"] = uptime
+        records["eps_statistics.memory_violation_reset_has_occured"] = False
+        records["eps_statistics.internal_temp"] = np.round(temperature + 6)
+
+        # Solar panel currents follow the tumbling attitude in sunlight
+        angle = 2 * np.pi * times / TUMBLE_PERIOD_S
+        x_sun = 300 * np.cos(angle) * sunlit
+        y_sun = 240 * np.sin(angle) * sunlit
+        self._adc(records, "spxp_curr", np.maximum(x_sun, 0))
+        self._adc(records, "spxn_curr", np.maximum(-x_sun, 0))
+        self._adc(records, "spyp_curr", np.maximum(y_sun, 0))
+        self._adc(records, "spyn_curr", np.maximum(-y_sun, 0))
+        self._adc(records, "sp_x_v", np.where(sunlit, 4800 + 400 * np.abs(np.cos(angle)), 0))
+        self._adc(records, "sp_y_v", np.where(sunlit, 4800 + 400 * np.abs(np.sin(angle)), 0))
+        full = charge >= 1
+        self._adc(records, "bat_curr", np.where(sunlit, np.where(full, 20, 400), -250) +
+                  rng.normal(0, 10, count))
+        self._adc(records, "bat_v", 7000 + 1100 * charge + rng.normal(0, 10, count))
+        transmitting = rng.random(count) < 0.1
+        self._adc(records, "uhf_curr_3v3", 30 + 150 * transmitting + rng.normal(0, 2, count))
+        self._adc(records, "uhf_curr_5v", np.full(count, 3))
+        self._adc(records, "payload_curr", 240 + rng.normal(0, 5, count))
+        # ADCS, GPS and OBC are powered off
+        records["adc_statistics.adcs_curr"] = 0
+        records["adc_statistics.gps_curr"] = 0
+        records["adc_statistics.obc_curr"] = 0
+        self._adc(records, "sns_3v3", 3176 + rng.normal(0, 8, count))
+        self._adc(records, "sns_5v", 4945 + rng.normal(0, 8, count))
+        records["adc_statistics.sns_12v_1"] = 0
+        records["adc_statistics.sns_12v_2"] = 0
+        self._adc(records, "temp_sns1", temperature + rng.normal(0, 0.3, count))
+        self._adc(records, "temp_sns2", temperature + rng.normal(0, 0.3, count))
+        mppt = np.where(sunlit, 1400 + 150 * charge, 1549)
+        records["mppt_statistics.panels.0.current_mppt_value"] = mppt
+        records["mppt_statistics.panels.1.current_mppt_value"] = mppt
+        power_levels = np.where(sunlit & ~full, POWER_LEVELS, POWER_LEVELS & ~CHARGING_BIT)
+        records["power_statistics.target_power_levels.raw"] = power_levels
+        records["power_statistics.actual_power_levels.raw"] = power_levels
+        records["power_statistics.state"] = 0
+        failures = self._uhf_failures + np.cumsum(rng.random(count) < 1e-3)
+        records["subsystem_hearbeat_statistics.uhf_failures"] = failures
+        records["antenna_statistics.deployment_sensed"] = ANTENNAS_DEPLOYED
+        self._uhf_failures = int(failures[-1])
+
+    def _uhf(self, records, times):
+        rng = self.rng
+        temperature = self._orbit(times)[2]
+        boot_count, _, uptime, history = self._uhf_boots.advance(
+            times, self.interval_s * len(self.messages))
+        records["can_statistics.rx_frame_count"] = uptime * CAN_TX_PER_S
+        records["can_statistics.tx_frame_count"] = uptime * CAN_RX_PER_S // 12
+        records["can_statistics.error_count"] = uptime // 600
+        records["uhf_statistics.boot_count"] = boot_count
+        records["uhf_statistics.last_boot_reason"] = history[:, 0]
+        records["uhf_statistics.memory_violation_reset_has_occured"] = False
+        records["uhf_statistics.internal_temp"] = np.round(temperature + 4)
+        # The packet number survives reboots
+        packet_number = self._csp_packet_number + np.cumsum(rng.poisson(2, len(times)))
+        records["uhf_statistics.current_csp_packet_number"] = packet_number
+        records["uhf_statistics.allowed_relay_packet_count"] = 0
+        records["uhf_statistics.rx_csp_frame_count"] = uptime // 10
+        records["uhf_statistics.rx_relay_frame_count"] = 0
+        records["uhf_statistics.tx_csp_frame_count"] = uptime // 7
+        records["uhf_statistics.rx_fifo_error_count"] = uptime // 86400
+        records["uhf_statistics.tx_fifo_error_count"] = 0
+        self._csp_packet_number = int(packet_number[-1])
+
+
+MODELS = {EpsStatisticsMessage: BeaconGenerator._eps,  # pylint: disable=protected-access
+          UhfStatisticsMessage: BeaconGenerator._uhf}  # pylint: disable=protected-access
+
+
+def impair(buffer, offsets, lengths, rng, bit_error_rate=0.0, truncation_rate=0.0,
+           garbage_rate=0.0, max_garbage=MAX_GARBAGE_BYTES):
+    # Copy of the frames with random bit errors, truncated frames and
+    # garbage between frames. Returns (data, offsets, lengths) of the
+    # resulting pieces, frames and garbage, back to back in data.
+    data = np.frombuffer(buffer, dtype=np.uint8).copy()
+    if bit_error_rate:
+        flips = rng.integers(0, len(data) * 8, rng.binomial(len(data) * 8, bit_error_rate))
+        np.bitwise_xor.at(data, flips >> 3, (1 << (flips & 7)).astype(np.uint8))
+    lengths = np.array(lengths, dtype=np.int64)
+    if truncation_rate:
+        truncated = np.flatnonzero(rng.random(len(lengths)) < truncation_rate)
+        lengths[truncated] = rng.integers(1, lengths[truncated])
+    garbage = np.zeros(len(lengths), dtype=np.int64)
+    if garbage_rate:
+        noisy = np.flatnonzero(rng.random(len(lengths)) < garbage_rate)
+        garbage[noisy] = rng.integers(1, max_garbage + 1, len(noisy))
+    # Each frame is followed by its garbage
+    piece_lengths = np.column_stack((lengths, garbage)).ravel()
+    piece_offsets = np.cumsum(piece_lengths) - piece_lengths
+    output = np.empty(int(piece_lengths.sum()), dtype=np.uint8)
+    output[_ranges(piece_offsets[0::2], lengths)] = data[_ranges(np.asarray(offsets), lengths)]
+    output[_ranges(piece_offsets[1::2], garbage)] = rng.integers(0, 256, int(garbage.sum()),
+                                                                 dtype=np.uint8)
+    pieces = piece_lengths > 0
+    return output, piece_offsets[pieces], piece_lengths[pieces]
+
+
+def hex_lines(buffer, offsets, lengths):
+    # One line of hex per frame, the input of the command line decoder
+    text = memoryview(buffer).hex().encode()
+    starts = (2 * np.asarray(offsets)).tolist()
+    ends = (2 * (np.asarray(offsets) + lengths)).tolist()
+    return b"\n".join([text[start:end] for start, end in zip(starts, ends)]) + b"\n"
+
+
+def gaussian_taps(bt, samples_per_symbol, span_symbols=3):
+    time_s = (np.arange(int(span_symbols * samples_per_symbol) + 1) -
+              span_symbols * samples_per_symbol / 2) / samples_per_symbol
+    sigma = np.sqrt(np.log(2)) / (2 * np.pi * bt)
+    taps = np.exp(-time_s ** 2 / (2 * sigma ** 2))
+    return taps / taps.sum()
+
+
+class FskModulator:
+    # Continuous phase 2-FSK (GFSK with bt) of CC11xx frames: preamble, sync
+    # word and the whitened frame, silence between frames. The phase carries
+    # over from one call to the next, so a recording can be written in
+    # chunks. noise is the standard deviation of the complex noise added,
+    # relative to the unit signal amplitude.
+    # pylint: disable=too-many-arguments
+    def __init__(self, sample_rate=SAMPLE_RATE, symbol_rate=SYMBOL_RATE,
+                 deviation_hz=DEVIATION_HZ, bt=GAUSSIAN_BT, gap_symbols=GAP_SYMBOLS,
+                 noise=0.0, seed=1):
+        self.samples_per_symbol = sample_rate / symbol_rate
+        self.phase_step = 2 * np.pi * deviation_hz / sample_rate
+        self.taps = gaussian_taps(bt, self.samples_per_symbol) if bt else None
+        self.gap_symbols = gap_symbols
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.phase = 0.0
+        self.sync = SYNC_WORD.to_bytes(SYNC_WORD_BITS // 8, "big")
+
+    def modulate(self, buffer, offsets, lengths):
+        data = bytes(buffer)
+        gap = np.zeros(self.gap_symbols, dtype=np.float32)
+        symbols = [gap]
+        for offset, length in zip(np.asarray(offsets).tolist(), np.asarray(lengths).tolist()):
+            air = PREAMBLE + self.sync + whiten(data[offset:offset + length])
+            bits = np.unpackbits(np.frombuffer(air, dtype=np.uint8)).astype(np.float32)
+            symbols.extend((2 * bits - 1, gap))
+        symbols = np.concatenate(symbols)
+        count = int(len(symbols) * self.samples_per_symbol)
+        frequency = symbols[(np.arange(count) / self.samples_per_symbol).astype(np.int64)]
+        amplitude = np.abs(frequency)
+        if self.taps is not None:
+            frequency = np.convolve(frequency, self.taps, "same")
+        phase = self.phase + np.cumsum(frequency * self.phase_step)
+        self.phase = float(phase[-1] % (2 * np.pi))
+        samples = (amplitude * np.exp(1j * phase)).astype(np.complex64)
+        if self.noise:
+            samples += (self.rng.normal(0, self.noise / np.sqrt(2), (count, 2))
+                        .astype(np.float32).view(np.complex64)[:, 0])
+        return samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic EPS and UHF statistics beacons for load testing")
+    parser.add_argument("--frames", type=int, default=1000000)
+    parser.add_argument("--format", choices=("hex", "binary", "iq"), default="binary",
+                        help="hex lines, back to back binary frames or 96 kHz complex64 IQ")
+    parser.add_argument("--output", "-o", help="output file instead of stdout")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--interval", type=float, default=BEACON_INTERVAL_S,
+                        help="seconds between beacons")
+    parser.add_argument("--bit-error-rate", type=float, default=0.0)
+    parser.add_argument("--truncation-rate", type=float, default=0.0,
+                        help="fraction of frames cut short")
+    parser.add_argument("--garbage-rate", type=float, default=0.0,
+                        help="fraction of frames followed by random bytes")
+    parser.add_argument("--noise", type=float, default=0.0,
+                        help="IQ noise amplitude relative to the signal")
+    args = parser.parse_args(argv)
+
+    generator = BeaconGenerator(seed=args.seed, interval_s=args.interval)
+    modulator = FskModulator(noise=args.noise, seed=args.seed)
+    rng = np.random.default_rng(args.seed + 1)
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    start = time.perf_counter()
+    written = 0
+    try:
+        remaining = args.frames
+        while remaining > 0:
+            chunk = generator.generate(min(remaining, len(generator.offsets)))
+            remaining -= len(chunk[1])
+            if args.bit_error_rate or args.truncation_rate or args.garbage_rate:
+                chunk = impair(*chunk, rng, args.bit_error_rate, args.truncation_rate,
+                               args.garbage_rate)
+            if args.format == "hex":
+                data = hex_lines(*chunk)
+            elif args.format == "binary":
+                data = chunk[0]
+            else:
+                data = modulator.modulate(*chunk).tobytes()
+            output.write(data)
+            written += len(data)
+    finally:
+        if args.output:
+            output.close()
+    seconds = time.perf_counter() - start
+    sys.stderr.write("%d frames, %d bytes in %.2f s (%.0f frames/s)\n" % (
+        args.frames, written, seconds, args.frames / seconds))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
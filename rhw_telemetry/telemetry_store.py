@@ -0,0 +1,280 @@
+from collections import OrderedDict
+import json
+import os
+
+import numpy as np
+
+from .batch_decoder import column_name
+from .hex_decoder import message_layout
+
+SEGMENT_ROWS = 1 << 16
+# Every INDEX_STRIDE:th timestamp of a segment is kept in its metadata
+INDEX_STRIDE = 256
+TIMESTAMP_COLUMN = "timestamp"
+# Monotonic counters are stored as differences to the previous row once a
+# segment is sealed, which mostly fit in a byte or two
+DELTA_ENCODED_COLUMNS = {
+    "can_statistics.rx_frame_count",
+    "can_statistics.tx_frame_count",
+    "can_statistics.error_count",
+    "eps_statistics.boot_count",
+    "eps_statistics.periodic_boot_count",
+    "eps_statistics.total_uptime_s",
+    "eps_statistics.uptime_s",
+    "uhf_statistics.boot_count",
+    "uhf_statistics.current_csp_packet_number",
+    "uhf_statistics.rx_csp_frame_count",
+    "uhf_statistics.rx_relay_frame_count",
+    "uhf_statistics.tx_csp_frame_count",
+    "uhf_statistics.rx_fifo_error_count",
+    "uhf_statistics.tx_fifo_error_count",
+}
+_DELTA_DTYPES = [np.dtype("<i1"), np.dtype("<i2"), np.dtype("<i4"), np.dtype("<i8")]
+
+
+def _write_json(path, value):
+    # Metadata is the commit point of an append, replace it atomically
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as output:
+        json.dump(value, output)
+    os.replace(temp_path, path)
+
+
+def _read_json(path):
+    with open(path) as source:
+        return json.load(source)
+
+
+def store_columns(message_class):
+    # (name, dtype, shape) of every stored column. Converted ADC channels are
+    # int64 to hold the temperature sentinels.
+    # pylint: disable=protected-access
+    converted = {path for path, _ in message_class._ground_conversions_}
+    columns = []
+    for field in message_layout(message_class):
+        dtype = np.dtype("<i8") if field.path in converted else \
+            np.dtype(field.ctype).newbyteorder("<")
+        columns.append((column_name(field.path), dtype, field.shape))
+    if TIMESTAMP_COLUMN not in [name for name, _, _ in columns]:
+        # Messages without a timestamp of their own are indexed by the
+        # reception time given to append
+        columns.insert(0, (TIMESTAMP_COLUMN, np.dtype("<u4"), ()))
+    return columns
+
+
+def _smallest_delta_dtype(deltas):
+    if len(deltas) == 0:
+        return _DELTA_DTYPES[0]
+    low, high = deltas.min(), deltas.max()
+    for dtype in _DELTA_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return _DELTA_DTYPES[-1]
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        self.meta = _read_json(os.path.join(path, "segment.json"))
+
+    @property
+    def rows(self):
+        return self.meta["rows"]
+
+    def column_path(self, name, encoding):
+        return os.path.join(self.path, "%s.%s" % (name, encoding))
+
+    def column(self, name, dtype, shape):
+        rows = self.rows
+        info = self.meta["columns"].get(name, {"encoding": "raw"})
+        if rows == 0:
+            return np.zeros((0,) + tuple(shape), dtype=dtype)
+        if info["encoding"] == "delta":
+            deltas = np.memmap(self.column_path(name, "delta"), dtype=info["dtype"],
+                               mode="r", shape=(rows,))
+            values = np.cumsum(deltas, dtype=np.int64) + info["base"]
+            return values.astype(dtype)
+        return np.memmap(self.column_path(name, "raw"), dtype=dtype, mode="r",
+                         shape=(rows,) + tuple(shape))
+
+    def row_range(self, start, stop, timestamp_dtype):
+        # Rows with start <= timestamp < stop, narrowed with the sparse index
+        # before the timestamp column itself is touched
+        meta = self.meta
+        rows = self.rows
+        if rows == 0 or (start is not None and meta["max_timestamp"] < start) or \
+                (stop is not None and meta["min_timestamp"] >= stop):
+            return 0, 0
+        timestamps = self.column(TIMESTAMP_COLUMN, timestamp_dtype, ())
+        if not meta["sorted"]:
+            selected = np.ones(rows, dtype=bool)
+            if start is not None:
+                selected &= timestamps >= start
+            if stop is not None:
+                selected &= timestamps < stop
+            return selected
+        index = np.asarray(meta["sparse_index"])
+        low, high = 0, rows
+        if start is not None:
+            block = max(int(np.searchsorted(index, start, "left")) - 1, 0) * INDEX_STRIDE
+            end = min(block + 2 * INDEX_STRIDE, rows)
+            low = block + int(np.searchsorted(timestamps[block:end], start, "left"))
+        if stop is not None:
+            block = max(int(np.searchsorted(index, stop, "left")) - 1, 0) * INDEX_STRIDE
+            end = min(block + 2 * INDEX_STRIDE, rows)
+            high = block + int(np.searchsorted(timestamps[block:end], stop, "left"))
+        return low, max(low, high)
+
+
+class TelemetryStore:
+    # Append-only columnar store of decoded messages of one message class.
+    # Rows go to the newest segment directory, one raw little endian file per
+    # column, until it holds segment_rows rows and is sealed.
+    def __init__(self, root, message_class, segment_rows=SEGMENT_ROWS):
+        self.root = root
+        self.message_class = message_class
+        self.columns = store_columns(message_class)
+        self._column_types = {name: (dtype, shape) for name, dtype, shape in self.columns}
+        # The unsealed segment appends go to, found once
+        self._segment = None
+        meta_path = os.path.join(root, "store.json")
+        if os.path.exists(meta_path):
+            meta = _read_json(meta_path)
+            if meta["message"] != message_class.__name__:
+                raise ValueError("Store at %s holds %s messages" % (root, meta["message"]))
+            self.segment_rows = meta["segment_rows"]
+        else:
+            os.makedirs(root, exist_ok=True)
+            self.segment_rows = segment_rows
+            _write_json(meta_path, {"message": message_class.__name__,
+                                    "segment_rows": segment_rows,
+                                    "columns": [[name, dtype.str, list(shape)]
+                                                for name, dtype, shape in self.columns]})
+
+    def segments(self):
+        names = sorted(name for name in os.listdir(self.root) if name.startswith("segment-"))
+        return [Segment(os.path.join(self.root, name)) for name in names]
+
+    def _new_segment(self, number):
+        path = os.path.join(self.root, "segment-%08d" % number)
+        os.makedirs(path)
+        _write_json(os.path.join(path, "segment.json"),
+                    {"rows": 0, "sealed": False, "sorted": True, "min_timestamp": None,
+                     "max_timestamp": None, "sparse_index": [], "columns": {}})
+        return Segment(path)
+
+    def _writable_segment(self):
+        if self._segment is None or self._segment.meta["sealed"]:
+            segments = self.segments()
+            if segments and not segments[-1].meta["sealed"]:
+                self._segment = segments[-1]
+            else:
+                self._segment = self._new_segment(len(segments))
+        return self._segment
+
+    # columns maps column names to equally long arrays, for example the
+    # output of vectorized_conversions.columns_to_ground
+    def append(self, columns, timestamps=None):
+        if timestamps is not None:
+            columns = OrderedDict(columns)
+            columns[TIMESTAMP_COLUMN] = timestamps
+        arrays = OrderedDict()
+        for name, dtype, shape in self.columns:
+            arrays[name] = np.asarray(columns[name]).astype(dtype, copy=False)
+        total = len(arrays[TIMESTAMP_COLUMN])
+        written = 0
+        while written < total:
+            segment = self._writable_segment()
+            rows = min(self.segment_rows - segment.rows, total - written)
+            self._append_rows(segment, arrays, written, written + rows)
+            if segment.rows >= self.segment_rows:
+                self._seal(segment)
+            written += rows
+        return total
+
+    def append_messages(self, messages, timestamps=None):
+        messages = list(messages)
+        columns = OrderedDict()
+        for field in message_layout(self.message_class):
+            values = []
+            for message in messages:
+                value = message
+                for key in field.path:
+                    value = value[key]
+                values.append(value)
+            columns[column_name(field.path)] = values
+        return self.append(columns, timestamps)
+
+    def _append_rows(self, segment, arrays, first, last):
+        meta = segment.meta
+        for name, values in arrays.items():
+            dtype, shape = self._column_types[name]
+            with open(segment.column_path(name, "raw"), "ab") as output:
+                # Rows written before a crash, but never committed to the
+                # metadata, would shift every later row
+                output.truncate(meta["rows"] * dtype.itemsize * int(np.prod(shape)))
+                np.ascontiguousarray(values[first:last]).tofile(output)
+        timestamps = arrays[TIMESTAMP_COLUMN][first:last]
+        old_rows = meta["rows"]
+        if meta["max_timestamp"] is not None and timestamps[0] < meta["max_timestamp"]:
+            meta["sorted"] = False
+        if len(timestamps) > 1 and np.any(np.diff(timestamps.astype(np.int64)) < 0):
+            meta["sorted"] = False
+        low, high = int(timestamps.min()), int(timestamps.max())
+        if meta["min_timestamp"] is not None:
+            low = min(low, meta["min_timestamp"])
+            high = max(high, meta["max_timestamp"])
+        meta["min_timestamp"], meta["max_timestamp"] = low, high
+        first_indexed = -old_rows % INDEX_STRIDE
+        meta["sparse_index"].extend(int(value) for value in timestamps[first_indexed::INDEX_STRIDE])
+        meta["rows"] = old_rows + last - first
+        _write_json(os.path.join(segment.path, "segment.json"), meta)
+
+    def _seal(self, segment):
+        meta = segment.meta
+        for name in DELTA_ENCODED_COLUMNS:
+            if name not in self._column_types:
+                continue
+            dtype, shape = self._column_types[name]
+            values = np.array(segment.column(name, dtype, shape), dtype=np.int64)
+            deltas = np.diff(values, prepend=values[:1])
+            delta_dtype = _smallest_delta_dtype(deltas)
+            deltas.astype(delta_dtype).tofile(segment.column_path(name, "delta"))
+            meta["columns"][name] = {"encoding": "delta", "dtype": delta_dtype.str,
+                                     "base": int(values[0])}
+        meta["sealed"] = True
+        _write_json(os.path.join(segment.path, "segment.json"), meta)
+        for name in meta["columns"]:
+            os.remove(segment.column_path(name, "raw"))
+
+    def iter_segments(self, names, start=None, stop=None):
+        # Yields the requested columns of every segment overlapping the
+        # [start, stop) timestamp range. Raw columns are memory mapped views.
+        timestamp_dtype = self._column_types[TIMESTAMP_COLUMN][0]
+        for segment in self.segments():
+            rows = segment.row_range(start, stop, timestamp_dtype)
+            if isinstance(rows, tuple):
+                if rows[0] == rows[1]:
+                    continue
+                selection = slice(*rows)
+            elif rows.any():
+                selection = rows
+            else:
+                continue
+            columns = OrderedDict()
+            for name in names:
+                dtype, shape = self._column_types[name]
+                columns[name] = segment.column(name, dtype, shape)[selection]
+            yield columns
+
+    def read(self, names, start=None, stop=None):
+        parts = list(self.iter_segments(names, start, stop))
+        if len(parts) == 1:
+            return parts[0]
+        result = OrderedDict()
+        for name in names:
+            dtype, shape = self._column_types[name]
+            result[name] = np.concatenate([part[name] for part in parts]) if parts else \
+                np.zeros((0,) + tuple(shape), dtype=dtype)
+        return result
@@ -1,6 +1,11 @@
+from collections import OrderedDict
+import bisect
 import logging
+import math
 import sys
-from ntcle100_temp_sensor import resistance_to_celsius
+import threading
+from types import SimpleNamespace
+from .ntcle100_temp_sensor import resistance_to_celsius
 ADC_REFERENCE_5V = 4885
 SOLAR_PANEL_CURRENT_CALIB_MULTIPLIER = 0.95
 ADC_REFERENCE_3V3 = 3145
@@ -24,133 +29,326 @@ OBC_CALIB_OFFSET = -136.87
 ADCS_CALIB_MULTIPLIER = 0.435
 ADCS_CALIB_OFFSET = -234.14
 ADC_MAX_VALUE = 4095
+# Temperatures of readings that can't be converted
+TEMP_OUT_OF_RANGE = sys.maxsize
+TEMP_INVALID = -9999
 
+# The constants above that a calibration profile can change, and their
+# values as flown, the builtin profile
+CALIBRATION_CONSTANTS = (
+    "ADC_REFERENCE_5V", "SOLAR_PANEL_CURRENT_CALIB_MULTIPLIER", "ADC_REFERENCE_3V3",
+    "TEMP_CALIB_R1_OHM", "BAT_CURRENT_SENSING_REFERENCE", "BAT_CURRENT_CALIB_MULTIPLIER",
+    "BAT_CURRENT_OFFSET_MILLIAMPER", "SOLAR_PANEL_OP_AMP_GAIN", "SOLAR_PANEL_VOLTAGE_OFFSET_MV",
+    "RESISTOR_DIVIDER_BAT_COMPENSATION", "RESISTOR_DIVIDER_3V3_COMPENSATION",
+    "RESISTOR_DIVIDER_5V_COMPENSATION", "RESISTOR_DIVIDER_12V_COMPENSATION",
+    "COM_3V3_CURRENT_CALIB_MULTIPLIER", "PAYLOAD_CALIB_MULTIPLIER", "PAYLOAD_CALIB_OFFSET",
+    "GPS_CALIB_MULTIPLIER", "GPS_CALIB_OFFSET", "OBC_CALIB_MULTIPLIER", "OBC_CALIB_OFFSET",
+    "ADCS_CALIB_MULTIPLIER", "ADCS_CALIB_OFFSET")
+BUILTIN = SimpleNamespace(**{name: globals()[name] for name in CALIBRATION_CONSTANTS})
 
-def adc_5v_to_milli_volt(adc):
-    return (adc * ADC_REFERENCE_5V) / ADC_MAX_VALUE
 
+def adc_5v_to_milli_volt(adc, calib=BUILTIN):
+    return (adc * calib.ADC_REFERENCE_5V) / ADC_MAX_VALUE
 
-def adc_3v3_to_milli_volt(adc):
-    return (adc * ADC_REFERENCE_3V3) / ADC_MAX_VALUE
 
+def adc_3v3_to_milli_volt(adc, calib=BUILTIN):
+    return (adc * calib.ADC_REFERENCE_3V3) / ADC_MAX_VALUE
 
-def adc_to_bat_current_milli_amper(adc):
-    return BAT_CURRENT_CALIB_MULTIPLIER * ((adc_5v_to_milli_volt(adc) - BAT_CURRENT_SENSING_REFERENCE) + BAT_CURRENT_OFFSET_MILLIAMPER)
 
+def adc_to_bat_current_milli_amper(adc, calib=BUILTIN):
+    return calib.BAT_CURRENT_CALIB_MULTIPLIER * (
+        (adc_5v_to_milli_volt(adc, calib) - calib.BAT_CURRENT_SENSING_REFERENCE) +
+        calib.BAT_CURRENT_OFFSET_MILLIAMPER)
 
-def adc_to_solar_panel_voltage_milli_volt(adc):
-    return SOLAR_PANEL_OP_AMP_GAIN * adc_5v_to_milli_volt(adc) + SOLAR_PANEL_VOLTAGE_OFFSET_MV
 
+def adc_to_solar_panel_voltage_milli_volt(adc, calib=BUILTIN):
+    return calib.SOLAR_PANEL_OP_AMP_GAIN * adc_5v_to_milli_volt(adc, calib) + \
+        calib.SOLAR_PANEL_VOLTAGE_OFFSET_MV
 
-def adc_to_solar_panel_current_milli_amper(adc):
-    return SOLAR_PANEL_CURRENT_CALIB_MULTIPLIER * adc_5v_to_milli_volt(adc)
 
+def adc_to_solar_panel_current_milli_amper(adc, calib=BUILTIN):
+    return calib.SOLAR_PANEL_CURRENT_CALIB_MULTIPLIER * adc_5v_to_milli_volt(adc, calib)
 
-def adc_3v3_bus_voltage_milli_volt(adc):
-    return adc_3v3_to_milli_volt(adc) * RESISTOR_DIVIDER_3V3_COMPENSATION
 
+def adc_3v3_bus_voltage_milli_volt(adc, calib=BUILTIN):
+    return adc_3v3_to_milli_volt(adc, calib) * calib.RESISTOR_DIVIDER_3V3_COMPENSATION
 
-def adc_5v_bus_voltage_milli_volt(adc):
-    return adc_3v3_to_milli_volt(adc) * RESISTOR_DIVIDER_5V_COMPENSATION
 
+def adc_5v_bus_voltage_milli_volt(adc, calib=BUILTIN):
+    return adc_3v3_to_milli_volt(adc, calib) * calib.RESISTOR_DIVIDER_5V_COMPENSATION
 
-def adc_12v_bus_voltage_milli_volt(adc):
-    return adc_3v3_to_milli_volt(adc) * RESISTOR_DIVIDER_12V_COMPENSATION
 
+def adc_12v_bus_voltage_milli_volt(adc, calib=BUILTIN):
+    return adc_3v3_to_milli_volt(adc, calib) * calib.RESISTOR_DIVIDER_12V_COMPENSATION
 
-def adc_to_bat_voltage(adc):
-    return adc_5v_to_milli_volt(adc) * RESISTOR_DIVIDER_BAT_COMPENSATION
 
+def adc_to_bat_voltage(adc, calib=BUILTIN):
+    return adc_5v_to_milli_volt(adc, calib) * calib.RESISTOR_DIVIDER_BAT_COMPENSATION
 
-def adc_to_com_3v3_current_milli_amper(adc):
-    return adc_3v3_to_milli_volt(adc) * COM_3V3_CURRENT_CALIB_MULTIPLIER
 
+def adc_to_com_3v3_current_milli_amper(adc, calib=BUILTIN):
+    return adc_3v3_to_milli_volt(adc, calib) * calib.COM_3V3_CURRENT_CALIB_MULTIPLIER
 
-def adc_to_com_5v_current_milli_amper(adc):
-    return adc_3v3_to_milli_volt(adc)
 
+def adc_to_com_5v_current_milli_amper(adc, calib=BUILTIN):
+    return adc_3v3_to_milli_volt(adc, calib)
 
-def adc_to_payload_current_milli_amper(adc):
-    return PAYLOAD_CALIB_MULTIPLIER * adc + PAYLOAD_CALIB_OFFSET
 
+def adc_to_payload_current_milli_amper(adc, calib=BUILTIN):
+    return calib.PAYLOAD_CALIB_MULTIPLIER * adc + calib.PAYLOAD_CALIB_OFFSET
 
-def adc_to_obc_current_milli_amper(adc):
-    return OBC_CALIB_MULTIPLIER * adc + OBC_CALIB_OFFSET
 
+def adc_to_obc_current_milli_amper(adc, calib=BUILTIN):
+    return calib.OBC_CALIB_MULTIPLIER * adc + calib.OBC_CALIB_OFFSET
 
-def adc_to_gps_current_milli_amper(adc):
-    return GPS_CALIB_MULTIPLIER * adc + GPS_CALIB_OFFSET
 
+def adc_to_gps_current_milli_amper(adc, calib=BUILTIN):
+    return calib.GPS_CALIB_MULTIPLIER * adc + calib.GPS_CALIB_OFFSET
 
-def adc_to_adcs_current_milli_amper(adc):
-    return GPS_CALIB_MULTIPLIER * adc + ADCS_CALIB_OFFSET
 
+def adc_to_adcs_current_milli_amper(adc, calib=BUILTIN):
+    return calib.GPS_CALIB_MULTIPLIER * adc + calib.ADCS_CALIB_OFFSET
 
-def temp_sensor_adc_val_to_celsius(adc_val):
+
+def temp_sensor_adc_to_ohm(adc_val, calib=BUILTIN):
+    adc_ratio = adc_val / ADC_MAX_VALUE
+    return adc_ratio * calib.TEMP_CALIB_R1_OHM / (1 - adc_ratio)
+
+
+def temp_sensor_adc_val_to_celsius(adc_val, calib=BUILTIN):
     if adc_val == ADC_MAX_VALUE:
         logging.error("ADC value for temp sensor out of meaningful range")
-        return sys.maxsize
-    adc_ratio = adc_val / ADC_MAX_VALUE
-    r2 = adc_ratio * TEMP_CALIB_R1_OHM / (1 - adc_ratio)
+        return TEMP_OUT_OF_RANGE
+    r2 = temp_sensor_adc_to_ohm(adc_val, calib)
     if r2 == 0:
         logging.error("Invalid temp sensor value %d", adc_val)
-        return -9999
+        return TEMP_INVALID
     return resistance_to_celsius(r2)
 
 
+# Readings whose conversion logs an error, they are never looked up from a
+# table so that they are logged every time
+UNTABULATED_READINGS = {
+    temp_sensor_adc_val_to_celsius: (0, ADC_MAX_VALUE),
+}
+
+
+class CalibrationProfile:
+    # A named and versioned set of calibration constants, the builtin value of
+    # every constant not given. The version identifies the constants: change
+    # it whenever they change.
+    def __init__(self, name, version, constants=None):
+        constants = dict(constants or {})
+        unknown = sorted(set(constants) - set(CALIBRATION_CONSTANTS))
+        if unknown:
+            raise ValueError("Unknown calibration constants: %s" % ", ".join(unknown))
+        if "ADC_REFERENCE_5V" in constants:
+            constants.setdefault("BAT_CURRENT_SENSING_REFERENCE",
+                                 constants["ADC_REFERENCE_5V"] / 2)
+        self.name = name
+        self.version = version
+        self.constants = SimpleNamespace(**dict(vars(BUILTIN), **constants))
+
+    def __repr__(self):
+        return "CalibrationProfile(%r, %r)" % (self.name, self.version)
+
+    def to_dict(self):
+        return OrderedDict([("name", self.name), ("version", self.version),
+                            ("constants", OrderedDict(
+                                (name, getattr(self.constants, name))
+                                for name in CALIBRATION_CONSTANTS))])
+
+    @classmethod
+    def from_dict(cls, dic):
+        try:
+            return cls(dic["name"], dic["version"], dic.get("constants"))
+        except KeyError as error:
+            raise ValueError("Calibration profile without %s" % error)
+
+
+def load_calibration_profile(path):
+    # A JSON object with the profile name, version and the constants that
+    # differ from the builtin ones
+    import json  # pylint: disable=import-outside-toplevel
+    with open(path) as source:
+        return CalibrationProfile.from_dict(json.load(source))
+
+
+class CalibrationTables:
+    # The conversions of every possible 12 bit reading under one profile.
+    # Tables hold the int() of each conversion, None for
+    # UNTABULATED_READINGS, and are compiled on first use.
+    def __init__(self, profile):
+        self.profile = profile
+        self._tables = {}
+        self._arrays = {}
+        self._temperature_curve = None
+
+    def table(self, conversion):
+        table = self._tables.get(conversion)
+        if table is None:
+            calib = self.profile.constants
+            untabulated = UNTABULATED_READINGS.get(conversion, ())
+            table = [None if adc in untabulated else int(conversion(adc, calib))
+                     for adc in range(ADC_MAX_VALUE + 1)]
+            self._tables[conversion] = table
+        return table
+
+    def array(self, conversion):
+        # The table as an int64 NumPy array, untabulated readings are 0
+        array = self._arrays.get(conversion)
+        if array is None:
+            import numpy as np  # pylint: disable=import-outside-toplevel
+            array = np.array([0 if value is None else value for value in self.table(conversion)],
+                             dtype=np.int64)
+            self._arrays[conversion] = array
+        return array
+
+    def _temperature(self):
+        # Temperatures (rising) and thermistor resistances of the valid
+        # readings, from the highest reading down
+        if self._temperature_curve is None:
+            calib = self.profile.constants
+            resistances = [temp_sensor_adc_to_ohm(adc, calib)
+                           for adc in range(ADC_MAX_VALUE - 1, 0, -1)]
+            celsius = [resistance_to_celsius(resistance) for resistance in resistances]
+            self._temperature_curve = celsius, resistances
+        return self._temperature_curve
+
+    def _temperature_position(self, celsius):
+        curve = self._temperature()[0]
+        if not curve[0] <= celsius <= curve[-1]:
+            raise ValueError("%r C is outside the %.1f...%.1f C the sensor can read" % (
+                celsius, curve[0], curve[-1]))
+        idx = max(bisect.bisect_left(curve, celsius), 1)
+        return idx, (celsius - curve[idx - 1]) / (curve[idx] - curve[idx - 1])
+
+    def celsius_to_resistance(self, celsius):
+        # Inverse of the temperature tables: the thermistor resistance,
+        # interpolated logarithmically between the two closest readings
+        idx, fraction = self._temperature_position(celsius)
+        resistances = self._temperature()[1]
+        low, high = math.log(resistances[idx - 1]), math.log(resistances[idx])
+        return math.exp(low + (high - low) * fraction)
+
+    def celsius_to_adc(self, celsius):
+        # The temperature sensor reading closest to celsius
+        idx, fraction = self._temperature_position(celsius)
+        return ADC_MAX_VALUE - idx - (1 if fraction >= 0.5 else 0)
+
+
+# Compiled tables by profile name and version
+_COMPILED = {}
+
+
+def compile_calibration(profile):
+    key = (profile.name, profile.version)
+    tables = _COMPILED.get(key)
+    if tables is None:
+        tables = _COMPILED[key] = CalibrationTables(profile)
+    elif vars(tables.profile.constants) != vars(profile.constants):
+        raise ValueError("%s version %s has other constants than the one already compiled" % (
+            profile.name, profile.version))
+    return tables
+
+
+BUILTIN_PROFILE = CalibrationProfile("builtin", 0)
+
+
+class _PendingTable:
+    # Stands in for the table of a conversion until its first lookup, which
+    # compiles the table of the active profile and binds it in its place
+    __slots__ = ("conversion",)
+
+    def __init__(self, conversion):
+        self.conversion = conversion
+
+    def __getitem__(self, adc):
+        with _SWITCH_LOCK:
+            table = self.conversion.table
+            if table is self:
+                table = self.conversion.table = _ACTIVE[0].table(self.conversion.conversion)
+        return table[adc]
+
+
+class CalibratedConversion:
+    # Ground unit conversion of one ADC channel under the active calibration
+    # profile, the int() of conversion(adc, constants). Readings of a 12 bit
+    # ADC are a table lookup. The table is bound when the profile changes,
+    # so a call is the lookup alone.
+    __slots__ = ("conversion", "table")
+
+    def __init__(self, conversion):
+        self.conversion = conversion
+        self.table = _PendingTable(self)
+
+    def __call__(self, adc):
+        try:
+            value = self.table[adc]
+        except (IndexError, TypeError):
+            value = None
+        if value is None:
+            return int(self.conversion(adc, _ACTIVE[0].profile.constants))
+        return value
+
+
+# Calibrated conversion formula of each ADCData channel
+ADC_CHANNEL_CONVERSIONS = OrderedDict([
+    ('spxp_curr', adc_to_solar_panel_current_milli_amper),
+    ('spxn_curr', adc_to_solar_panel_current_milli_amper),
+    ('spyp_curr', adc_to_solar_panel_current_milli_amper),
+    ('spyn_curr', adc_to_solar_panel_current_milli_amper),
+    ('sp_x_v', adc_to_solar_panel_voltage_milli_volt),
+    ('sp_y_v', adc_to_solar_panel_voltage_milli_volt),
+    ('bat_curr', adc_to_bat_current_milli_amper),
+    ('bat_v', adc_to_bat_voltage),
+    ('uhf_curr_3v3', adc_to_com_3v3_current_milli_amper),
+    ('uhf_curr_5v', adc_to_com_5v_current_milli_amper),
+    ('payload_curr', adc_to_payload_current_milli_amper),
+    ('adcs_curr', adc_to_adcs_current_milli_amper),
+    ('gps_curr', adc_to_gps_current_milli_amper),
+    ('obc_curr', adc_to_obc_current_milli_amper),
+    ('sns_3v3', adc_3v3_bus_voltage_milli_volt),
+    ('sns_5v', adc_5v_bus_voltage_milli_volt),
+    ('sns_12v_1', adc_12v_bus_voltage_milli_volt),
+    ('sns_12v_2', adc_12v_bus_voltage_milli_volt),
+    ('temp_sns1', temp_sensor_adc_val_to_celsius),
+    ('temp_sns2', temp_sensor_adc_val_to_celsius),
+])
+# Ground unit conversion of each ADCData channel, see unit_conversions_to_ground
+ADC_GROUND_CONVERSIONS = OrderedDict((field, CalibratedConversion(conversion))
+                                     for field, conversion in ADC_CHANNEL_CONVERSIONS.items())
+# The tables every CalibratedConversion uses. Conversions pick them up under
+# the lock so that none keeps the tables of a previous profile.
+_ACTIVE = [compile_calibration(BUILTIN_PROFILE)]
+_SWITCH_LOCK = threading.Lock()
+
+
+def active_calibration():
+    return _ACTIVE[0]
+
+
+def use_calibration(profile):
+    # Switches every ground unit conversion, also in already compiled
+    # decoders and views, to profile and returns the tables in use before.
+    # A message converted while switching can mix both profiles.
+    tables = compile_calibration(profile)
+    with _SWITCH_LOCK:
+        previous = _ACTIVE[0]
+        _ACTIVE[0] = tables
+        for conversion in ADC_GROUND_CONVERSIONS.values():
+            conversion.table = _PendingTable(conversion)
+    return previous
+
+
 def update_solar_panel_current_adc_to_milli_amper(dic, field):
-    dic['adc_statistics'][field] = int(adc_to_solar_panel_current_milli_amper(
+    # With the active calibration profile, like unit_conversions_to_ground
+    dic['adc_statistics'][field] = int(ADC_GROUND_CONVERSIONS[field](
         dic['adc_statistics'][field]))
 
 
 def unit_conversions_to_ground(dic):
-
-    update_solar_panel_current_adc_to_milli_amper(dic, 'spxp_curr')
-    update_solar_panel_current_adc_to_milli_amper(dic, 'spxn_curr')
-    update_solar_panel_current_adc_to_milli_amper(dic, 'spyp_curr')
-    update_solar_panel_current_adc_to_milli_amper(dic, 'spyn_curr')
-
-    dic['adc_statistics']['sp_x_v'] = int(adc_to_solar_panel_voltage_milli_volt(
-        dic['adc_statistics']['sp_x_v']))
-    dic['adc_statistics']['sp_y_v'] = int(adc_to_solar_panel_voltage_milli_volt(
-        dic['adc_statistics']['sp_y_v']))
-
-    dic['adc_statistics']['bat_curr'] = int(adc_to_bat_current_milli_amper(
-        dic['adc_statistics']['bat_curr']))
-
-    dic['adc_statistics']['bat_v'] = int(adc_to_bat_voltage(
-        dic['adc_statistics']['bat_v']))
-
-    dic['adc_statistics']['uhf_curr_3v3'] = int(adc_to_com_3v3_current_milli_amper(
-        dic['adc_statistics']['uhf_curr_3v3']))
-
-    dic['adc_statistics']['uhf_curr_5v'] = int(adc_to_com_5v_current_milli_amper(
-        dic['adc_statistics']['uhf_curr_5v']))
-
-    dic['adc_statistics']['payload_curr'] = int(adc_to_payload_current_milli_amper(
-        dic['adc_statistics']['payload_curr']))
-    dic['adc_statistics']['adcs_curr'] = int(adc_to_adcs_current_milli_amper(
-        dic['adc_statistics']['adcs_curr']))
-    dic['adc_statistics']['gps_curr'] = int(adc_to_gps_current_milli_amper(
-        dic['adc_statistics']['gps_curr']))
-    dic['adc_statistics']['obc_curr'] = int(adc_to_obc_current_milli_amper(
-        dic['adc_statistics']['obc_curr']))
-
-    dic['adc_statistics']['sns_3v3'] = int(adc_3v3_bus_voltage_milli_volt(
-        dic['adc_statistics']['sns_3v3']))
-
-    dic['adc_statistics']['sns_5v'] = int(adc_5v_bus_voltage_milli_volt(
-        dic['adc_statistics']['sns_5v']))
-
-    dic['adc_statistics']['sns_12v_1'] = int(adc_12v_bus_voltage_milli_volt(
-        dic['adc_statistics']['sns_12v_1']))
-    dic['adc_statistics']['sns_12v_2'] = int(adc_12v_bus_voltage_milli_volt(
-        dic['adc_statistics']['sns_12v_2']))
-
-    dic['adc_statistics']['temp_sns1'] = int(temp_sensor_adc_val_to_celsius(
-        dic['adc_statistics']['temp_sns1']))
-
-    dic['adc_statistics']['temp_sns2'] = int(temp_sensor_adc_val_to_celsius(
-        dic['adc_statistics']['temp_sns2']))
+    adc_statistics = dic['adc_statistics']
+    for field, conversion in ADC_GROUND_CONVERSIONS.items():
+        adc_statistics[field] = int(conversion(adc_statistics[field]))
     return dic
-
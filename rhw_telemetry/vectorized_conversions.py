@@ -0,0 +1,95 @@
+from collections import OrderedDict
+import logging
+
+import numpy as np
+
+from .batch_decoder import column_name
+from .ntcle100_temp_sensor import A_1, B_1, C_1, D_1, R_REF
+from .telemetry_unit_conversions import ADC_MAX_VALUE, TEMP_CALIB_R1_OHM, TEMP_OUT_OF_RANGE, \
+    TEMP_INVALID, temp_sensor_adc_val_to_celsius, CalibratedConversion, active_calibration, \
+    compile_calibration
+
+
+def resistance_to_celsius_array(resistance):
+    log_ratio = np.log(resistance / R_REF)
+    temp = 1 / (A_1 + B_1 * log_ratio +
+                C_1 * np.power(log_ratio, 2) +
+                D_1 * np.power(log_ratio, 3))
+    return temp - 273
+
+
+def _truncate(values):
+    # Same rounding towards zero as int() on the scalar path
+    return np.trunc(values).astype(np.int64)
+
+
+# Array version of int(temp_sensor_adc_val_to_celsius(adc)) with the same
+# sentinels. Readings above ADC_MAX_VALUE, which the scalar path can't take,
+# are reported out of range as well. With calibration tables the valid
+# readings are a table gather.
+def temp_sensor_adc_to_celsius_array(adc, tables=None):
+    adc = np.asarray(adc, dtype=np.int64)
+    out_of_range = adc >= ADC_MAX_VALUE
+    invalid = adc == 0
+    if out_of_range.any():
+        logging.error("%d ADC values for temp sensor out of meaningful range",
+                      np.count_nonzero(out_of_range))
+    if invalid.any():
+        logging.error("%d invalid temp sensor values", np.count_nonzero(invalid))
+    valid = ~(out_of_range | invalid)
+    result = np.empty(adc.shape, dtype=np.int64)
+    if tables is not None:
+        result[valid] = tables.array(temp_sensor_adc_val_to_celsius)[adc[valid]]
+    else:
+        adc_ratio = adc[valid] / ADC_MAX_VALUE
+        r2 = adc_ratio * TEMP_CALIB_R1_OHM / (1 - adc_ratio)
+        result[valid] = _truncate(resistance_to_celsius_array(r2))
+    result[out_of_range] = TEMP_OUT_OF_RANGE
+    result[invalid] = TEMP_INVALID
+    return result
+
+
+def calibrated_column_to_ground(conversion, adc, tables):
+    # Table gather of a calibrated conversion, readings that no 12 bit ADC
+    # gives are computed from the formula
+    adc = np.asarray(adc, dtype=np.int64)
+    if conversion.conversion is temp_sensor_adc_val_to_celsius:
+        return temp_sensor_adc_to_celsius_array(adc, tables)
+    result = tables.array(conversion.conversion)[np.clip(adc, 0, ADC_MAX_VALUE)]
+    above = adc > ADC_MAX_VALUE
+    if above.any():
+        result[above] = _truncate(conversion.conversion(adc[above], tables.profile.constants))
+    return result
+
+
+# Scalar conversions that can't be applied to arrays as such
+ARRAY_CONVERSIONS = {
+    temp_sensor_adc_val_to_celsius: temp_sensor_adc_to_celsius_array,
+}
+
+
+def adc_column_to_ground(conversion, adc, tables=None):
+    if isinstance(conversion, CalibratedConversion):
+        return calibrated_column_to_ground(conversion, adc,
+                                           tables if tables is not None else active_calibration())
+    array_conversion = ARRAY_CONVERSIONS.get(conversion)
+    if array_conversion is not None:
+        return array_conversion(adc)
+    # The linear conversions work on arrays unchanged once the unsigned
+    # ADC counts can't overflow anymore
+    return _truncate(conversion(np.asarray(adc, dtype=np.int64)))
+
+
+# Applies every ground unit conversion of message_class to the columns
+# returned by batch_decoder.decode_columns, one vectorized pass per channel.
+# Calibrated channels use the active calibration profile unless another
+# telemetry_unit_conversions.CalibrationProfile is given, which re-converts
+# archived raw readings under a corrected calibration.
+def columns_to_ground(message_class, columns, profile=None):
+    tables = compile_calibration(profile) if profile is not None else None
+    result = OrderedDict(columns)
+    # pylint: disable=protected-access
+    for path, conversion in message_class._ground_conversions_:
+        name = column_name(path)
+        result[name] = adc_column_to_ground(conversion, columns[name], tables)
+    return result
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# The package isn't installed, run from the checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The EPS beacon of the README, with its CC11xx CRC
+EPS_FRAME_HEX = (
+    "71 01 07 00 C3 00 00 62 81 F8 00 5C AC 60 03 00 77 7A 35 00 8F 00 00 00 5E 00 00 00 0A 00 "
+    "02 06 02 02 02 02 02 02 02 06 02 02 06 DE 72 01 00 C6 00 00 00 00 FE FF 03 00 77 00 BB 00 "
+    "27 00 E0 05 07 05 FF 07 A5 0D 2E 00 05 00 97 01 01 00 F6 00 00 00 7A 08 B3 0C 03 00 00 00 "
+    "7E 0A 18 0B B5 07 9D 08 C3 06 C3 06 00 04 00 3F 20 23 04 26 FD 7A AB FF B4 AC")
+
+
+@pytest.fixture
+def eps_frame():
+    return bytes.fromhex(EPS_FRAME_HEX)
@@ -0,0 +1,58 @@
+import numpy as np
+
+from rhw_telemetry.batch_decoder import _frame_stride, csp_header_columns, decode_csp_headers, \
+    pack_frames, select_csp
+from rhw_telemetry.hex_decoder import CspPacket, RADIO_FRAME_CSP_OFFSET
+from rhw_telemetry.synthetic import BeaconGenerator
+
+CSP_FIELDS = ("src", "dst", "dst_port", "src_port", "priority", "hmac", "xtea", "rdp", "crc")
+
+
+def _check_against_csp_packets(buffer, offsets, lengths, headers):
+    columns = csp_header_columns(headers)
+    assert headers["valid"].all()
+    for idx, (offset, length) in enumerate(zip(offsets, lengths)):
+        frame = bytes(buffer[offset:offset + length])
+        packet = CspPacket.from_bytes(frame[RADIO_FRAME_CSP_OFFSET:])
+        for name in CSP_FIELDS:
+            assert columns[name][idx] == getattr(packet, name), name
+        assert headers["length"][idx] == len(packet.payload)
+        assert headers["offset"][idx] == offset + RADIO_FRAME_CSP_OFFSET
+
+
+def test_strided_headers_match_csp_packets():
+    buffer, offsets, lengths = BeaconGenerator(chunk_frames=20).generate(20)
+    # Every other frame is an EPS beacon, evenly spaced
+    offsets, lengths = offsets[::2], lengths[::2]
+    assert _frame_stride(offsets, np.ones(len(offsets), dtype=bool)) is not None
+    headers = decode_csp_headers(buffer, offsets, lengths)
+    _check_against_csp_packets(buffer, offsets, lengths, headers)
+
+
+def test_gathered_headers_match_csp_packets():
+    generated, offsets, lengths = BeaconGenerator(chunk_frames=20).generate(20)
+    frames = [bytes(generated[offset:offset + length])
+              for offset, length in zip(offsets, lengths)]
+    relay = frames[0][:1] + b"\x02" + frames[0][2:]
+    buffer, offsets, lengths = pack_frames(frames + [frames[1][:20], relay, b"\x03\x01"])
+    assert _frame_stride(offsets, np.ones(len(offsets), dtype=bool)) is None
+    headers = decode_csp_headers(buffer, offsets, lengths)
+    assert headers["valid"].tolist() == [True] * 20 + [False] * 3
+    assert not headers["header"][20:].any()
+    selected = {name: values[:20] for name, values in headers.items()}
+    _check_against_csp_packets(buffer, offsets[:20], lengths[:20], selected)
+
+
+def test_select_csp():
+    buffer, offsets, lengths = BeaconGenerator(chunk_frames=20).generate(20)
+    headers = decode_csp_headers(buffer, offsets, lengths)
+    packets = [CspPacket.from_bytes(bytes(buffer[offset + RADIO_FRAME_CSP_OFFSET:
+                                                offset + length]))
+               for offset, length in zip(offsets, lengths)]
+    eps = [packet.dst == 16 and packet.dst_port == 3 for packet in packets]
+    assert 0 < sum(eps) < len(eps)
+    assert select_csp(headers, dst=16, dst_port=3).tolist() == eps
+    assert select_csp(headers, dst=16, dst_port=(3, 11)).all()
+    assert not select_csp(headers, dst=15).any()
+    assert select_csp(headers, predicate=lambda columns: columns["src"] == 2).tolist() == \
+        [packet.src == 2 for packet in packets]
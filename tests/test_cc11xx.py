@@ -0,0 +1,48 @@
+import numpy as np
+
+from rhw_telemetry.cc11xx import PN9_SEQUENCE, check_crc, check_crc_frames, crc16, crc16_rows, \
+    dewhiten, dewhiten_frames, whiten
+
+
+def test_pn9_sequence():
+    # First bytes of the sequence in TI design note DN509
+    assert PN9_SEQUENCE[:16] == bytes.fromhex("FF E1 1D 9A ED 85 33 24 EA 7A D2 39 70 97 57 0A")
+
+
+def test_whitening_round_trip(eps_frame):
+    whitened = whiten(eps_frame)
+    assert whitened != eps_frame
+    assert whitened[0] == eps_frame[0] ^ 0xFF
+    assert dewhiten(whitened) == eps_frame
+
+
+def test_dewhiten_frames(eps_frame):
+    buffer = b"\x00\x11" + whiten(eps_frame) + b"\x22" + whiten(eps_frame[:10])
+    offsets, lengths = [2, 3 + len(eps_frame)], [len(eps_frame), 10]
+    data = dewhiten_frames(buffer, offsets, lengths).tobytes()
+    assert data == b"\x00\x11" + eps_frame + b"\x22" + eps_frame[:10]
+
+
+def test_crc16(eps_frame):
+    # CRC-16/CMS check value
+    assert crc16(b"123456789") == 0xAEE7
+    assert crc16(eps_frame[:-2]) == int.from_bytes(eps_frame[-2:], "big")
+    assert crc16(eps_frame) == 0
+    assert check_crc(eps_frame)
+    assert not check_crc(eps_frame[:-1] + b"\x00")
+
+
+def test_crc16_rows(eps_frame):
+    rows = np.frombuffer(eps_frame * 3, dtype=np.uint8).reshape(3, -1).copy()
+    rows[1, 20] ^= 4
+    assert crc16_rows(rows).tolist()[::2] == [0, 0]
+    assert crc16_rows(rows[:, :-2]).tolist()[0] == crc16(eps_frame[:-2])
+    assert crc16_rows(rows[:, 1:])[0] == crc16(eps_frame[1:])
+
+
+def test_check_crc_frames(eps_frame):
+    corrupted = eps_frame[:30] + b"\x00" + eps_frame[31:]
+    buffer = eps_frame + corrupted + eps_frame
+    size = len(eps_frame)
+    intact = check_crc_frames(buffer, [0, size, 2 * size, 2 * size + 1], [size] * 4)
+    assert intact.tolist() == [True, False, True, False]
@@ -0,0 +1,37 @@
+import io
+
+from rhw_telemetry import cli
+from rhw_telemetry.dedup import DuplicateCache
+
+
+def _write_hex(path, frame):
+    path.write_text(frame.hex(" ").upper() + "\n")
+    return str(path)
+
+
+def _decode(paths, **kwargs):
+    output = io.StringIO()
+    statistics, failures = cli.run(paths, output, workers=1, **kwargs)
+    return output.getvalue().splitlines(), statistics, failures
+
+
+def test_corrupted_copy_does_not_suppress_the_good_one(tmp_path, eps_frame):
+    corrupted = eps_frame[:-1] + bytes([eps_frame[-1] ^ 1])
+    paths = [_write_hex(tmp_path / "st1.hex", corrupted),
+             _write_hex(tmp_path / "st2.hex", eps_frame)]
+    lines, statistics, failures = _decode(paths, dedup=DuplicateCache())
+    assert len(lines) == 1
+    assert statistics["duplicates"] == 0
+    assert failures["crc"] == 1
+
+
+def test_recovered_copy_is_deduplicated(tmp_path, eps_frame):
+    corrupted = bytearray(eps_frame)
+    corrupted[40] ^= 0x10
+    paths = [_write_hex(tmp_path / "st1.hex", bytes(corrupted)),
+             _write_hex(tmp_path / "st2.hex", eps_frame)]
+    lines, statistics, failures = _decode(paths, dedup=DuplicateCache(), max_flips=1)
+    assert len(lines) == 1
+    assert '"bit_flips":1,' in lines[0]
+    assert statistics["duplicates"] == 1
+    assert failures["recovered", 1] == 1
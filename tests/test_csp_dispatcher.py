@@ -0,0 +1,77 @@
+from ctypes import sizeof
+
+import pytest
+
+from rhw_telemetry import hex_decoder
+from rhw_telemetry.hex_decoder import CspDispatcher, EpsStatisticsMessage, UhfStatisticsMessage, \
+    STATISTICS_DISPATCHER, csp_address_mask
+
+# Headers of the EPS and UHF beacons in the samples
+EPS_HEADER = 0x0700C300
+UHF_HEADER = 0x0502C200
+EPS_SIZE = sizeof(EpsStatisticsMessage)
+UHF_SIZE = sizeof(UhfStatisticsMessage)
+
+
+class EpsCommand(EpsStatisticsMessage):
+    # Same size as the EPS beacon, told apart by the address only
+    pass
+
+
+def test_csp_address_mask():
+    mask, value = csp_address_mask({"src": 3, "dst_port": 3})
+    assert EPS_HEADER & mask == value
+    assert UHF_HEADER & mask != value
+    with pytest.raises(ValueError):
+        csp_address_mask({"port": 3})
+    with pytest.raises(ValueError):
+        csp_address_mask({"dst_port": 64})
+
+
+def test_statistics_dispatcher_falls_back_to_the_size():
+    assert STATISTICS_DISPATCHER.lookup(EPS_HEADER, EPS_SIZE) is EpsStatisticsMessage
+    assert STATISTICS_DISPATCHER.lookup(UHF_HEADER, UHF_SIZE) is UhfStatisticsMessage
+    # Any header goes, the payload size tells the beacons apart
+    assert STATISTICS_DISPATCHER.lookup(UHF_HEADER, EPS_SIZE) is EpsStatisticsMessage
+    assert STATISTICS_DISPATCHER.lookup(0x12345678, UHF_SIZE) is UhfStatisticsMessage
+    assert STATISTICS_DISPATCHER.lookup(EPS_HEADER, EPS_SIZE + 1) is None
+    assert STATISTICS_DISPATCHER.payload_sizes() == {EPS_SIZE, UHF_SIZE}
+
+
+def test_address_masks_pick_the_most_specific_registration():
+    dispatcher = CspDispatcher([EpsStatisticsMessage])
+    assert dispatcher.lookup(EPS_HEADER, EPS_SIZE) is EpsStatisticsMessage
+    # Registering drops the memoized headers
+    dispatcher.register(EpsCommand, src=3, dst_port=3)
+    assert dispatcher.lookup(EPS_HEADER, EPS_SIZE) is EpsCommand
+    assert dispatcher.lookup(EPS_HEADER | 1 << 31, EPS_SIZE) is EpsCommand
+    assert dispatcher.lookup(UHF_HEADER, EPS_SIZE) is EpsStatisticsMessage
+    dispatcher.register(UhfStatisticsMessage, src=2, dst_port=11)
+    assert dispatcher.lookup(UHF_HEADER, UHF_SIZE) is UhfStatisticsMessage
+    assert dispatcher.lookup(EPS_HEADER, UHF_SIZE) is None
+    assert dispatcher.payload_sizes() == {EPS_SIZE, UHF_SIZE}
+    dispatcher.register(EpsCommand, src=3, dst_port=3)
+    with pytest.raises(ValueError):
+        dispatcher.register(EpsStatisticsMessage, src=3, dst_port=3)
+
+
+def test_resolved_headers_are_bounded(monkeypatch):
+    monkeypatch.setattr(hex_decoder, "MAX_RESOLVED_HEADERS", 4)
+    dispatcher = CspDispatcher()
+    dispatcher.register(EpsStatisticsMessage, dst=16)
+    for src in range(32):
+        header = EPS_HEADER & ~(31 << 25) | src << 25
+        assert dispatcher.lookup(header, EPS_SIZE) is EpsStatisticsMessage
+        assert dispatcher.lookup(header, UHF_SIZE) is None
+        assert len(dispatcher._resolved) <= 4  # pylint: disable=protected-access
+
+
+def test_dispatch_frame(eps_frame):
+    assert STATISTICS_DISPATCHER.dispatch_frame(eps_frame) is EpsStatisticsMessage
+    assert STATISTICS_DISPATCHER.dispatch_frame(eps_frame[:1] + b"\x02" + eps_frame[2:]) is None
+    with pytest.raises(ValueError):
+        STATISTICS_DISPATCHER.dispatch_frame(eps_frame[:1] + b"\x07" + eps_frame[2:])
+    with pytest.raises(ValueError):
+        STATISTICS_DISPATCHER.dispatch_frame(eps_frame[:6])
+    with pytest.raises(ValueError):
+        STATISTICS_DISPATCHER.dispatch_frame(eps_frame[:50])
@@ -0,0 +1,82 @@
+import struct
+
+from rhw_telemetry.dedup import DuplicateCache, payload_key, timestamp_key
+from rhw_telemetry.hex_decoder import EpsStatisticsMessage, UhfStatisticsMessage, \
+    decode_statistics_frame
+from rhw_telemetry.synthetic import BeaconGenerator
+
+MESSAGE_OFFSET = 8
+
+
+def _frames(count=6):
+    buffer, offsets, lengths = BeaconGenerator(chunk_frames=count).generate(count)
+    return [bytes(buffer[offset:offset + length]) for offset, length in zip(offsets, lengths)]
+
+
+def test_max_entries_evicts_the_least_recently_seen():
+    frames = _frames()
+    cache = DuplicateCache(max_entries=3)
+    assert cache.filter(frames[:3], now=0) == frames[:3]
+    # Seen again, the first frame moves to the back of the queue
+    assert not cache.check(frames[0], now=1)
+    assert cache.check(frames[3], now=2)
+    assert len(cache) == 3
+    assert cache.evicted == 1
+    assert not cache.check(frames[0], now=3)
+    assert cache.check(frames[1], now=4)
+    assert cache.evicted == 2
+    assert (cache.unique, cache.duplicates) == (5, 2)
+
+
+def test_beacon_seen_after_ttl_is_new():
+    frame = _frames(1)[0]
+    now = [1000.0]
+    cache = DuplicateCache(ttl_s=60, clock=lambda: now[0])
+    assert cache.check(frame)
+    now[0] += 50
+    assert not cache.check(frame)
+    # The TTL runs from the last reception
+    now[0] += 55
+    assert not cache.check(frame)
+    now[0] += 61
+    assert cache.check(frame)
+    assert (cache.unique, cache.duplicates) == (2, 2)
+    assert cache.sighting(frame).first_seen == now[0]
+
+
+def test_counts_per_station():
+    frames = _frames(2)
+    cache = DuplicateCache()
+    assert cache.check(frames[0], "st1", now=0)
+    assert not cache.check(frames[0], "st2", now=1)
+    assert not cache.check(frames[0], "st3", now=2)
+    assert cache.check(frames[1], "st2", now=3)
+    assert not cache.check(frames[1], "st1", now=4)
+    sighting = cache.sighting(frames[0])
+    assert sighting.first_station == "st1"
+    assert sighting.also_seen == [("st2", 1), ("st3", 2)]
+    assert sighting.receptions == 3
+    snapshot = cache.snapshot()
+    assert snapshot["first_seen"] == {"st1": 1, "st2": 1}
+    assert snapshot["also_seen"] == {"st1": 1, "st2": 1, "st3": 1}
+
+
+def test_timestamp_key():
+    frames = _frames(2)
+    classes = [decode_statistics_frame(frame)[0] for frame in frames]
+    assert classes == [EpsStatisticsMessage, UhfStatisticsMessage]
+    eps, uhf = frames
+    header, length, timestamp = timestamp_key(eps)
+    assert header == struct.unpack_from(">I", eps, 2)[0]
+    assert length == struct.unpack_from(">H", eps, 6)[0]
+    assert timestamp == EpsStatisticsMessage.decode(eps, MESSAGE_OFFSET)["timestamp"]
+    # Only the timestamp of the payload is part of the key
+    changed = bytearray(eps)
+    changed[MESSAGE_OFFSET + 10] ^= 0xFF
+    assert timestamp_key(bytes(changed)) == timestamp_key(eps)
+    assert payload_key(bytes(changed)) != payload_key(eps)
+    # UHF beacons have no timestamp field
+    assert timestamp_key(uhf) == payload_key(uhf)
+    cache = DuplicateCache(key=timestamp_key)
+    assert cache.check(eps, now=0)
+    assert not cache.check(bytes(changed), now=1)
@@ -0,0 +1,105 @@
+import datetime
+import math
+
+import numpy as np
+import pytest
+
+from rhw_telemetry import doppler
+from rhw_telemetry.fsk_demodulator import FskDemodulator
+from rhw_telemetry.synthetic import BeaconGenerator, FskModulator
+
+TLE_LINE1 = "1 25544U 98067A   08264.51782528 -.00002182  00000-0 -11606-4 0  2927"
+TLE_LINE2 = "2 25544  51.6416 247.4627 0006703 130.5360 325.0288 15.72125391563537"
+CARRIER_HZ = 437e6
+RESIDUAL_HZ = 400.0
+
+
+def test_parse_tle():
+    elements = doppler.parse_tle(TLE_LINE1, TLE_LINE2, "ISS (ZARYA)")
+    epoch = datetime.datetime(2008, 1, 1, tzinfo=datetime.timezone.utc).timestamp() + \
+        263.51782528 * 86400
+    assert elements.name == "ISS (ZARYA)"
+    assert elements.epoch == pytest.approx(epoch)
+    assert elements.inclination == pytest.approx(math.radians(51.6416))
+    assert elements.eccentricity == pytest.approx(0.0006703)
+    assert elements.mean_motion == pytest.approx(15.72125391 * 2 * math.pi / 86400)
+
+
+def test_parse_tle_checks_the_checksum():
+    with pytest.raises(ValueError, match="checksum"):
+        doppler.parse_tle(TLE_LINE1[:-1] + "8", TLE_LINE2)
+    with pytest.raises(ValueError, match="checksum"):
+        doppler.parse_tle(TLE_LINE1, TLE_LINE2.replace("51.6416", "51.6417"))
+    with pytest.raises(ValueError):
+        doppler.parse_tle(TLE_LINE2, TLE_LINE1)
+
+
+def test_load_tle(tmp_path):
+    path = tmp_path / "stations.tle"
+    other = TLE_LINE1.replace("25544", "25545")
+    other = other[:68] + str(doppler._tle_checksum(other))  # pylint: disable=protected-access
+    other2 = TLE_LINE2.replace("25544", "25545")
+    other2 = other2[:68] + str(doppler._tle_checksum(other2))  # pylint: disable=protected-access
+    path.write_text("0 OTHER\n%s\n%s\n\nISS (ZARYA)\n%s\n%s\n" %
+                    (other, other2, TLE_LINE1, TLE_LINE2))
+    assert doppler.load_tle(str(path)).name == "OTHER"
+    assert doppler.load_tle(str(path), "ISS (ZARYA)").name == "ISS (ZARYA)"
+    assert doppler.load_tle(str(path), 25544).name == "ISS (ZARYA)"
+    with pytest.raises(ValueError):
+        doppler.load_tle(str(path), "HUBBLE")
+
+
+def _pass():
+    # A station a few degrees off the ground track, two minutes after epoch
+    elements = doppler.parse_tle(TLE_LINE1, TLE_LINE2)
+    start = elements.epoch + 30
+    times = np.array([start + 120.0])
+    position, _ = doppler.teme_to_ecef(times, *doppler.KeplerOrbit(elements).teme(times))
+    x_km, y_km, z_km = position[0]
+    station = doppler.Station(math.degrees(math.atan2(z_km, math.hypot(x_km, y_km))) + 3,
+                              math.degrees(math.atan2(y_km, x_km)), 0)
+    return elements, station, start
+
+
+def test_corrector_chunks_join_up():
+    elements, station, start = _pass()
+    curve = doppler.doppler_curve(elements, station, start, 5, CARRIER_HZ)
+    rng = np.random.default_rng(1)
+    samples = (rng.normal(size=200000) + 1j * rng.normal(size=200000)).astype(np.complex64)
+    whole = doppler.DopplerCorrector(curve)
+    whole.lock(RESIDUAL_HZ)
+    expected = whole.process(samples)
+    chunked = doppler.DopplerCorrector(curve)
+    chunked.lock(RESIDUAL_HZ)
+    bounds = [0, 1, 999, 65536, 65537, 150000, len(samples)]
+    parts = [chunked.process(samples[low:high]) for low, high in zip(bounds, bounds[1:])]
+    assert chunked.sample_index == whole.sample_index == len(samples)
+    np.testing.assert_allclose(np.concatenate(parts), expected, atol=1e-3)
+
+
+def test_pass_demodulator_follows_the_curve():
+    elements, station, start = _pass()
+    buffer, offsets, lengths = BeaconGenerator(chunk_frames=12).generate(12)
+    frames = [bytes(buffer[offset:offset + length]) for offset, length in zip(offsets, lengths)]
+    samples = FskModulator(noise=0.05).modulate(buffer, offsets, lengths)
+    curve = doppler.doppler_curve(elements, station, start, len(samples) / 96000 + 2,
+                                  CARRIER_HZ)
+    assert abs(curve.offsets_hz).min() > 5000
+    indices = np.arange(len(samples))
+    phase = doppler.curve_phase(curve, indices) + 2 * np.pi * RESIDUAL_HZ * indices / 96000
+    recording = samples * np.exp(1j * phase).astype(np.complex64)
+
+    assert not FskDemodulator().process(recording)
+    for chunk_samples in (60000, 10000):
+        corrector = doppler.DopplerCorrector(curve)
+        demodulator = doppler.PassDemodulator(corrector)
+        found = []
+        residuals = []
+        for idx in range(0, len(recording), chunk_samples):
+            found.extend(demodulator.process(recording[idx:idx + chunk_samples]))
+            residuals.append(corrector.residual_hz)
+        assert [frame.data for frame in found] == frames
+        # Chunks of several frames track the residual once, approaching it
+        # instead of overshooting
+        assert max(residuals) < RESIDUAL_HZ + 100
+    assert abs(residuals[-1] - RESIDUAL_HZ) < 100
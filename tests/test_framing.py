@@ -0,0 +1,48 @@
+from rhw_telemetry.framing import CspPacketFramer, RadioPacketFramer
+from rhw_telemetry.hex_decoder import CspPacket, HWRadioPacket
+
+GARBAGE = b"\x00\xff\x00\x05\x07"
+
+
+def _feed(framer, chunks):
+    packets = []
+    for chunk in chunks:
+        packets.extend(framer.feed(chunk))
+    return packets
+
+
+def test_radio_framer_resyncs_over_garbage_and_split_frames(eps_frame):
+    stream = GARBAGE + eps_frame + GARBAGE + eps_frame
+    chunks = [stream[idx:idx + 7] for idx in range(0, len(stream), 7)]
+    framer = RadioPacketFramer(trailer_size=2, check_crc=True)
+    packets = _feed(framer, chunks)
+    assert [packet.get_bytes() for packet in packets] == [eps_frame[:-2]] * 2
+    assert framer.frames == 2
+    assert framer.bytes_skipped == 2 * len(GARBAGE)
+    assert framer.pending() == 0
+
+
+def test_radio_framer_skips_frames_failing_the_crc(eps_frame):
+    corrupted = eps_frame[:20] + bytes([eps_frame[20] ^ 1]) + eps_frame[21:]
+    framer = RadioPacketFramer(trailer_size=2, check_crc=True)
+    packets = _feed(framer, [corrupted + eps_frame[:50], eps_frame[50:]])
+    assert [packet.get_bytes() for packet in packets] == [eps_frame[:-2]]
+    # False headers inside the corrupted frame fail the CRC too
+    assert framer.crc_errors >= 1
+    assert framer.malformed == framer.crc_errors
+
+
+def test_radio_framer_keeps_an_incomplete_frame(eps_frame):
+    framer = RadioPacketFramer(trailer_size=2)
+    assert not _feed(framer, [eps_frame[:-1]])
+    assert framer.pending() == len(eps_frame) - 1
+    assert len(_feed(framer, [eps_frame[-1:]])) == 1
+
+
+def test_csp_framer_split_frames(eps_frame):
+    # The radio payload ends with the signature, past the CSP length
+    csp = CspPacket.from_bytes(HWRadioPacket.from_bytes(eps_frame[:-2]).payload).get_bytes()
+    framer = CspPacketFramer()
+    packets = _feed(framer, [csp[:3], csp[3:40], csp[40:] + csp[:1], csp[1:]])
+    assert [packet.get_bytes() for packet in packets] == [csp, csp]
+    assert framer.bytes_skipped == 0
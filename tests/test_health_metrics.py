@@ -0,0 +1,39 @@
+import copy
+
+import pytest
+
+from rhw_telemetry.health_metrics import EpsHealthMonitor, RollingStatistics
+from rhw_telemetry.hex_decoder import decode_statistics_frame
+from rhw_telemetry.telemetry_unit_conversions import TEMP_OUT_OF_RANGE, TEMP_INVALID
+
+
+def test_temperature_sentinels_are_left_out(eps_frame):
+    _, message = decode_statistics_frame(eps_frame)
+    monitor = EpsHealthMonitor()
+    temps = []
+    for idx, sentinel in enumerate([None, TEMP_OUT_OF_RANGE, None, TEMP_INVALID]):
+        beacon = copy.deepcopy(message)
+        beacon["timestamp"] = message["timestamp"] + 10 * idx
+        if sentinel is not None:
+            beacon["adc_statistics"]["temp_sns1"] = sentinel
+        else:
+            temps.append(beacon["adc_statistics"]["temp_sns1"])
+        monitor.update(beacon)
+    statistics = monitor.statistics["adc_statistics.temp_sns1"]
+    assert statistics.count == 2
+    assert statistics.min == min(temps)
+    assert statistics.max == max(temps)
+    assert statistics.mean == sum(temps) / 2
+    assert statistics.ewma == temps[0]
+
+
+def test_window_must_be_positive():
+    for window_s in (0, -1):
+        with pytest.raises(ValueError):
+            RollingStatistics(window_s)
+        with pytest.raises(ValueError):
+            EpsHealthMonitor(window_s=window_s)
+    statistics = RollingStatistics(0.5)
+    statistics.update(10, 1)
+    statistics.update(11, 3)
+    assert (statistics.count, statistics.min, statistics.max) == (1, 3, 3)
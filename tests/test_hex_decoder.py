@@ -0,0 +1,77 @@
+import pickle
+
+from rhw_telemetry.hex_decoder import HWRadioPacket, CspPacket, HEADER_PLUS_LENGTH_SIZE, \
+    RADIO_FRAME_CSP_OFFSET, EpsStatisticsMessage, UhfStatisticsMessage, ctypes_obj_to_dic, \
+    decode_statistics_frame
+from rhw_telemetry.synthetic import BeaconGenerator
+
+MESSAGE_OFFSET = RADIO_FRAME_CSP_OFFSET + HEADER_PLUS_LENGTH_SIZE
+
+
+def test_radio_packet_with_zero_length_byte():
+    packet = HWRadioPacket.from_bytes(b"\x00\x01\xaa\xbb")
+    assert packet.get_bytes() == b"\x01\x01"
+    assert str(packet) == "01 01"
+    assert packet.len_without_len_field() == 1
+    assert bytes(packet.payload) == b""
+    assert pickle.loads(pickle.dumps(packet)).get_bytes() == b"\x01\x01"
+
+
+def test_radio_packet_payload_is_bytes(eps_frame):
+    packet = HWRadioPacket.from_bytes(eps_frame[:-2])
+    assert isinstance(packet.payload, bytes)
+    assert packet.payload + b"x" == eps_frame[2:-2] + b"x"
+    assert packet.payload_view == eps_frame[2:-2]
+    packet.payload = b"abc"
+    assert packet.get_bytes() == b"\x04\x01abc"
+
+
+def test_signed_radio_packet_serial_and_cmac(eps_frame):
+    packet = HWRadioPacket.from_bytes(eps_frame[:-2], with_signature=True)
+    assert packet.cmac == eps_frame[-6:-2]
+    assert packet.serial == eps_frame[-10:-6]
+    packet.serial = b"\x01\x02\x03\x04"
+    assert packet.serial == b"\x01\x02\x03\x04"
+    assert packet.get_bytes() == eps_frame[:-2]
+
+
+def test_csp_packet_fields_can_be_assigned(eps_frame):
+    csp = CspPacket.from_bytes(HWRadioPacket.from_bytes(eps_frame[:-2]).payload_view)
+    assert (csp.src, csp.dst, csp.dst_port) == (3, 16, 3)
+    assert isinstance(csp.payload, bytes)
+    csp.dst_port = 10
+    assert csp.dst_port == 10
+    assert CspPacket.from_bytes(csp.get_bytes()).dst_port == 10
+    assert csp.get_bytes()[HEADER_PLUS_LENGTH_SIZE:] == csp.payload
+    csp.payload = b"\x01\x02"
+    assert csp.get_bytes() == csp.get_bytes(False)[:4] + b"\x00\x02\x01\x02"
+
+
+def _synthetic_messages(count=20):
+    buffer, offsets, _ = BeaconGenerator(chunk_frames=count).generate(count)
+    for offset in offsets:
+        frame = bytes(buffer[offset:])
+        yield decode_statistics_frame(frame)[0], frame
+
+
+def _reference(message_class, frame):
+    return ctypes_obj_to_dic(message_class.from_buffer_copy(frame, MESSAGE_OFFSET))
+
+
+def test_compiled_decoder_matches_ctypes(eps_frame):
+    messages = [(EpsStatisticsMessage, eps_frame)] + list(_synthetic_messages())
+    assert {message_class for message_class, _ in messages} == \
+        {EpsStatisticsMessage, UhfStatisticsMessage}
+    for message_class, frame in messages:
+        assert message_class.decode(frame, MESSAGE_OFFSET) == _reference(message_class, frame)
+
+
+def test_message_view_matches_ctypes(eps_frame):
+    messages = [(EpsStatisticsMessage, eps_frame)] + list(_synthetic_messages())
+    for message_class, frame in messages:
+        view = message_class.view(frame, MESSAGE_OFFSET)
+        expected = _reference(message_class, frame)
+        for key, value in expected.items():
+            found = getattr(view, key)
+            assert (found.to_dict() if hasattr(found, "to_dict") else found) == value
+        assert view.to_dict() == expected
@@ -0,0 +1,25 @@
+import asyncio
+import socket
+import time
+
+from rhw_telemetry.ingest_server import IngestServer
+
+
+def test_idle_udp_stations_are_closed(eps_frame):
+    async def scenario():
+        server = IngestServer(udp_idle_s=60)
+        transport = await server.start_udp("127.0.0.1", 0)
+        subscription = server.subscribe()
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+            sender.sendto(eps_frame, transport.get_extra_info("sockname"))
+            await asyncio.wait_for(subscription.__anext__(), 5)
+        assert len(server.connections) == 1
+        assert server.expire_idle() == 0
+        assert server.expire_idle(time.monotonic() + 61) == 1
+        assert not server.connections
+        (station, snapshot), = server.closed_connections
+        assert station.startswith("udp:")
+        assert snapshot["messages"] == 1
+        await server.close()
+
+    asyncio.run(scenario())
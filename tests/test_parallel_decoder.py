@@ -0,0 +1,16 @@
+from rhw_telemetry.parallel_decoder import decode_recording
+from rhw_telemetry.synthetic import main as synthetic_main
+
+
+def test_decimation_keeps_sample_positions(tmp_path):
+    path = str(tmp_path / "beacons.iq")
+    synthetic_main(["--frames", "3", "--format", "iq", "--noise", "0.1", "--output", path])
+    positions = {}
+    for decimation in (1, 2, 4):
+        packets = decode_recording(path, workers=1, decimation=decimation)
+        positions[decimation] = [int(packet.sample_index) for packet in packets]
+    assert len(positions[1]) == 3
+    for decimation in (2, 4):
+        assert len(positions[decimation]) == 3
+        for expected, found in zip(positions[1], positions[decimation]):
+            assert abs(found - expected) <= 1
@@ -0,0 +1,31 @@
+import random
+
+from rhw_telemetry.recovery import recover_frame, recover_frames
+
+
+def _flip(frame, *bits):
+    frame = bytearray(frame)
+    for bit in bits:
+        frame[bit // 8] ^= 0x80 >> (bit % 8)
+    return bytes(frame)
+
+
+def test_every_single_flip_is_recovered(eps_frame):
+    bits = range(8, 8 * len(eps_frame))
+    frames = [_flip(eps_frame, bit) for bit in bits]
+    assert recover_frames(frames, max_flips=1) == [(eps_frame, 1)] * len(frames)
+
+
+def test_flipped_length_byte_is_not_recovered(eps_frame):
+    assert recover_frame(_flip(eps_frame, 3), max_flips=2) == (None, 0)
+
+
+def test_double_flips_are_recovered_or_left_alone(eps_frame):
+    # A double flip shares its syndrome with other pairs, those the
+    # plausibility checks can't tell apart are given up on
+    rng = random.Random(1)
+    results = [recover_frame(_flip(eps_frame, *rng.sample(range(8, 8 * len(eps_frame)), 2)))
+               for _ in range(20)]
+    assert set(results) <= {(eps_frame, 2), (None, 0)}
+    assert (eps_frame, 2) in results
+
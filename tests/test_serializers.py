@@ -0,0 +1,67 @@
+import io
+import json
+import random
+from ctypes import sizeof
+
+from rhw_telemetry.hex_decoder import EpsStatisticsMessage, UhfStatisticsMessage, \
+    decode_statistics_frame
+from rhw_telemetry.serializers import CsvWriter, NdjsonWriter, compile_csv_formatter, \
+    compile_ndjson_formatter, csv_header
+from rhw_telemetry.synthetic import BeaconGenerator
+
+MESSAGE_OFFSET = 8
+
+
+def _messages(eps_frame):
+    messages = [(EpsStatisticsMessage, eps_frame[MESSAGE_OFFSET:])]
+    buffer, offsets, _ = BeaconGenerator(chunk_frames=10).generate(10)
+    for offset in offsets:
+        message_class = decode_statistics_frame(bytes(buffer[offset:]))[0]
+        start = int(offset) + MESSAGE_OFFSET
+        messages.append((message_class, bytes(buffer[start:start + sizeof(message_class)])))
+    # Any byte values, booleans other than 0 and 1 among them. EPS ADC
+    # readings have to stay in range to convert.
+    rng = random.Random(1)
+    for _ in range(10):
+        messages.append((UhfStatisticsMessage, bytes(rng.getrandbits(8) for _ in
+                                                     range(sizeof(UhfStatisticsMessage)))))
+    return messages
+
+
+def test_ndjson_matches_json_dumps(eps_frame):
+    for message_class, data in _messages(eps_frame):
+        expected = json.dumps(message_class.decode(data), separators=(",", ":")) + "\n"
+        assert compile_ndjson_formatter(message_class)(data) == expected
+
+
+def test_ndjson_writer(eps_frame):
+    messages = [data for message_class, data in _messages(eps_frame)
+                if message_class is EpsStatisticsMessage]
+    output = io.StringIO()
+    with NdjsonWriter(output, EpsStatisticsMessage, batch_size=3) as writer:
+        writer.write_all(messages[:5])
+        for data in messages[5:]:
+            writer.write(data)
+    assert writer.messages == len(messages)
+    assert [json.loads(line) for line in output.getvalue().splitlines()] == \
+        [EpsStatisticsMessage.decode(data) for data in messages]
+
+
+def _flatten(value):
+    if isinstance(value, dict):
+        return [item for child in value.values() for item in _flatten(child)]
+    if isinstance(value, list):
+        return [item for child in value for item in _flatten(child)]
+    return [value]
+
+
+def test_csv_matches_decode(eps_frame):
+    for message_class, data in _messages(eps_frame):
+        values = _flatten(message_class.decode(data))
+        line = compile_csv_formatter(message_class)(data)
+        assert line.endswith("\n")
+        assert len(line[:-1].split(",")) == len(csv_header(message_class)) == len(values)
+    output = io.StringIO()
+    with CsvWriter(output, UhfStatisticsMessage) as writer:
+        writer.write(_messages(eps_frame)[2][1])
+    assert output.getvalue().splitlines()[0] == ",".join(csv_header(UhfStatisticsMessage))
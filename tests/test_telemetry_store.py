@@ -0,0 +1,37 @@
+import numpy as np
+
+from rhw_telemetry.hex_decoder import EpsStatisticsMessage
+from rhw_telemetry.telemetry_store import TelemetryStore, TIMESTAMP_COLUMN
+
+
+def _columns(store, timestamps):
+    columns = {}
+    for name, dtype, shape in store.columns:
+        columns[name] = np.zeros((len(timestamps),) + tuple(shape), dtype=dtype)
+    columns[TIMESTAMP_COLUMN] = np.asarray(timestamps)
+    columns["eps_statistics.boot_count"] = np.arange(len(timestamps))
+    return columns
+
+
+def test_append_and_range_query(tmp_path):
+    store = TelemetryStore(str(tmp_path), EpsStatisticsMessage, segment_rows=1000)
+    store.append(_columns(store, np.arange(1000, 3500)))
+    assert len(store.segments()) == 3
+    result = store.read([TIMESTAMP_COLUMN, "eps_statistics.boot_count"], 1500, 2100)
+    assert list(result[TIMESTAMP_COLUMN]) == list(range(1500, 2100))
+    # Sealed segments are delta encoded
+    assert list(result["eps_statistics.boot_count"]) == list(range(500, 1100))
+    reopened = TelemetryStore(str(tmp_path), EpsStatisticsMessage)
+    assert len(reopened.read([TIMESTAMP_COLUMN])[TIMESTAMP_COLUMN]) == 2500
+
+
+def test_uncommitted_rows_are_dropped(tmp_path):
+    store = TelemetryStore(str(tmp_path), EpsStatisticsMessage)
+    store.append(_columns(store, [10, 11]))
+    # A crash after writing a column but before the metadata
+    segment = store.segments()[-1]
+    with open(segment.column_path(TIMESTAMP_COLUMN, "raw"), "ab") as output:
+        output.write(b"\xff" * 12)
+    store = TelemetryStore(str(tmp_path), EpsStatisticsMessage)
+    store.append(_columns(store, [12, 13]))
+    assert list(store.read([TIMESTAMP_COLUMN])[TIMESTAMP_COLUMN]) == [10, 11, 12, 13]
@@ -0,0 +1,54 @@
+from rhw_telemetry.batch_decoder import decode_columns
+from rhw_telemetry.hex_decoder import EpsStatisticsMessage, decode_statistics_frame, \
+    ctypes_obj_to_dic
+from rhw_telemetry.telemetry_unit_conversions import CalibrationProfile, \
+    PAYLOAD_CALIB_MULTIPLIER, PAYLOAD_CALIB_OFFSET, update_solar_panel_current_adc_to_milli_amper, \
+    use_calibration
+from rhw_telemetry.vectorized_conversions import columns_to_ground
+
+MESSAGE_OFFSET = 8
+PROFILE = CalibrationProfile("test-payload", 1, {"PAYLOAD_CALIB_MULTIPLIER": 2.0,
+                                                 "SOLAR_PANEL_CURRENT_CALIB_MULTIPLIER": 2.0})
+
+
+def _payload_currents(frame, view):
+    columns = decode_columns(EpsStatisticsMessage, [frame], offset=MESSAGE_OFFSET)
+    ground = columns_to_ground(EpsStatisticsMessage, columns)
+    return (decode_statistics_frame(frame)[1]["adc_statistics"]["payload_curr"],
+            view.adc_statistics.payload_curr,
+            int(ground["adc_statistics.payload_curr"][0]))
+
+
+def test_profile_switch_reaches_every_conversion(eps_frame):
+    raw = EpsStatisticsMessage.from_buffer_copy(eps_frame, MESSAGE_OFFSET) \
+        .adc_statistics.payload_curr
+    view_class = type(EpsStatisticsMessage.view(eps_frame, MESSAGE_OFFSET))
+    builtin = _payload_currents(eps_frame, view_class(eps_frame, MESSAGE_OFFSET))
+    assert builtin == (int(PAYLOAD_CALIB_MULTIPLIER * raw + PAYLOAD_CALIB_OFFSET),) * 3
+    previous = use_calibration(PROFILE)
+    try:
+        # Views cache converted fields, a new one of the compiled class
+        # converts again
+        calibrated = _payload_currents(eps_frame, view_class(eps_frame, MESSAGE_OFFSET))
+        assert type(EpsStatisticsMessage.view(eps_frame, MESSAGE_OFFSET)) is view_class
+    finally:
+        use_calibration(previous.profile)
+    assert calibrated == (int(2.0 * raw + PAYLOAD_CALIB_OFFSET),) * 3
+    assert _payload_currents(eps_frame, view_class(eps_frame, MESSAGE_OFFSET)) == builtin
+
+
+def test_solar_panel_helper_uses_the_active_profile(eps_frame):
+    message = EpsStatisticsMessage.from_buffer_copy(eps_frame, MESSAGE_OFFSET)
+    raw = message.adc_statistics.spxp_curr
+    converted = ctypes_obj_to_dic(message)["adc_statistics"]["spxp_curr"]
+    previous = use_calibration(PROFILE)
+    try:
+        dic = {"adc_statistics": {"spxp_curr": raw}}
+        update_solar_panel_current_adc_to_milli_amper(dic, "spxp_curr")
+        calibrated = ctypes_obj_to_dic(message)["adc_statistics"]["spxp_curr"]
+    finally:
+        use_calibration(previous.profile)
+    assert dic["adc_statistics"]["spxp_curr"] == calibrated != converted
+    dic = {"adc_statistics": {"spxp_curr": raw}}
+    update_solar_panel_current_adc_to_milli_amper(dic, "spxp_curr")
+    assert dic["adc_statistics"]["spxp_curr"] == converted